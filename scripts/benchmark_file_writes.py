@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+"""Compare the latency of writing files through the sandbox and with safe_write_file.
+
+Usage: ./scripts/benchmark_file_writes.py [--writes N] [--size BYTES]
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from tin.apps.safe_files import safe_write_file
+from tin.sandboxing import get_assignment_sandbox_args
+
+
+def sandboxed_write(root: str, path: str, text: str) -> None:
+    """How files used to be written."""
+    fpath = os.path.join(root, path)
+    os.makedirs(os.path.dirname(fpath), exist_ok=True)
+    subprocess.run(
+        get_assignment_sandbox_args(
+            ["sh", "-c", 'cat >"$1"', "sh", fpath],
+            network_access=False,
+            whitelist=[os.path.dirname(fpath)],
+        ),
+        input=text,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+        check=True,
+    )
+
+
+def benchmark(write, writes: int, text: str) -> list[float]:
+    times = []
+    with tempfile.TemporaryDirectory() as root:
+        for i in range(writes):
+            start = time.perf_counter()
+            write(root, f"assignment-1/student/submission_{i}.py", text)
+            times.append(time.perf_counter() - start)
+    return times
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--writes", type=int, default=200)
+    parser.add_argument("--size", type=int, default=4096)
+    args = parser.parse_args()
+
+    text = "x" * args.size
+    for name, write in (
+        ("sandboxed sh -c cat", sandboxed_write),
+        ("safe_write_file", safe_write_file),
+    ):
+        times = benchmark(write, args.writes, text)
+        print(
+            f"{name:>20}: mean {statistics.mean(times) * 1000:8.3f} ms, "
+            f"median {statistics.median(times) * 1000:8.3f} ms, "
+            f"max {max(times) * 1000:8.3f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -5,3 +5,6 @@ from django.apps import AppConfig
 
 class AssignmentsConfig(AppConfig):
     name = "tin.apps.assignments"
+
+    def ready(self):
+        from . import signals  # pylint: disable=unused-import,import-outside-toplevel # noqa: F401
@@ -66,6 +66,7 @@ class AssignmentForm(forms.ModelForm):
             "grader_timeout",
             "grader_has_network_access",
             "has_network_access",
+            "cache_grader_results",
             "submission_limit_count",
             "submission_limit_interval",
             "submission_limit_cooldown",
@@ -83,6 +84,7 @@ class AssignmentForm(forms.ModelForm):
             "grader_timeout": "Grader timeout (seconds):",
             "grader_has_network_access": "Give the grader internet access?",
             "has_network_access": "Give submissions internet access?",
+            "cache_grader_results": "Reuse grader results for identical submissions?",
             "submission_limit_count": "Rate limit count",
             "submission_limit_interval": "Rate limit interval (minutes)",
             "submission_limit_cooldown": "Rate limit cooldown period (minutes)",
@@ -133,6 +135,7 @@ class AssignmentForm(forms.ModelForm):
                     "grader_timeout",
                     "has_network_access",
                     "grader_has_network_access",
+                    "cache_grader_results",
                     "submission_limit_count",
                     "submission_limit_interval",
                     "submission_limit_cooldown",
@@ -150,6 +153,11 @@ class AssignmentForm(forms.ModelForm):
             'internet access" below. If set, it increases the amount '
             "of time it takes to start up the grader (to about 1.5 "
             "seconds). This is not recommended unless necessary.",
+            "cache_grader_results": "If set, Tin skips running the grader on a submission "
+            "(including when rerunning submissions) if identical code was already graded and "
+            "neither the grader, the assignment's files, nor the virtual environment have "
+            "changed since. Leave this unset if the grader is nondeterministic (for example, "
+            "if it uses randomness, the current time, or the internet).",
             "submission_limit_count": "",
             "submission_limit_interval": "Tin sets rate limits on submissions. If a student tries "
             "to submit too many submissions in a given interval, "
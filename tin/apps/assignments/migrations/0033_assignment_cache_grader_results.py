@@ -0,0 +1,18 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assignments', '0032_assignment_quiz_description_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='assignment',
+            name='cache_grader_results',
+            field=models.BooleanField(default=False),
+        ),
+    ]
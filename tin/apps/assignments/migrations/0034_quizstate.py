@@ -0,0 +1,59 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_quiz_states(apps, schema_editor):
+    QuizLogMessage = apps.get_model("assignments", "QuizLogMessage")
+    QuizState = apps.get_model("assignments", "QuizState")
+
+    totals = (
+        QuizLogMessage.objects.order_by()
+        .values("assignment_id", "student_id")
+        .annotate(
+            severity_total=models.Sum("severity"),
+            ended=models.Max(
+                models.Case(models.When(content="Ended quiz", then=1), default=0)
+            ),
+        )
+    )
+    QuizState.objects.bulk_create(
+        (
+            QuizState(
+                assignment_id=row["assignment_id"],
+                student_id=row["student_id"],
+                severity_total=row["severity_total"],
+                ended=bool(row["ended"]),
+            )
+            for row in totals.iterator()
+        ),
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('assignments', '0033_assignment_cache_grader_results'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QuizState',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('severity_total', models.IntegerField(default=0)),
+                ('ended', models.BooleanField(default=False)),
+                ('assignment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='quiz_states', to='assignments.assignment')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='quiz_states', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='quizstate',
+            constraint=models.UniqueConstraint(fields=('assignment', 'student'), name='unique_quiz_state_assignment_student'),
+        ),
+        migrations.RunPython(build_quiz_states, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 4.2.30 on 2026-10-18 07:12
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assignments', '0034_quizstate'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='quizlogmessage',
+            name='date',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
@@ -1,22 +1,26 @@
 from __future__ import annotations
 
 import datetime
+import hashlib
 import logging
 import os
 import subprocess
-from typing import Literal
+from collections.abc import Iterable
+from typing import Any, Literal
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator
 from django.db import models, transaction
-from django.db.models import Q
+from django.db.models import Exists, F, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
 from django.urls import reverse
 from django.utils import timezone
 
-from ...sandboxing import get_action_sandbox_args, get_assignment_sandbox_args
+from ...sandboxing import get_action_sandbox_args
 from ..courses.models import Course, Period
-from ..submissions.models import Submission
+from ..courses.roles import get_course_roles
+from ..safe_files import safe_write_file
 from ..venvs.models import Venv
 
 logger = logging.getLogger(__name__)
@@ -59,12 +63,15 @@ class AssignmentQuerySet(models.query.QuerySet):
         if user.is_superuser:
             return self.all()
         else:
+            roles = get_course_roles(user)
             perm_q = Q(course__archived=False)
             for perm in perms:
                 perm_q |= Q(course__permission=perm)
-            q = Q(course__teacher=user) | (Q(course__students=user, hidden=False) & perm_q)
+            q = Q(course_id__in=roles.taught_course_ids) | (
+                Q(course_id__in=roles.enrolled_course_ids, hidden=False) & perm_q
+            )
 
-            return self.filter(q).distinct()
+            return self.filter(q)
 
     def filter_visible(self, user):
         r"""Filters assignments that are visible to a user
@@ -89,7 +96,7 @@ class AssignmentQuerySet(models.query.QuerySet):
         if user.is_superuser:
             return self.all()
         else:
-            return self.filter(course__teacher=user).distinct()
+            return self.filter(course_id__in=get_course_roles(user).taught_course_ids)
 
 
 def upload_grader_file_path(assignment, _):  # pylint: disable=unused-argument
@@ -157,6 +164,8 @@ class Assignment(models.Model):
 
     grader_has_network_access = models.BooleanField(default=False)
 
+    cache_grader_results = models.BooleanField(default=False)
+
     has_network_access = models.BooleanField(default=False)
 
     submission_limit_count = models.PositiveIntegerField(
@@ -200,43 +209,54 @@ class Assignment(models.Model):
     def save_grader_file(self, grader_text: str) -> None:
         """Save the grader file to the correct location.
 
-        .. warning::
-
-            Writing to files in directories not controlled by us without some
-            form of sandboxing is a security risk. Most notably, users can use symbolic
-            links to trick you into writing to another file, outside the directory.
-            they control.
-            This solution is very hacky, but we don't have another good way of
-            doing this.
+        The assignment directory is writable by graders, so the file is written
+        with :func:`.safe_write_file` to avoid following symbolic links out of it.
         """
         fname = upload_grader_file_path(self, "")
 
         self.grader_file.name = fname
         self.save()
 
-        fpath = os.path.join(settings.MEDIA_ROOT, self.grader_file.name)
+        safe_write_file(settings.MEDIA_ROOT, self.grader_file.name, grader_text)
 
-        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        # Results from the old grader can never be reused
+        self.cached_grader_results.all().delete()
 
-        args = get_assignment_sandbox_args(
-            ["sh", "-c", 'cat >"$1"', "sh", fpath],
-            network_access=False,
-            whitelist=[os.path.dirname(fpath)],
+    def grader_fingerprint(self) -> str:
+        """A hash of everything about the assignment that can affect grading results.
+
+        This covers the grader, the other files in the assignment directory, and
+        the settings the grader is run with.
+        """
+        digest = hashlib.sha256()
+        digest.update(
+            repr(
+                (
+                    self.language,
+                    self.filename,
+                    str(self.points_possible),
+                    self.enable_grader_timeout,
+                    self.grader_timeout,
+                    self.grader_has_network_access,
+                    self.has_network_access,
+                )
+            ).encode()
         )
 
-        try:
-            subprocess.run(
-                args,
-                input=grader_text,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                encoding="utf-8",
-                text=True,
-                check=True,
-            )
-        except FileNotFoundError as e:
-            logger.error("Cannot run processes: %s", e)
-            raise FileNotFoundError from e
+        grader_log_file = os.path.basename(self.grader_log_filename)
+        assignment_path = os.path.join(settings.MEDIA_ROOT, f"assignment-{self.id}")
+        for item in sorted(os.scandir(assignment_path), key=lambda item: item.name):
+            if item.name == grader_log_file:
+                continue
+
+            if item.is_symlink():
+                digest.update(f"{item.name}\0->{os.readlink(item.path)}\0".encode())
+            elif item.is_file(follow_symlinks=False):
+                with open(item.path, "rb") as f:
+                    file_hash = hashlib.file_digest(f, "sha256").hexdigest()
+                digest.update(f"{item.name}\0{file_hash}\0".encode())
+
+        return digest.hexdigest()
 
     def list_files(self) -> list[tuple[int, str, str, int, datetime.datetime]]:
         """List all files in the assignments directory
@@ -273,32 +293,10 @@ class Assignment(models.Model):
 
     def save_file(self, file_text: str, file_name: str) -> None:
         """Save some text as a file"""
-        self.make_assignment_dir()
-
-        fpath = os.path.join(settings.MEDIA_ROOT, f"assignment-{self.id}", file_name)
-
-        os.makedirs(os.path.dirname(fpath), exist_ok=True)
-
-        args = get_assignment_sandbox_args(
-            ["sh", "-c", 'cat >"$1"', "sh", fpath],
-            network_access=False,
-            whitelist=[os.path.dirname(fpath)],
+        safe_write_file(
+            settings.MEDIA_ROOT, os.path.join(f"assignment-{self.id}", file_name), file_text
         )
 
-        try:
-            subprocess.run(
-                args,
-                input=file_text,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                encoding="utf-8",
-                text=True,
-                check=True,
-            )
-        except FileNotFoundError as e:
-            logger.error("Cannot run processes: %s", e)
-            raise FileNotFoundError from e
-
     def get_file(self, file_id: int) -> tuple[str, str]:
         self.make_assignment_dir()
 
@@ -321,24 +319,13 @@ class Assignment(models.Model):
                 return
 
     def check_rate_limit(self, student) -> None:
-        """Check if a student is submitting too quickly"""
-        now = timezone.localtime()
+        """Check if a student is submitting too quickly
 
-        if (
-            Submission.objects.filter(
-                date_submitted__gte=now
-                - datetime.timedelta(minutes=self.submission_limit_interval),
-                student=student,
-            ).count()
-            > self.submission_limit_count
-        ):
-            with transaction.atomic():
-                current_cooldown = CooldownPeriod.objects.filter(
-                    assignment=self, student=student
-                ).first()
-                if current_cooldown:
-                    current_cooldown.delete()
-                CooldownPeriod.objects.create(assignment=self, student=student)
+        See :func:`.rate_limit.check_rate_limit`.
+        """
+        from .rate_limit import check_rate_limit  # pylint: disable=import-outside-toplevel
+
+        check_rate_limit(self, student)
 
     @property
     def venv_fully_created(self):
@@ -350,14 +337,24 @@ class Assignment(models.Model):
 
     def quiz_open_for_student(self, student):
         """Check if a quiz is open for a specific student"""
-        is_teacher = self.course.teacher.filter(id=student.id).exists()
+        is_teacher = self.course.is_teacher_in_course(student)
         if is_teacher or student.is_superuser:
             return True
-        return not (self.quiz_ended_for_student(student) or self.quiz_locked_for_student(student))
+        state = self.quiz_state_for_student(student)
+        return not (state.ended or (state.has_issues and self.quiz_action == "2"))
+
+    def quiz_state_for_student(self, student) -> QuizState:
+        """Get a student's :class:`.QuizState` for this quiz.
+
+        If the student hasn't been logged for this quiz yet, this is an unsaved,
+        empty state.
+        """
+        state = self.quiz_states.filter(student=student).first()
+        return state if state is not None else QuizState(assignment=self, student=student)
 
     def quiz_ended_for_student(self, student) -> bool:
         """Check if the quiz has ended for a student"""
-        return self.log_messages.filter(student=student, content="Ended quiz").exists()
+        return self.quiz_states.filter(student=student, ended=True).exists()
 
     def quiz_locked_for_student(self, student) -> bool:
         """Check if the quiz has been locked (e.g. due to leaving the tab)"""
@@ -365,10 +362,9 @@ class Assignment(models.Model):
 
     def quiz_issues_for_student(self, student) -> bool:
         """Check if the student has exceeded the maximum amount of issues they can have with a quiz."""
-        return (
-            sum(lm.severity for lm in self.log_messages.filter(student=student))
-            >= settings.QUIZ_ISSUE_THRESHOLD
-        )
+        return self.quiz_states.filter(
+            student=student, severity_total__gte=settings.QUIZ_ISSUE_THRESHOLD
+        ).exists()
 
 
 class CooldownPeriod(models.Model):
@@ -452,13 +448,10 @@ class Quiz(models.Model):
         return f"Quiz for {self.assignment}"
 
     def issues_for_student(self, student):
-        return (
-            sum(lm.severity for lm in self.assignment.log_messages.filter(student=student))
-            >= settings.QUIZ_ISSUE_THRESHOLD
-        )
+        return self.assignment.quiz_issues_for_student(student)
 
     def open_for_student(self, student):
-        is_teacher = student in self.assignment.course.teacher.all()
+        is_teacher = self.assignment.course.is_teacher_in_course(student)
         if is_teacher or student.is_superuser:
             return True
         return not (self.locked_for_student(student) or self.ended_for_student(student))
@@ -467,12 +460,15 @@ class Quiz(models.Model):
         return self.issues_for_student(student) and self.action == "2"
 
     def ended_for_student(self, student):
-        return self.assignment.log_messages.filter(student=student, content="Ended quiz").exists()
+        return self.assignment.quiz_ended_for_student(student)
 
 
 class QuizLogMessage(models.Model):
     """A log message for an :class:`Assignment` (with :attr:`~.Assignment.is_quiz` set to ``True``)"""
 
+    #: The content of the message logged when a student ends a quiz
+    ENDED_QUIZ = "Ended quiz"
+
     assignment = models.ForeignKey(
         Assignment, on_delete=models.CASCADE, related_name="log_messages"
     )
@@ -480,7 +476,7 @@ class QuizLogMessage(models.Model):
         get_user_model(), on_delete=models.CASCADE, related_name="log_messages"
     )
 
-    date = models.DateTimeField(auto_now_add=True)
+    date = models.DateTimeField(default=timezone.now)
     content = models.CharField(max_length=100)
     severity = models.IntegerField()
 
@@ -494,6 +490,87 @@ class QuizLogMessage(models.Model):
         return f"{self.content} for {self.assignment} by {self.student}"
 
 
+class QuizState(models.Model):
+    """A running summary of a student's :class:`QuizLogMessage` objects for a quiz.
+
+    This is updated whenever a log message is created or deleted (see
+    :mod:`.signals`), so checking whether a student has ended a quiz or has too many
+    issues doesn't require reading all of their log messages.
+    """
+
+    assignment = models.ForeignKey(Assignment, on_delete=models.CASCADE, related_name="quiz_states")
+    student = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="quiz_states"
+    )
+
+    severity_total = models.IntegerField(default=0)
+    ended = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name="unique_quiz_state_assignment_student",
+                fields=["assignment", "student"],
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.student}'s quiz state on {self.assignment}"
+
+    @property
+    def has_issues(self) -> bool:
+        """Whether the student has exceeded the maximum amount of issues they can have."""
+        return self.severity_total >= settings.QUIZ_ISSUE_THRESHOLD
+
+    @classmethod
+    def record_messages(cls, messages: Iterable[QuizLogMessage]) -> None:
+        """Add newly created log messages to their students' quiz states."""
+        changes: dict[tuple[int, int], dict[str, Any]] = {}
+        for message in messages:
+            change = changes.setdefault(
+                (message.assignment_id, message.student_id), {"severity": 0, "ended": False}
+            )
+            change["severity"] += message.severity
+            change["ended"] |= message.content == QuizLogMessage.ENDED_QUIZ
+
+        with transaction.atomic():
+            cls.objects.bulk_create(
+                [
+                    cls(assignment_id=assignment_id, student_id=student_id)
+                    for assignment_id, student_id in changes
+                ],
+                ignore_conflicts=True,
+            )
+            for (assignment_id, student_id), change in changes.items():
+                fields = {"severity_total": F("severity_total") + change["severity"]}
+                if change["ended"]:
+                    fields["ended"] = True
+                cls.objects.filter(assignment_id=assignment_id, student_id=student_id).update(
+                    **fields
+                )
+
+    @classmethod
+    def refresh(cls, assignment_id: int, student_id: int) -> None:
+        """Recompute a student's quiz state from their remaining log messages.
+
+        This only updates an existing state, since the assignment or student may be
+        being deleted.
+        """
+        messages = QuizLogMessage.objects.filter(assignment_id=assignment_id, student_id=student_id)
+        cls.objects.filter(assignment_id=assignment_id, student_id=student_id).update(
+            severity_total=Coalesce(
+                Subquery(
+                    messages.order_by()
+                    .values("student")
+                    .annotate(total=Sum("severity"))
+                    .values("total")
+                ),
+                0,
+            ),
+            ended=Exists(messages.filter(content=QuizLogMessage.ENDED_QUIZ)),
+        )
+
+
 def moss_base_file_path(obj, _):  # pylint: disable=unused-argument
     assert obj.assignment.id is not None
     return f"assignment-{obj.assignment.id}/moss-{obj.id}/base.{obj.extension}"
@@ -0,0 +1,262 @@
+"""Buffered ingestion of the quiz log messages reported by students' browsers.
+
+Students' browsers report events (like clicking off the quiz) in batches. Instead
+of writing each one to the database as it arrives, reported messages are buffered
+in a Redis list (at ``QUIZ_LOG_REDIS_URL``) shared by all the web workers, and
+written with a single :meth:`~django.db.models.query.QuerySet.bulk_create` once
+``QUIZ_LOG_BUFFER_SIZE`` messages have been buffered or
+``QUIZ_LOG_FLUSH_INTERVAL`` seconds have passed, whichever comes first. Since the
+buffer is shared, any worker can flush everyone's messages (e.g. before a
+student's log is cleared).
+
+Whether a student's quiz should be colored or locked can't wait for that, so each
+student's total severity and whether they ended the quiz are also kept in the cache,
+and updated as soon as messages are reported.
+
+If Redis is unavailable, or disabled by setting ``QUIZ_LOG_REDIS_URL`` to ``None``,
+messages are saved as soon as they're reported. Messages taken from the buffer are
+lost if the worker flushing them is killed before saving them, so anything that
+needs to be recorded reliably (like a student ending the quiz) should be saved
+directly instead.
+"""
+
+from __future__ import annotations
+
+import atexit
+import datetime
+import json
+import logging
+import threading
+import time
+from collections.abc import Iterable
+from functools import cache as memoize
+
+import redis
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connections, transaction
+
+from .models import QuizLogMessage, QuizState
+
+logger = logging.getLogger(__name__)
+
+#: How long to stop trying Redis for (in seconds) after it fails
+REDIS_RETRY_INTERVAL = 30
+
+BUFFER_KEY = "tin:quiz-log:buffer"
+
+_lock = threading.Lock()
+_flush_timer: threading.Timer | None = None
+_redis_unavailable_until = 0.0
+
+
+@memoize
+def _connect(url: str) -> redis.Redis:
+    return redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+
+def _get_redis() -> redis.Redis | None:
+    if settings.QUIZ_LOG_REDIS_URL is None:
+        return None
+    if time.monotonic() < _redis_unavailable_until:
+        return None
+    return _connect(settings.QUIZ_LOG_REDIS_URL)
+
+
+def _redis_failed(exc: redis.RedisError) -> None:
+    global _redis_unavailable_until  # noqa: PLW0603 # pylint: disable=global-statement
+
+    logger.warning("Saving quiz log messages without buffering them: %s", exc)
+    _redis_unavailable_until = time.monotonic() + REDIS_RETRY_INTERVAL
+
+
+def _severity_key(assignment_id: int, student_id: int) -> str:
+    return f"quiz-severity-{assignment_id}-{student_id}"
+
+
+def _ended_key(assignment_id: int, student_id: int) -> str:
+    return f"quiz-ended-{assignment_id}-{student_id}"
+
+
+def _dump(message: QuizLogMessage) -> str:
+    return json.dumps(
+        [
+            message.assignment_id,
+            message.student_id,
+            message.content,
+            message.severity,
+            message.date.isoformat(),
+        ]
+    )
+
+
+def _load(data: bytes) -> QuizLogMessage:
+    assignment_id, student_id, content, severity, date = json.loads(data)
+    return QuizLogMessage(
+        assignment_id=assignment_id,
+        student_id=student_id,
+        content=content,
+        severity=severity,
+        date=datetime.datetime.fromisoformat(date),
+    )
+
+
+def _buffered_messages() -> list[QuizLogMessage]:
+    conn = _get_redis()
+    if conn is None:
+        return []
+    try:
+        return [_load(data) for data in conn.lrange(BUFFER_KEY, 0, -1)]
+    except redis.RedisError as exc:
+        _redis_failed(exc)
+        return []
+
+
+def get_cached_quiz_state(assignment_id: int, student_id: int) -> tuple[int, bool]:
+    """Get a student's total quiz severity and whether they ended the quiz.
+
+    This reads the student's :class:`.QuizState` if it isn't cached, including any
+    of their messages that haven't been flushed yet.
+
+    Returns:
+        A tuple of the total severity and whether the quiz has ended.
+    """
+    severity_key = _severity_key(assignment_id, student_id)
+    ended_key = _ended_key(assignment_id, student_id)
+    cached = cache.get_many([severity_key, ended_key])
+    if len(cached) == 2:
+        return cached[severity_key], cached[ended_key]
+
+    state = QuizState.objects.filter(assignment_id=assignment_id, student_id=student_id).first()
+    severity, ended = (state.severity_total, state.ended) if state is not None else (0, False)
+    for message in _buffered_messages():
+        if message.assignment_id == assignment_id and message.student_id == student_id:
+            severity += message.severity
+
+    timeout = settings.QUIZ_STATE_CACHE_TIMEOUT
+    cache.add(severity_key, severity, timeout)
+    cache.add(ended_key, ended, timeout)
+    return cache.get(severity_key, severity), cache.get(ended_key, ended)
+
+
+def forget_cached_quiz_state(assignment_id: int, student_id: int) -> None:
+    """Remove a student's quiz state from the cache, e.g. after their log is cleared."""
+    cache.delete_many(
+        [_severity_key(assignment_id, student_id), _ended_key(assignment_id, student_id)]
+    )
+
+
+def report_quiz_log_messages(assignment, student, messages: Iterable[tuple[str, int]]) -> int:
+    """Record log messages reported by a student taking a quiz.
+
+    The messages are buffered (see the module documentation), but the student's
+    cached total severity is updated immediately.
+
+    Args:
+        assignment: The :class:`.Assignment` being taken
+        student: The student taking it
+        messages: The content and severity of each message
+
+    Returns:
+        The student's total severity, including these messages.
+    """
+    messages = [
+        QuizLogMessage(
+            assignment_id=assignment.id,
+            student_id=student.id,
+            content=content[: QuizLogMessage._meta.get_field("content").max_length],
+            severity=severity,
+        )
+        for content, severity in messages
+    ]
+    total, _ = get_cached_quiz_state(assignment.id, student.id)
+    if not messages:
+        return total
+
+    added = sum(message.severity for message in messages)
+    try:
+        total = cache.incr(_severity_key(assignment.id, student.id), added)
+    except ValueError:
+        # It expired in the meantime
+        total += added
+
+    _buffer_messages(messages)
+    return total
+
+
+def _buffer_messages(messages: list[QuizLogMessage]) -> None:
+    global _flush_timer  # noqa: PLW0603 # pylint: disable=global-statement
+
+    conn = _get_redis()
+    if conn is None:
+        _save(messages)
+        return
+
+    try:
+        length = conn.rpush(BUFFER_KEY, *(_dump(message) for message in messages))
+    except redis.RedisError as exc:
+        _redis_failed(exc)
+        _save(messages)
+        return
+
+    if length >= settings.QUIZ_LOG_BUFFER_SIZE:
+        flush_quiz_log_messages()
+        return
+
+    with _lock:
+        if _flush_timer is None:
+            _flush_timer = threading.Timer(settings.QUIZ_LOG_FLUSH_INTERVAL, _flush_in_background)
+            _flush_timer.daemon = True
+            _flush_timer.start()
+
+
+def _flush_in_background() -> None:
+    try:
+        flush_quiz_log_messages()
+    finally:
+        connections.close_all()
+
+
+def _save(messages: list[QuizLogMessage]) -> None:
+    with transaction.atomic():
+        QuizLogMessage.objects.bulk_create(messages)
+        QuizState.record_messages(messages)
+
+
+def flush_quiz_log_messages() -> int:
+    """Write all buffered log messages (reported to any worker) to the database.
+
+    Returns:
+        The number of messages written.
+    """
+    global _flush_timer  # noqa: PLW0603 # pylint: disable=global-statement
+
+    with _lock:
+        if _flush_timer is not None:
+            _flush_timer.cancel()
+            _flush_timer = None
+
+    conn = _get_redis()
+    if conn is None:
+        return 0
+
+    try:
+        pipe = conn.pipeline(transaction=True)
+        pipe.lrange(BUFFER_KEY, 0, -1)
+        pipe.delete(BUFFER_KEY)
+        buffered, _ = pipe.execute()
+    except redis.RedisError as exc:
+        _redis_failed(exc)
+        return 0
+
+    messages = [_load(data) for data in buffered]
+    if messages:
+        _save(messages)
+    return len(messages)
+
+
+@atexit.register
+def _flush_at_exit() -> None:
+    # Only if this process buffered messages that haven't been flushed yet
+    if _flush_timer is not None:
+        flush_quiz_log_messages()
@@ -0,0 +1,264 @@
+"""Submission rate and concurrency limits.
+
+Before a student submits, Tin checks that they don't have too many submissions
+running (see ``CONCURRENT_USER_SUBMISSION_LIMIT``) and that they aren't in a
+:class:`.CooldownPeriod`. After they submit, it checks whether they've submitted
+too many times recently and should be put in one.
+
+These checks are on the hot path of every submission, so they're tracked in Redis
+(at ``SUBMISSION_RATE_LIMIT_REDIS_URL``) with a constant number of commands:
+
+* each student's recent submissions are kept in a sorted set scored by the time
+  they were submitted, so counting the ones in an interval is a ``ZCOUNT``
+* each student's running submissions are kept in another sorted set
+* cooldown periods are keys that expire when the cooldown ends
+
+A student's sets are seeded from the database the first time they're needed, and
+kept up to date as submissions are saved (see :mod:`.signals`). If Redis is
+unavailable, or disabled by setting ``SUBMISSION_RATE_LIMIT_REDIS_URL`` to
+``None``, the same checks are made with database queries instead. (Cooldown periods
+started while Redis was unavailable are only enforced while it still is.)
+"""
+
+from __future__ import annotations
+
+import datetime
+import logging
+import time
+from functools import cache
+
+import redis
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from ..submissions.models import Submission
+from .models import Assignment, CooldownPeriod
+
+logger = logging.getLogger(__name__)
+
+#: How long to stop trying Redis for (in seconds) after it fails
+REDIS_RETRY_INTERVAL = 30
+
+#: How long (in seconds) the set of a student's running submissions is trusted
+#: before being reseeded from the database
+RUNNING_SEED_TIMEOUT = 60 * 60
+
+_redis_unavailable_until = 0.0
+
+
+@cache
+def _connect(url: str) -> redis.Redis:
+    return redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+
+
+def _get_redis() -> redis.Redis | None:
+    if settings.SUBMISSION_RATE_LIMIT_REDIS_URL is None:
+        return None
+    if time.monotonic() < _redis_unavailable_until:
+        return None
+    return _connect(settings.SUBMISSION_RATE_LIMIT_REDIS_URL)
+
+
+def _redis_failed(exc: redis.RedisError) -> None:
+    global _redis_unavailable_until  # noqa: PLW0603 # pylint: disable=global-statement
+
+    logger.warning("Falling back to the database for submission rate limits: %s", exc)
+    _redis_unavailable_until = time.monotonic() + REDIS_RETRY_INTERVAL
+
+
+def _recent_key(student_id: int) -> str:
+    return f"tin:submissions:recent:{student_id}"
+
+
+def _running_key(student_id: int) -> str:
+    return f"tin:submissions:running:{student_id}"
+
+
+def _cooldown_key(assignment_id: int, student_id: int) -> str:
+    return f"tin:submissions:cooldown:{assignment_id}:{student_id}"
+
+
+def _seeded_key(key: str) -> str:
+    return f"{key}:seeded"
+
+
+def _max_interval() -> datetime.timedelta:
+    return datetime.timedelta(minutes=settings.SUBMISSION_RATE_LIMIT_MAX_INTERVAL)
+
+
+def _seed(conn: redis.Redis, key: str, submissions, timeout: int) -> None:
+    """Fill a sorted set with submissions, unless it was filled recently."""
+    if not conn.set(_seeded_key(key), 1, ex=timeout, nx=True):
+        return
+    scores = {
+        str(submission_id): date_submitted.timestamp()
+        for submission_id, date_submitted in submissions.values_list("id", "date_submitted")
+    }
+    pipe = conn.pipeline()
+    pipe.delete(key)
+    if scores:
+        pipe.zadd(key, scores)
+        pipe.expire(key, timeout)
+    pipe.execute()
+
+
+def _seed_recent(conn: redis.Redis, student_id: int) -> None:
+    _seed(
+        conn,
+        _recent_key(student_id),
+        Submission.objects.filter(
+            student_id=student_id, date_submitted__gte=timezone.now() - _max_interval()
+        ),
+        int(_max_interval().total_seconds()),
+    )
+
+
+def _seed_running(conn: redis.Redis, student_id: int) -> None:
+    _seed(
+        conn,
+        _running_key(student_id),
+        Submission.objects.filter(student_id=student_id, complete=False),
+        RUNNING_SEED_TIMEOUT,
+    )
+
+
+def _running_count_from_db(student_id: int) -> int:
+    return Submission.objects.filter(student_id=student_id, complete=False).count()
+
+
+def has_too_many_running_submissions(student) -> bool:
+    """Check whether a student already has as many submissions running as they're allowed."""
+    limit = settings.CONCURRENT_USER_SUBMISSION_LIMIT
+    conn = _get_redis()
+    if conn is None:
+        return _running_count_from_db(student.id) >= limit
+
+    try:
+        _seed_running(conn, student.id)
+        if conn.zcard(_running_key(student.id)) < limit:
+            return False
+        # The set may still contain submissions that finished without being saved
+        # (e.g. with QuerySet.update()), so double check and start over
+        conn.delete(_seeded_key(_running_key(student.id)))
+    except redis.RedisError as exc:
+        _redis_failed(exc)
+    return _running_count_from_db(student.id) >= limit
+
+
+def get_cooldown_remaining(assignment: Assignment, student) -> datetime.timedelta | None:
+    """Get how long is left in a student's cooldown period for an assignment.
+
+    Returns:
+        The time left, or ``None`` if they aren't in a cooldown period.
+    """
+    conn = _get_redis()
+    if conn is not None:
+        try:
+            ttl = conn.pttl(_cooldown_key(assignment.id, student.id))
+        except redis.RedisError as exc:
+            _redis_failed(exc)
+        else:
+            return datetime.timedelta(milliseconds=ttl) if ttl > 0 else None
+
+    cooldown = (
+        CooldownPeriod.objects.filter(assignment=assignment, student=student)
+        .select_related("assignment")
+        .first()
+    )
+    if cooldown is None:
+        return None
+    remaining = cooldown.get_time_to_end()
+    return remaining if remaining > datetime.timedelta() else None
+
+
+def _start_cooldown(assignment: Assignment, student) -> None:
+    with transaction.atomic():
+        CooldownPeriod.objects.filter(assignment=assignment, student=student).delete()
+        CooldownPeriod.objects.create(assignment=assignment, student=student)
+
+    conn = _get_redis()
+    if conn is not None:
+        try:
+            conn.set(
+                _cooldown_key(assignment.id, student.id),
+                1,
+                ex=datetime.timedelta(minutes=assignment.submission_limit_cooldown),
+            )
+        except redis.RedisError as exc:
+            _redis_failed(exc)
+
+
+def check_rate_limit(assignment: Assignment, student) -> None:
+    """Put a student in a cooldown period if they're submitting too quickly.
+
+    This should be called right after they submit.
+    """
+    interval = datetime.timedelta(minutes=assignment.submission_limit_interval)
+    since = timezone.now() - interval
+
+    conn = _get_redis()
+    count = None
+    if conn is not None and interval <= _max_interval():
+        try:
+            _seed_recent(conn, student.id)
+            count = conn.zcount(_recent_key(student.id), since.timestamp(), "+inf")
+        except redis.RedisError as exc:
+            _redis_failed(exc)
+    if count is None:
+        count = Submission.objects.filter(date_submitted__gte=since, student=student).count()
+
+    if count > assignment.submission_limit_count:
+        _start_cooldown(assignment, student)
+
+
+def submission_saved(submission: Submission) -> None:
+    """Keep the sets of a student's recent and running submissions up to date."""
+    conn = _get_redis()
+    if conn is None:
+        return
+
+    member = str(submission.id)
+    recent_key = _recent_key(submission.student_id)
+    running_key = _running_key(submission.student_id)
+    try:
+        pipe = conn.pipeline()
+        pipe.zadd(recent_key, {member: submission.date_submitted.timestamp()})
+        pipe.zremrangebyscore(recent_key, "-inf", (timezone.now() - _max_interval()).timestamp())
+        pipe.expire(recent_key, _max_interval())
+        if submission.complete:
+            pipe.zrem(running_key, member)
+        else:
+            pipe.zadd(running_key, {member: time.time()})
+            pipe.expire(running_key, RUNNING_SEED_TIMEOUT)
+        pipe.execute()
+    except redis.RedisError as exc:
+        _redis_failed(exc)
+
+
+def submission_deleted(submission: Submission) -> None:
+    """Remove a deleted submission from its student's sets."""
+    conn = _get_redis()
+    if conn is None:
+        return
+
+    member = str(submission.id)
+    try:
+        pipe = conn.pipeline()
+        pipe.zrem(_recent_key(submission.student_id), member)
+        pipe.zrem(_running_key(submission.student_id), member)
+        pipe.execute()
+    except redis.RedisError as exc:
+        _redis_failed(exc)
+
+
+def cooldown_deleted(cooldown: CooldownPeriod) -> None:
+    """End a cooldown period in Redis when it's deleted (e.g. by an admin)."""
+    conn = _get_redis()
+    if conn is None:
+        return
+
+    try:
+        conn.delete(_cooldown_key(cooldown.assignment_id, cooldown.student_id))
+    except redis.RedisError as exc:
+        _redis_failed(exc)
@@ -0,0 +1,45 @@
+from __future__ import annotations
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from ..submissions.models import Submission
+from . import rate_limit
+from .models import CooldownPeriod, QuizLogMessage, QuizState
+from .quiz_log import forget_cached_quiz_state
+
+
+def _forget_cached_quiz_state(message):
+    assignment_id, student_id = message.assignment_id, message.student_id
+    transaction.on_commit(lambda: forget_cached_quiz_state(assignment_id, student_id))
+
+
+def update_quiz_state(sender, instance, created, **kwargs):  # pylint: disable=unused-argument
+    if created:
+        QuizState.record_messages([instance])
+        _forget_cached_quiz_state(instance)
+
+
+def update_quiz_state_on_delete(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    QuizState.refresh(instance.assignment_id, instance.student_id)
+    _forget_cached_quiz_state(instance)
+
+
+def track_submission(sender, instance, update_fields=None, **kwargs):  # pylint: disable=unused-argument
+    if update_fields is None or "complete" in update_fields:
+        rate_limit.submission_saved(instance)
+
+
+def untrack_submission(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    rate_limit.submission_deleted(instance)
+
+
+def end_cooldown(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    rate_limit.cooldown_deleted(instance)
+
+
+post_save.connect(update_quiz_state, sender=QuizLogMessage)
+post_delete.connect(update_quiz_state_on_delete, sender=QuizLogMessage)
+post_save.connect(track_submission, sender=Submission)
+post_delete.connect(untrack_submission, sender=Submission)
+post_delete.connect(end_cooldown, sender=CooldownPeriod)
@@ -5,8 +5,10 @@ import os
 
 import mosspy
 from celery import shared_task
+from django.db.models import Prefetch
 
-from ..submissions.models import PublishedSubmission, Submission
+from ..courses.models import Period
+from ..submissions.gradebook import graded_submissions
 from .models import MossResult
 
 logger = logging.getLogger(__name__)
@@ -35,19 +37,24 @@ def run_moss(moss_result_id):
     moss_result.status = "Collecting student code..."
     moss_result.save()
 
-    for student in students:
-        submissions = Submission.objects.filter(student=student, assignment=assignment)
-        latest_submission = submissions.latest() if submissions else None
-        publishes = PublishedSubmission.objects.filter(student=student, assignment=assignment)
-        published_submission = publishes.latest().submission if publishes else latest_submission
-        if published_submission is not None:
-            file_with_header = published_submission.file_text_with_header
-            with open(os.path.join(download_folder, f"{student.username}.{extension}"), "w") as f:
-                f.write(file_with_header)
-            runner.addFile(
-                os.path.join(download_folder, f"{student.username}.{extension}"),
-                f"{student.first_name}_{student.last_name}",
-            )
+    # Everything needed for the headers, as in stream_submissions_zip()
+    submissions = (
+        graded_submissions(assignment, students)
+        .select_related("assignment__course", "student", "blob")
+        .prefetch_related(
+            "comments",
+            Prefetch("student__periods", queryset=Period.objects.filter(course=assignment.course)),
+        )
+    )
+    for submission in submissions:
+        student = submission.student
+        file_with_header = submission.file_text_with_header
+        with open(os.path.join(download_folder, f"{student.username}.{extension}"), "w") as f:
+            f.write(file_with_header)
+        runner.addFile(
+            os.path.join(download_folder, f"{student.username}.{extension}"),
+            f"{student.first_name}_{student.last_name}",
+        )
 
     moss_result.status = "Uploading code to Moss..."
     moss_result.save()
@@ -2,8 +2,13 @@ from __future__ import annotations
 
 import csv
 import io
+import zipfile
+from decimal import Decimal
 
 import pytest
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from tin.tests import is_redirect, login
@@ -43,6 +48,44 @@ def test_delete_assignment(client, assignment):
         assignment.refresh_from_db()
 
 
+@login("teacher")
+@pytest.mark.parametrize("is_quiz", (False, True))
+def test_show_assignment_roster_query_count(client, assignment, submission, is_quiz):
+    assignment.is_quiz = is_quiz
+    assignment.save()
+
+    def get_roster():
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(
+                reverse("assignments:show", args=[assignment.id]), {"period": "all"}
+            )
+        assert response.status_code == 200
+        return response.context["students_and_submissions"], len(queries)
+
+    # Let the teacher's course roles be cached
+    get_roster()
+    roster, num_queries = get_roster()
+    assert [row[2] for row in roster] == [submission]
+
+    for i in range(5):
+        student = get_user_model().objects.create(username=f"student{i}", last_name=str(i))
+        assignment.course.students.add(student)
+        student_submission = assignment.submissions.create(
+            student=student, complete=True, has_been_graded=True, points_received=100
+        )
+        student_submission.publish()
+        assignment.submissions.create(student=student)
+
+    roster, new_num_queries = get_roster()
+    assert len(roster) == 6
+    assert new_num_queries == num_queries
+    for student, _, latest_submission, graded_submission, *_ in roster:
+        if student == submission.student:
+            continue
+        assert latest_submission != graded_submission
+        assert graded_submission.is_latest_publish
+
+
 @login("student")
 def test_submit_assignment_with_text(client, assignment):
     response = client.post(
@@ -70,7 +113,7 @@ def test_csv_of_missing_assignment(client, assignment, student):
     response = client.get(
         reverse("assignments:scores_csv", args=[assignment.id]), {"period": "all"}
     )
-    reader = csv.reader(io.StringIO(response.content.decode("utf-8")))
+    reader = csv.reader(io.StringIO(b"".join(response.streaming_content).decode("utf-8")))
     next(reader)  # skip row with headers
     row = next(reader)
     assert row is not None
@@ -93,7 +136,7 @@ def test_csv_of_missing_assignment_graded(client, assignment, student):
     response = client.get(
         reverse("assignments:scores_csv", args=[assignment.id]), {"period": "all"}
     )
-    reader = csv.reader(io.StringIO(response.content.decode("utf-8")))
+    reader = csv.reader(io.StringIO(b"".join(response.streaming_content).decode("utf-8")))
     next(reader)  # skip initial row with headers
     row = next(reader)
     assert row is not None
@@ -103,3 +146,54 @@ def test_csv_of_missing_assignment_graded(client, assignment, student):
     assert float(raw) == max_points
     assert float(final) == max_points
     assert formatted == "150 / 300 (50.00%)"
+
+
+@login("teacher")
+def test_csv_uses_published_submission_and_point_overrides(client, assignment, student, teacher):
+    published = assignment.submissions.create(
+        student=student, has_been_graded=True, points_received=150
+    )
+    published.comments.create(
+        author=teacher, start_char=0, end_char=1, text="Nice", point_override=10
+    )
+    published.comments.create(
+        author=teacher, start_char=0, end_char=1, text="But", point_override=-40
+    )
+    published.publish()
+    assignment.submissions.create(student=student, has_been_graded=True, points_received=300)
+
+    other_student = get_user_model().objects.create(username="other", full_name="Other")
+    assignment.course.students.add(other_student)
+
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(
+            reverse("assignments:scores_csv", args=[assignment.id]), {"period": "all"}
+        )
+        rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+    assert len(queries) < 10
+
+    rows_by_username = {row[1]: row for row in rows[1:]}
+    raw, final, formatted = rows_by_username[student.username][3:]
+    assert Decimal(raw) == 150
+    assert Decimal(final) == 120
+    assert formatted == "120 / 300 (40.00%)"
+    assert rows_by_username["other"][3:] == ["M", "M", "M"]
+
+
+@login("teacher")
+def test_download_submissions(client, assignment, submission, student):
+    other_student = get_user_model().objects.create(username="other", full_name="Other")
+    assignment.course.students.add(other_student)
+    other_submission = assignment.submissions.create(student=other_student)
+    other_submission.save_file("print('Goodbye World!')")
+
+    response = client.get(
+        reverse("assignments:download_submissions", args=[assignment.id]), {"period": "all"}
+    )
+    with zipfile.ZipFile(io.BytesIO(b"".join(response.streaming_content))) as zf:
+        assert sorted(zf.namelist()) == ["other.py", f"{student.username}.py"]
+        code = zf.read(f"{student.username}.py").decode()
+        assert code.startswith("# Turn-In\n")
+        assert f"# Student: {student.full_name} ({student.username})" in code
+        assert code.endswith("\n\nprint('Hello World!')")
+        assert zf.read("other.py").decode().endswith("\n\nprint('Goodbye World!')")
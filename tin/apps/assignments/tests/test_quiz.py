@@ -6,6 +6,7 @@ import pytest
 from django.conf import settings
 from django.urls import reverse
 
+from tin.apps.assignments.quiz_log import flush_quiz_log_messages
 from tin.tests import is_redirect, login
 
 
@@ -102,3 +103,99 @@ def test_clear_quiz_messages(client, student, quiz):
     response = client.post(reverse("assignments:clear", args=[quiz.id, student.id]))
     assert is_redirect(response)
     assert not quiz.log_messages.exists()
+
+
+def test_quiz_state(quiz, student):
+    assert not quiz.quiz_ended_for_student(student)
+    assert not quiz.quiz_issues_for_student(student)
+
+    quiz.log_messages.create(student=student, content="hi", severity=settings.QUIZ_ISSUE_THRESHOLD)
+    quiz.log_messages.create(student=student, content="hello", severity=1)
+    state = quiz.quiz_states.get(student=student)
+    assert state.severity_total == settings.QUIZ_ISSUE_THRESHOLD + 1
+    assert not state.ended
+    assert quiz.quiz_issues_for_student(student)
+
+    quiz.log_messages.create(student=student, content="Ended quiz", severity=0)
+    assert quiz.quiz_ended_for_student(student)
+    assert not quiz.quiz_open_for_student(student)
+
+    quiz.log_messages.filter(student=student, content="hi").delete()
+    state.refresh_from_db()
+    assert state.severity_total == 1
+    assert state.ended
+    assert not quiz.quiz_issues_for_student(student)
+
+
+@login("teacher")
+def test_clear_quiz_messages_resets_state(client, student, quiz):
+    quiz.quiz_action = "2"
+    quiz.save()
+    quiz.log_messages.create(student=student, content="hi", severity=settings.QUIZ_ISSUE_THRESHOLD)
+    quiz.log_messages.create(student=student, content="Ended quiz", severity=0)
+    assert not quiz.quiz_open_for_student(student)
+
+    client.post(reverse("assignments:clear", args=[quiz.id, student.id]))
+
+    state = quiz.quiz_states.get(student=student)
+    assert state.severity_total == 0
+    assert not state.ended
+    assert quiz.quiz_open_for_student(student)
+
+
+@login("student")
+def test_quiz_report_batch(client, quiz, student):
+    quiz.quiz_action = "2"
+    quiz.save()
+
+    response = client.post(
+        reverse("assignments:report", args=[quiz.id]),
+        {"events": [{"content": "Page loaded", "severity": 0}, {"content": "hi", "severity": 3}]},
+        content_type="application/json",
+    )
+    assert json.loads(response.content) == {"action": "no action"}
+    assert set(quiz.log_messages.values_list("content", "severity")) == {
+        ("Page loaded", 0),
+        ("hi", 3),
+    }
+
+    # the total severity decides whether the quiz is locked
+    response = client.post(
+        reverse("assignments:report", args=[quiz.id]),
+        {"events": [{"content": "hi", "severity": settings.QUIZ_ISSUE_THRESHOLD - 3}]},
+        content_type="application/json",
+    )
+    assert json.loads(response.content) == {"action": "lock"}
+    assert quiz.quiz_states.get(student=student).severity_total == settings.QUIZ_ISSUE_THRESHOLD
+
+    response = client.post(
+        reverse("assignments:report", args=[quiz.id]),
+        {"events": [{"content": "hi"}]},
+        content_type="application/json",
+    )
+    assert response.status_code == 400
+
+
+@login("student")
+def test_quiz_report_form(client, quiz, student):
+    # What navigator.sendBeacon() sends when the page is closed
+    client.post(
+        reverse("assignments:report", args=[quiz.id]),
+        {"events": json.dumps([{"content": "Clicked off browser", "severity": 5}])},
+    )
+    assert quiz.log_messages.get().content == "Clicked off browser"
+
+
+@login("student")
+def test_quiz_report_without_redis(client, settings, quiz, student):
+    # Messages are saved right away if the buffer can't be reached
+    settings.QUIZ_LOG_REDIS_URL = "redis://localhost:1/0"
+
+    client.post(
+        reverse("assignments:report", args=[quiz.id]),
+        {"events": [{"content": "a", "severity": 0}, {"content": "b", "severity": 1}]},
+        content_type="application/json",
+    )
+    assert quiz.log_messages.count() == 2
+    assert quiz.quiz_states.get(student=student).severity_total == 1
+    assert flush_quiz_log_messages() == 0
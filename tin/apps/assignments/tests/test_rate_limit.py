@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import datetime
+
+from django.conf import settings
+from django.urls import reverse
+
+from tin.apps.assignments.models import CooldownPeriod
+from tin.apps.assignments.rate_limit import (
+    check_rate_limit,
+    get_cooldown_remaining,
+    has_too_many_running_submissions,
+)
+from tin.tests import login
+
+
+def test_running_submissions(assignment, student):
+    for _ in range(settings.CONCURRENT_USER_SUBMISSION_LIMIT - 1):
+        assignment.submissions.create(student=student)
+    assert not has_too_many_running_submissions(student)
+
+    submission = assignment.submissions.create(student=student)
+    assert has_too_many_running_submissions(student)
+
+    submission.complete = True
+    submission.save()
+    assert not has_too_many_running_submissions(student)
+
+
+def test_rate_limit_cooldown(assignment, student):
+    assignment.submission_limit_count = 2
+    assignment.submission_limit_cooldown = 10
+    assignment.save()
+
+    for _ in range(2):
+        assignment.submissions.create(student=student, complete=True)
+        check_rate_limit(assignment, student)
+    assert get_cooldown_remaining(assignment, student) is None
+
+    assignment.submissions.create(student=student, complete=True)
+    check_rate_limit(assignment, student)
+    remaining = get_cooldown_remaining(assignment, student)
+    assert datetime.timedelta(minutes=9) < remaining <= datetime.timedelta(minutes=10)
+
+    CooldownPeriod.objects.filter(assignment=assignment, student=student).update(
+        start_time=datetime.datetime(2000, 1, 1, tzinfo=datetime.UTC)
+    )
+    assert get_cooldown_remaining(assignment, student) is None
+
+
+@login("student")
+def test_submit_while_limited(client, assignment, student):
+    for _ in range(settings.CONCURRENT_USER_SUBMISSION_LIMIT):
+        assignment.submissions.create(student=student)
+
+    response = client.post(reverse("assignments:submit", args=[assignment.id]), {"text": "print()"})
+    assert "running at the same time" in response.context["text_errors"]
+
+    assignment.submissions.update(complete=True)
+    CooldownPeriod.objects.create(assignment=assignment, student=student)
+    response = client.post(reverse("assignments:submit", args=[assignment.id]), {"text": "print()"})
+    assert "too many submissions too quickly" in response.context["text_errors"]
+    assert assignment.submissions.count() == settings.CONCURRENT_USER_SUBMISSION_LIMIT
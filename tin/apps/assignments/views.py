@@ -1,17 +1,20 @@
 from __future__ import annotations
 
-import csv
+import collections
+import concurrent.futures
 import datetime
+import json
 import logging
 import os
 import subprocess
 import zipfile
-from io import BytesIO
 
 import celery
 from django import http
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models import FilteredRelation, Prefetch, Q, Value
+from django.db.models.functions import Coalesce
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
 from django.utils.text import slugify
@@ -20,8 +23,11 @@ from django.utils.timezone import now
 from ... import sandboxing
 from ..auth.decorators import login_required, teacher_or_superuser_required
 from ..courses.models import Course, Period
-from ..submissions.models import PublishedSubmission, Submission
+from ..streaming import stream_csv
+from ..submissions.gradebook import annotate_gradebook, graded_submissions
+from ..submissions.models import GradebookEntry, Submission
 from ..submissions.tasks import run_submission
+from ..submissions.utils import format_grade
 from ..users.models import User
 from .forms import (
     AssignmentForm,
@@ -32,12 +38,217 @@ from .forms import (
     MossForm,
     TextSubmissionForm,
 )
-from .models import Assignment, CooldownPeriod, QuizLogMessage
+from .models import Assignment, QuizLogMessage
+from .quiz_log import flush_quiz_log_messages, get_cached_quiz_state, report_quiz_log_messages
+from .rate_limit import get_cooldown_remaining, has_too_many_running_submissions
 from .tasks import run_moss
 
 logger = logging.getLogger(__name__)
 
 
+def get_latest_and_graded_submission(assignment, student):
+    """Get a student's latest and graded submissions to an assignment from the gradebook.
+
+    The graded submission is the student's latest published submission, or else their
+    latest submission.
+
+    Returns:
+        A tuple of the latest and graded submissions, which are ``None`` if the
+        student hasn't submitted anything.
+    """
+    entry = (
+        GradebookEntry.objects.filter(assignment=assignment, student=student)
+        .select_related("latest_submission", "published_submission")
+        .first()
+    )
+    if entry is None:
+        return None, None
+    return entry.latest_submission, entry.graded_submission
+
+
+def get_student_roster(assignment, students):
+    """Fetch the students in a roster along with their submissions to an assignment.
+
+    This takes a constant number of queries, no matter how many students there are.
+
+    Args:
+        assignment: The :class:`.Assignment`
+        students: A queryset of students (or an empty list)
+
+    Returns:
+        A tuple of the students and a dictionary mapping submission ids to submissions.
+        Each student is annotated as described in :func:`.annotate_gradebook`, and with
+
+        * ``assignment_periods``: the student's periods in the assignment's course
+        * ``quiz_ended`` and ``quiz_severity`` (quizzes only): whether the student ended
+          the quiz and the total severity of their quiz log messages, read from their
+          :class:`.QuizState`
+    """
+    if not students:
+        return [], {}
+
+    students = annotate_gradebook(assignment, students).prefetch_related(
+        Prefetch(
+            "periods",
+            queryset=Period.objects.filter(course=assignment.course),
+            to_attr="assignment_periods",
+        )
+    )
+
+    if assignment.is_quiz:
+        students = students.annotate(
+            quiz_state=FilteredRelation(
+                "quiz_states", condition=Q(quiz_states__assignment=assignment)
+            )
+        ).annotate(
+            quiz_ended=Coalesce("quiz_state__ended", Value(value=False)),
+            quiz_severity=Coalesce("quiz_state__severity_total", 0),
+        )
+
+    students = list(students)
+
+    submission_ids = {student.latest_submission_id for student in students}
+    submission_ids |= {student.published_submission_id for student in students}
+    submission_ids.discard(None)
+    submissions_by_id = (
+        Submission.objects.filter(id__in=submission_ids)
+        .select_related("assignment")
+        .prefetch_related("comments")
+        .with_publish_info()
+        .in_bulk()
+    )
+
+    return students, submissions_by_id
+
+
+#: How many rows to fetch from the database at once when streaming downloads
+STREAMING_CHUNK_SIZE = 500
+
+
+def scores_csv_rows(assignment, students):
+    """Generate the rows of the CSV of an assignment's scores.
+
+    Each student's scores are read from the gradebook as part of the query for the
+    students, which is streamed in chunks of
+    :data:`STREAMING_CHUNK_SIZE` students. Memory usage doesn't depend on the
+    number of students.
+
+    Args:
+        assignment: The :class:`.Assignment`
+        students: A queryset of students
+    """
+    students = (
+        annotate_gradebook(assignment, students)
+        .prefetch_related(
+            Prefetch(
+                "periods",
+                queryset=Period.objects.filter(course=assignment.course),
+                to_attr="assignment_periods",
+            )
+        )
+        .order_by("periods", "last_name")
+    )
+
+    yield ["Name", "Username", "Period", "Raw Score", "Final Score", "Formatted Grade"]
+
+    for student in students.iterator(chunk_size=STREAMING_CHUNK_SIZE):
+        row = [
+            student.full_name,
+            student.username,
+            ", ".join(p.name for p in student.assignment_periods),
+        ]
+
+        if student.graded_submission_id is None:
+            row.extend(["M", "M", "M"])
+        elif not student.graded_points_received:
+            row.extend(["NG", "NG", "NG"])
+        else:
+            row.append(student.graded_points_received)
+            row.append(student.graded_points)
+            row.append(
+                format_grade(student.graded_points, assignment.points_possible)
+                if student.graded_has_been_graded
+                else "Not graded"
+            )
+        yield row
+
+
+class _ZipStream:
+    """A write-only file-like object that buffers what is written until it is taken.
+
+    Since it isn't seekable, :class:`zipfile.ZipFile` writes each entry's sizes
+    after its data, so entries can be sent as soon as they are written.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_submissions_zip(assignment, students):
+    """Generate a ``.zip`` of each student's graded submission to an assignment.
+
+    Submissions (along with everything needed for their headers) are fetched in
+    chunks, and their files are read by a pool of
+    ``settings.SUBMISSION_FILE_READ_THREADS`` threads. Only a bounded number of
+    files are read ahead of the one being written, so memory usage doesn't depend
+    on the number of students.
+
+    Args:
+        assignment: The :class:`.Assignment`
+        students: A queryset of students
+    """
+    extension = "py" if assignment.filename.endswith(".py") else "java"
+
+    submissions = (
+        graded_submissions(assignment, students)
+        .select_related("assignment__course", "student", "blob")
+        .prefetch_related(
+            "comments",
+            Prefetch("student__periods", queryset=Period.objects.filter(course=assignment.course)),
+        )
+        .order_by("student__username")
+    )
+
+    max_threads = settings.SUBMISSION_FILE_READ_THREADS
+    stream = _ZipStream()
+    with (
+        zipfile.ZipFile(stream, "w") as zf,
+        concurrent.futures.ThreadPoolExecutor(max_threads) as executor,
+    ):
+
+        def write_entry(submission, file_text):
+            # The header may need the database, so it isn't built in the thread pool
+            zf.writestr(
+                f"{submission.student.username}.{extension}",
+                submission.file_header + "\n\n" + file_text.result(),
+            )
+
+        pending = collections.deque()
+        for submission in submissions.iterator(chunk_size=STREAMING_CHUNK_SIZE):
+            pending.append((submission, executor.submit(lambda s=submission: s.file_text)))
+            if len(pending) > 2 * max_threads:
+                write_entry(*pending.popleft())
+                yield stream.take()
+
+        while pending:
+            write_entry(*pending.popleft())
+            yield stream.take()
+
+    yield stream.take()
+
+
 @login_required
 def show_view(request, assignment_id):
     """Shows an overview of the :class:`.Assignment`
@@ -54,9 +265,9 @@ def show_view(request, assignment_id):
 
     if course.is_only_student_in_course(request.user):
         submissions = Submission.objects.filter(student=request.user, assignment=assignment)
-        latest_submission = submissions.latest() if submissions else None
-        publishes = PublishedSubmission.objects.filter(student=request.user, assignment=assignment)
-        graded_submission = publishes.latest().submission if publishes else latest_submission
+        latest_submission, graded_submission = get_latest_and_graded_submission(
+            assignment, request.user
+        )
 
         return render(
             request,
@@ -69,7 +280,7 @@ def show_view(request, assignment_id):
                 "latest_submission": latest_submission,
                 "graded_submission": graded_submission,
                 "is_student": course.is_student_in_course(request.user),
-                "is_teacher": request.user in course.teacher.all(),
+                "is_teacher": course.is_teacher_in_course(request.user),
                 "quiz_accessible": quiz_accessible,
             },
         )
@@ -92,7 +303,7 @@ def show_view(request, assignment_id):
             )
         elif course.period_set.exists():
             if period == "":
-                if request.user in course.teacher.all():
+                if course.is_teacher_in_course(request.user):
                     try:
                         period = (
                             course.period_set.filter(teacher=request.user).order_by("name")[0].id
@@ -120,12 +331,12 @@ def show_view(request, assignment_id):
             active_period = "none"
             student_list = []
 
-        for student in student_list:
-            period = student.periods.filter(course=assignment.course)
-            submissions = Submission.objects.filter(student=student, assignment=assignment)
-            publishes = PublishedSubmission.objects.filter(student=student, assignment=assignment)
-            latest_submission = submissions.latest() if submissions else None
-            graded_submission = publishes.latest().submission if publishes else latest_submission
+        students, submissions_by_id = get_student_roster(assignment, student_list)
+        for student in students:
+            latest_submission = submissions_by_id.get(student.latest_submission_id)
+            graded_submission = submissions_by_id.get(
+                student.published_submission_id, latest_submission
+            )
 
             if not assignment.is_quiz:
                 if latest_submission:
@@ -134,7 +345,7 @@ def show_view(request, assignment_id):
                 students_and_submissions.append(
                     (
                         student,
-                        period,
+                        student.assignment_periods,
                         latest_submission,
                         graded_submission,
                         new_since_last_login,
@@ -145,11 +356,14 @@ def show_view(request, assignment_id):
                 students_and_submissions.append(
                     (
                         student,
-                        period,
+                        student.assignment_periods,
                         latest_submission,
                         graded_submission,
-                        assignment.quiz_ended_for_student(student),
-                        assignment.quiz_locked_for_student(student),
+                        student.quiz_ended,
+                        (
+                            student.quiz_severity >= settings.QUIZ_ISSUE_THRESHOLD
+                            and assignment.quiz_action == "2"
+                        ),
                     )
                 )
 
@@ -162,7 +376,7 @@ def show_view(request, assignment_id):
                 os.path.exists(os.path.join(settings.MEDIA_ROOT, assignment.grader_log_filename))
             ),
             "is_student": course.is_student_in_course(request.user),
-            "is_teacher": request.user in course.teacher.all(),
+            "is_teacher": course.is_teacher_in_course(request.user),
             "query": query,
             "period_set": period_set,
             "active_period": active_period,
@@ -170,9 +384,9 @@ def show_view(request, assignment_id):
         }
 
         submissions = Submission.objects.filter(student=request.user, assignment=assignment)
-        publishes = PublishedSubmission.objects.filter(student=request.user, assignment=assignment)
-        latest_submission = submissions.latest() if submissions else None
-        graded_submission = publishes.latest().submission if publishes else latest_submission
+        latest_submission, graded_submission = get_latest_and_graded_submission(
+            assignment, request.user
+        )
         context.update(
             {
                 "submissions": submissions.order_by("-date_submitted"),
@@ -492,9 +706,7 @@ def student_submissions_view(request, assignment_id, student_id):
     student = get_object_or_404(User, id=student_id)
 
     submissions = Submission.objects.filter(student=student, assignment=assignment)
-    publishes = PublishedSubmission.objects.filter(student=student, assignment=assignment)
-    latest_submission = submissions.latest() if submissions else None
-    published_submission = publishes.latest().submission if publishes else latest_submission
+    latest_submission, published_submission = get_latest_and_graded_submission(assignment, student)
 
     log_messages = (
         assignment.log_messages.filter(student=student).order_by("date")
@@ -550,10 +762,7 @@ def submit_view(request, assignment_id):
         if assignment.grader_file is None:
             return redirect("assignments:show", assignment.id)
 
-        if (
-            Submission.objects.filter(student=request.user, complete=False).count()
-            >= settings.CONCURRENT_USER_SUBMISSION_LIMIT
-        ):
+        if has_too_many_running_submissions(student):
             if request.FILES.get("file"):
                 file_form = FileSubmissionForm(request.POST, request.FILES)
                 file_errors = (
@@ -572,10 +781,7 @@ def submit_view(request, assignment_id):
                         "" if settings.CONCURRENT_USER_SUBMISSION_LIMIT == 1 else "s",
                     )
                 )
-        elif CooldownPeriod.exists(assignment=assignment, student=student):
-            cooldown_period = CooldownPeriod.objects.get(assignment=assignment, student=student)
-
-            end_delta = cooldown_period.get_time_to_end()
+        elif (end_delta := get_cooldown_remaining(assignment, student)) is not None:
             # Throw out the microseconds
             end_delta = datetime.timedelta(days=end_delta.days, seconds=end_delta.seconds)
 
@@ -608,8 +814,6 @@ def submit_view(request, assignment_id):
 
                         assignment.check_rate_limit(student)
 
-                        submission.create_backup_copy(submission_text)
-
                         run_submission.delay(submission.id)
                         return redirect("assignments:show", assignment.id)
             else:
@@ -627,8 +831,6 @@ def submit_view(request, assignment_id):
 
                     assignment.check_rate_limit(student)
 
-                    submission.create_backup_copy(submission_text)
-
                     run_submission.delay(submission.id)
                     return redirect("assignments:show", assignment.id)
                 else:
@@ -672,15 +874,9 @@ def rerun_view(request, assignment_id):
     else:
         raise http.Http404
 
-    submission_reruns = []
-
-    for student in students:
-        submissions = Submission.objects.filter(student=student, assignment=assignment)
-        latest_submission = submissions.latest() if submissions else None
-        publishes = PublishedSubmission.objects.filter(student=request.user, assignment=assignment)
-        published_submission = publishes.latest().submission if publishes else latest_submission
-        if published_submission:
-            submission_reruns.append(published_submission.rerun())
+    submission_reruns = [
+        submission.rerun() for submission in graded_submissions(assignment, students)
+    ]
 
     celery.group(submission_reruns).delay()
 
@@ -716,10 +912,7 @@ def quiz_view(request, assignment_id):
         if assignment.grader_file is None:
             return redirect("assignments:show", assignment.id)
 
-        if (
-            Submission.objects.filter(student=request.user, complete=False).count()
-            >= settings.CONCURRENT_USER_SUBMISSION_LIMIT
-        ):
+        if has_too_many_running_submissions(student):
             text_form = TextSubmissionForm(request.POST)
             text_errors = (
                 "You may only have a maximum of {} submission{} running at the same time".format(
@@ -727,10 +920,7 @@ def quiz_view(request, assignment_id):
                     "" if settings.CONCURRENT_USER_SUBMISSION_LIMIT == 1 else "s",
                 )
             )
-        elif CooldownPeriod.exists(assignment=assignment, student=student):
-            cooldown_period = CooldownPeriod.objects.get(assignment=assignment, student=student)
-
-            end_delta = cooldown_period.get_time_to_end()
+        elif (end_delta := get_cooldown_remaining(assignment, student)) is not None:
             # Throw out the microseconds
             end_delta = datetime.timedelta(days=end_delta.days, seconds=end_delta.seconds)
 
@@ -752,14 +942,14 @@ def quiz_view(request, assignment_id):
 
                     assignment.check_rate_limit(student)
 
-                    submission.create_backup_copy(submission_text)
-
                     run_submission.delay(submission.id)
                     return redirect("assignments:quiz", assignment.id)
                 else:
                     text_errors = "Submission too large"
 
-    quiz_color = assignment.quiz_issues_for_student(request.user) and assignment.quiz_action == "1"
+    quiz_color = (
+        assignment.quiz_state_for_student(request.user).has_issues and assignment.quiz_action == "1"
+    )
 
     return render(
         request,
@@ -777,10 +967,23 @@ def quiz_view(request, assignment_id):
     )
 
 
+#: The most log messages a browser may report at once
+MAX_REPORTED_QUIZ_EVENTS = 100
+
+
 @login_required
 def quiz_report_view(request, assignment_id):
     """Allows client-side JavaScript to report quiz log messages
 
+    A single message can be reported with a GET request with ``content`` and
+    ``severity`` parameters. Several can be reported at once by POSTing
+    ``{"events": [{"content": ..., "severity": ...}, ...]}`` as JSON, or as the
+    ``events`` field of a form.
+
+    The messages are buffered before being saved (see :mod:`.quiz_log`), but the
+    response says right away whether the quiz should be colored or locked, based
+    on the student's total severity.
+
     Args:
         request: The request
         assignment_id: The primary key of the :class:`.Assignment` model
@@ -789,17 +992,27 @@ def quiz_report_view(request, assignment_id):
         Assignment.objects.filter_visible(request.user), id=assignment_id
     )
 
-    content = request.GET.get("content", "")
-    severity = int(request.GET.get("severity", 0))
+    try:
+        if request.method == "POST":
+            if request.content_type == "application/json":
+                events = json.loads(request.body)["events"]
+            else:
+                # Sent with navigator.sendBeacon(), which can't send JSON with a CSRF token
+                events = json.loads(request.POST["events"])
+            events = events[:MAX_REPORTED_QUIZ_EVENTS]
+            messages = [(str(event["content"]), int(event["severity"])) for event in events]
+        else:
+            messages = [(request.GET.get("content", ""), int(request.GET.get("severity", 0)))]
+    except (ValueError, TypeError, KeyError):
+        return http.HttpResponseBadRequest()
 
     action = "no action"
 
-    if not assignment.quiz_ended_for_student(request.user):
-        QuizLogMessage.objects.create(
-            assignment=assignment, student=request.user, content=content, severity=severity
-        )
+    _, ended = get_cached_quiz_state(assignment.id, request.user.id)
+    if not ended:
+        total = report_quiz_log_messages(assignment, request.user, messages)
 
-        if severity >= settings.QUIZ_ISSUE_THRESHOLD:
+        if total >= settings.QUIZ_ISSUE_THRESHOLD:
             if assignment.quiz_action == "1":
                 action = "color"
             elif assignment.quiz_action == "2":
@@ -820,8 +1033,10 @@ def quiz_end_view(request, assignment_id):
         Assignment.objects.filter_visible(request.user), id=assignment_id
     )
 
+    # Keep the log in order
+    flush_quiz_log_messages()
     QuizLogMessage.objects.create(
-        assignment=assignment, student=request.user, content="Ended quiz", severity=0
+        assignment=assignment, student=request.user, content=QuizLogMessage.ENDED_QUIZ, severity=0
     )
 
     return redirect("assignments:show", assignment.id)
@@ -843,6 +1058,7 @@ def quiz_clear_view(request, assignment_id, user_id):
     )
     user = get_object_or_404(get_user_model(), id=user_id)
 
+    flush_quiz_log_messages()
     assignment.log_messages.filter(student=user).delete()
 
     return redirect("assignments:student_submission", assignment.id, user.id)
@@ -874,36 +1090,10 @@ def scores_csv_view(request, assignment_id):
     else:
         raise http.Http404
 
-    response = http.HttpResponse(content_type="text/csv")
+    response = http.StreamingHttpResponse(
+        stream_csv(scores_csv_rows(assignment, students)), content_type="text/csv"
+    )
     response["Content-Disposition"] = f"attachment; filename={name}"
-
-    writer = csv.writer(response)
-    writer.writerow(["Name", "Username", "Period", "Raw Score", "Final Score", "Formatted Grade"])
-
-    for student in students.order_by("periods", "last_name"):
-        row = [student.full_name, student.username]
-        periods = ", ".join([p.name for p in student.periods.filter(course=assignment.course)])
-        row.append(periods)
-
-        submissions = Submission.objects.filter(student=student, assignment=assignment)
-        latest_submission = submissions.latest() if submissions else None
-        publishes = PublishedSubmission.objects.filter(student=student, assignment=assignment)
-        published_submission = publishes.latest().submission if publishes else latest_submission
-        if published_submission is not None:
-            if published_submission.points_received:
-                row.append(published_submission.points_received)
-                row.append(published_submission.points)
-                row.append(published_submission.formatted_grade)
-            else:
-                row.append("NG")
-                row.append("NG")
-                row.append("NG")
-        else:
-            row.append("M")
-            row.append("M")
-            row.append("M")
-        writer.writerow(row)
-
     return response
 
 
@@ -933,20 +1123,9 @@ def download_submissions_view(request, assignment_id):
     else:
         raise http.Http404
 
-    language = "P" if assignment.filename.endswith(".py") else "J"
-    extension = "java" if language == "J" else "py"
-
-    s = BytesIO()
-    with zipfile.ZipFile(s, "w") as zf:
-        for student in students:
-            submissions = Submission.objects.filter(student=student, assignment=assignment)
-            latest_submission = submissions.latest() if submissions else None
-            publishes = PublishedSubmission.objects.filter(student=student, assignment=assignment)
-            published_submission = publishes.latest().submission if publishes else latest_submission
-            if published_submission is not None:
-                file_with_header = published_submission.file_text_with_header
-                zf.writestr(f"{student.username}.{extension}", file_with_header)
-    resp = http.HttpResponse(s.getvalue(), content_type="application/x-zip-compressed")
+    resp = http.StreamingHttpResponse(
+        stream_submissions_zip(assignment, students), content_type="application/x-zip-compressed"
+    )
     resp["Content-Disposition"] = f"attachment; filename={name}"
     return resp
 
@@ -1020,7 +1199,7 @@ def download_log_view(request, assignment_id):
     log_file_name = os.path.join(settings.MEDIA_ROOT, assignment.grader_log_filename)
 
     if (
-        request.user not in assignment.course.teacher.all() and not request.user.is_superuser
+        not assignment.course.is_teacher_in_course(request.user) and not request.user.is_superuser
     ) or not os.path.exists(log_file_name):
         raise http.Http404
 
@@ -1078,7 +1257,7 @@ def show_folder_view(request, course_id, folder_id):
         "assignments": assignments,
         "period": course.period_set.filter(students=request.user),
         "is_student": course.is_student_in_course(request.user),
-        "is_teacher": request.user in course.teacher.all(),
+        "is_teacher": course.is_teacher_in_course(request.user),
     }
     if course.is_student_in_course(request.user):
         context["unsubmitted_assignments"] = assignments.exclude(submissions__student=request.user)
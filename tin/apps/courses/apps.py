@@ -5,3 +5,6 @@ from django.apps import AppConfig
 
 class CoursesConfig(AppConfig):
     name = "tin.apps.courses"
+
+    def ready(self):
+        from . import signals  # pylint: disable=unused-import,import-outside-toplevel # noqa: F401
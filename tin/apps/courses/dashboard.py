@@ -0,0 +1,78 @@
+"""The assignments shown to a student on the course index page.
+
+Every student loads this page at the start of every class, so what it shows is
+cached per student until they submit something or one of their courses'
+assignments or enrollments changes (see :mod:`.signals`).
+
+Only the assignments themselves and which ones the student has submitted are
+cached, so which ones are due soon is still worked out on every request.
+"""
+
+from __future__ import annotations
+
+import datetime
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ..assignments.models import Assignment
+from ..submissions.models import GradebookEntry
+
+#: How far ahead assignments are shown as due soon
+DUE_SOON = datetime.timedelta(weeks=1)
+
+
+def _cache_key(student_id: int) -> str:
+    return f"student-dashboard-{student_id}"
+
+
+@dataclass
+class StudentDashboard:
+    """The (non-quiz) assignments a student can see in the courses they're enrolled in.
+
+    ``assignments`` are ordered by due date, and ``unsubmitted_ids`` are the ids of
+    those the student hasn't submitted to and still can.
+    """
+
+    assignments: list[Assignment]
+    unsubmitted_ids: frozenset[int]
+
+    def unsubmitted_assignments(self) -> list[Assignment]:
+        return [a for a in self.assignments if a.id in self.unsubmitted_ids]
+
+    def due_soon_assignments(self, now: datetime.datetime) -> list[Assignment]:
+        return [a for a in self.assignments if now <= a.due <= now + DUE_SOON]
+
+
+def build_student_dashboard(student) -> StudentDashboard:
+    """Build a student's dashboard, without using the cache."""
+    assignments = (
+        Assignment.objects.filter_visible(student)
+        .filter(course__students=student, is_quiz=False)
+        .select_related("course")
+        .order_by("due")
+    )
+    submitted_ids = GradebookEntry.objects.filter(student=student).values("assignment_id")
+    unsubmitted_ids = (
+        assignments.exclude(id__in=submitted_ids)
+        .filter(course__archived=False)
+        .filter_permissions(student, "w")
+        .values_list("id", flat=True)
+    )
+    return StudentDashboard(list(assignments), frozenset(unsubmitted_ids))
+
+
+def get_student_dashboard(student) -> StudentDashboard:
+    """Get a student's dashboard, building it if it isn't cached."""
+    key = _cache_key(student.id)
+    dashboard = cache.get(key)
+    if dashboard is None:
+        dashboard = build_student_dashboard(student)
+        cache.set(key, dashboard, settings.STUDENT_DASHBOARD_CACHE_TIMEOUT)
+    return dashboard
+
+
+def invalidate_student_dashboards(*student_ids: int) -> None:
+    """Remove the cached dashboards of some students."""
+    cache.delete_many([_cache_key(student_id) for student_id in student_ids])
@@ -0,0 +1,118 @@
+"""A gradebook of every student's score on every assignment in a course.
+
+The gradebook is built from the course's :class:`.GradebookEntry` objects with a
+fixed number of queries, then cached until a score, assignment, or enrollment in
+the course changes (see :mod:`.signals`).
+"""
+
+from __future__ import annotations
+
+from collections import defaultdict
+from collections.abc import Iterator
+from dataclasses import dataclass
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.cache import cache
+
+from ..assignments.models import Assignment
+from ..submissions.models import GradebookEntry
+from .models import Course, Period
+
+
+def _cache_key(course_id: int) -> str:
+    return f"course-gradebook-{course_id}"
+
+
+@dataclass
+class GradebookAssignment:
+    id: int
+    name: str
+    points_possible: Decimal
+
+
+@dataclass
+class GradebookStudent:
+    id: int
+    full_name: str
+    username: str
+    periods: str
+
+
+@dataclass
+class CourseGradebook:
+    """Every student's score on every assignment in a course.
+
+    ``scores[i][j]`` is the score of ``students[i]`` on ``assignments[j]``. Like
+    in an assignment's scores CSV, this is ``"M"`` if the student hasn't submitted
+    anything, ``"NG"`` if their submission hasn't been graded, and their final score
+    (including point overrides) otherwise.
+    """
+
+    assignments: list[GradebookAssignment]
+    students: list[GradebookStudent]
+    scores: list[list[Decimal | str]]
+
+    def rows(self) -> Iterator[list[object]]:
+        """The rows of the gradebook as a CSV, including a header row."""
+        yield ["Name", "Username", "Period", *(a.name for a in self.assignments)]
+        for student, scores in zip(self.students, self.scores, strict=True):
+            yield [student.full_name, student.username, student.periods, *scores]
+
+
+def build_course_gradebook(course: Course) -> CourseGradebook:
+    """Build the gradebook for a course, without using the cache.
+
+    This takes a constant number of queries, no matter how many students and
+    assignments there are.
+    """
+    assignments = [
+        GradebookAssignment(*row)
+        for row in Assignment.objects.filter(course=course)
+        .order_by("due", "name")
+        .values_list("id", "name", "points_possible")
+    ]
+
+    periods = defaultdict(list)
+    for student_id, period_name in (
+        Period.students.through.objects.filter(period__course=course)
+        .order_by("period__name")
+        .values_list("user_id", "period__name")
+    ):
+        periods[student_id].append(period_name)
+
+    students = [
+        GradebookStudent(id, full_name, username, ", ".join(periods[id]))
+        for id, full_name, username in course.students.order_by(
+            "last_name", "first_name", "username"
+        ).values_list("id", "full_name", "username")
+    ]
+
+    student_index = {student.id: i for i, student in enumerate(students)}
+    assignment_index = {assignment.id: j for j, assignment in enumerate(assignments)}
+
+    scores: list[list[Decimal | str]] = [["M"] * len(assignments) for _ in students]
+    entries = GradebookEntry.objects.filter(
+        assignment__course=course, student__courses=course
+    ).values_list("student_id", "assignment_id", "points_received", "points")
+    for student_id, assignment_id, points_received, points in entries:
+        scores[student_index[student_id]][assignment_index[assignment_id]] = (
+            points if points_received else "NG"
+        )
+
+    return CourseGradebook(assignments, students, scores)
+
+
+def get_course_gradebook(course: Course) -> CourseGradebook:
+    """Get the gradebook for a course, building it if it isn't cached."""
+    key = _cache_key(course.id)
+    gradebook = cache.get(key)
+    if gradebook is None:
+        gradebook = build_course_gradebook(course)
+        cache.set(key, gradebook, settings.COURSE_GRADEBOOK_CACHE_TIMEOUT)
+    return gradebook
+
+
+def invalidate_course_gradebook(*course_ids: int | None) -> None:
+    """Remove the cached gradebooks of some courses."""
+    cache.delete_many([_cache_key(course_id) for course_id in course_ids if course_id is not None])
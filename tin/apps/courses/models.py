@@ -5,6 +5,8 @@ from django.db import models
 from django.db.models import Q
 from django.urls import reverse
 
+from .roles import get_course_roles
+
 
 class CourseQuerySet(models.query.QuerySet):
     """Provide filtering utilities for courses."""
@@ -19,17 +21,21 @@ class CourseQuerySet(models.query.QuerySet):
         if user.is_superuser:
             return self.all()
         else:
+            roles = get_course_roles(user)
             return self.filter(
-                Q(teacher=user)
-                | (Q(students=user) & (Q(archived=False) | Q(permission="r") | Q(permission="w")))
-            ).distinct()
+                Q(id__in=roles.taught_course_ids)
+                | (
+                    Q(id__in=roles.enrolled_course_ids)
+                    & (Q(archived=False) | Q(permission="r") | Q(permission="w"))
+                )
+            )
 
     def filter_editable(self, user):
         """Filter courses a user can edit."""
         if user.is_superuser:
             return self.all()
         else:
-            return self.filter(teacher=user).distinct()
+            return self.filter(id__in=get_course_roles(user).taught_course_ids)
 
 
 class Course(models.Model):
@@ -77,12 +83,16 @@ class Course(models.Model):
 
     def is_student_in_course(self, user) -> bool:
         """Check if a student is registered in the course"""
-        return self.students.contains(user)
+        return get_course_roles(user).is_enrolled_in(self.id)
+
+    def is_teacher_in_course(self, user) -> bool:
+        """Check if a user is one of the course's teachers"""
+        return get_course_roles(user).teaches(self.id)
 
     def is_only_student_in_course(self, user) -> bool:
         """Check if a user is the only student in a course"""
         return self.is_student_in_course(user) and not (
-            user.is_superuser or user in self.teacher.all()
+            user.is_superuser or self.is_teacher_in_course(user)
         )
 
 
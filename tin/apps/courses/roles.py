@@ -0,0 +1,100 @@
+"""Which courses a user teaches and is enrolled in.
+
+Permission checks need these all over the place (in querysets like
+:meth:`.CourseQuerySet.filter_visible`, in views, and in consumers), so they are
+loaded once per user object and remembered on it. Since each request has its own
+``request.user``, this lasts for one request (or one WebSocket connection).
+
+If ``COURSE_ROLES_CACHE_TIMEOUT`` is set, they are also cached for that many
+seconds, and removed from the cache when a course's teachers or students change
+(see :mod:`.signals`).
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+
+from django.conf import settings
+from django.core.cache import cache
+
+
+def _cache_key(user_id: int) -> str:
+    return f"course-roles-{user_id}"
+
+
+@dataclass(frozen=True)
+class CourseRoles:
+    """The ids of the courses a user teaches and is enrolled in."""
+
+    taught_course_ids: frozenset[int]
+    enrolled_course_ids: frozenset[int]
+
+    def teaches(self, course_id: int) -> bool:
+        return course_id in self.taught_course_ids
+
+    def is_enrolled_in(self, course_id: int) -> bool:
+        return course_id in self.enrolled_course_ids
+
+
+NO_ROLES = CourseRoles(frozenset(), frozenset())
+
+
+def get_course_roles(user) -> CourseRoles:
+    """Get the courses a user teaches and is enrolled in.
+
+    Args:
+        user: The user (usually ``request.user``)
+    """
+    if not user.is_authenticated:
+        return NO_ROLES
+
+    roles = getattr(user, "_course_roles", None)
+    if roles is not None:
+        return roles
+
+    timeout = settings.COURSE_ROLES_CACHE_TIMEOUT
+    if timeout:
+        roles = cache.get(_cache_key(user.id))
+    if roles is None:
+        roles = CourseRoles(
+            taught_course_ids=frozenset(user.taught_courses.values_list("id", flat=True)),
+            enrolled_course_ids=frozenset(user.courses.values_list("id", flat=True)),
+        )
+        if timeout:
+            cache.set(_cache_key(user.id), roles, timeout)
+
+    user._course_roles = roles  # pylint: disable=protected-access
+    return roles
+
+
+async def aget_course_roles(user) -> CourseRoles:
+    """The asynchronous version of :func:`get_course_roles`."""
+    if not user.is_authenticated:
+        return NO_ROLES
+
+    roles = getattr(user, "_course_roles", None)
+    if roles is not None:
+        return roles
+
+    timeout = settings.COURSE_ROLES_CACHE_TIMEOUT
+    if timeout:
+        roles = await cache.aget(_cache_key(user.id))
+    if roles is None:
+        roles = CourseRoles(
+            taught_course_ids=frozenset(
+                [course_id async for course_id in user.taught_courses.values_list("id", flat=True)]
+            ),
+            enrolled_course_ids=frozenset(
+                [course_id async for course_id in user.courses.values_list("id", flat=True)]
+            ),
+        )
+        if timeout:
+            await cache.aset(_cache_key(user.id), roles, timeout)
+
+    user._course_roles = roles  # pylint: disable=protected-access
+    return roles
+
+
+def forget_course_roles(*user_ids: int) -> None:
+    """Remove the cached roles of some users."""
+    cache.delete_many([_cache_key(user_id) for user_id in user_ids])
@@ -0,0 +1,94 @@
+from __future__ import annotations
+
+from django.db import transaction
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from ..assignments.models import Assignment
+from ..submissions.models import Submission
+from .dashboard import invalidate_student_dashboards
+from .gradebook import invalidate_course_gradebook
+from .models import Course, Period
+from .roles import forget_course_roles
+
+
+def invalidate_gradebook(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    course_id = instance.course_id
+    transaction.on_commit(lambda: invalidate_course_gradebook(course_id))
+
+
+def invalidate_dashboards(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    course_id = instance.id if sender is Course else instance.course_id
+    student_ids = list(
+        Course.students.through.objects.filter(course_id=course_id).values_list(
+            "user_id", flat=True
+        )
+    )
+    transaction.on_commit(lambda: invalidate_student_dashboards(*student_ids))
+
+
+def invalidate_dashboard_on_submission(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    # Only creating or deleting a submission changes what the student has submitted
+    if kwargs.get("created", True):
+        student_id = instance.student_id
+        transaction.on_commit(lambda: invalidate_student_dashboards(student_id))
+
+
+def invalidate_gradebook_on_enrollment(sender, instance, action, reverse, pk_set, **kwargs):  # pylint: disable=unused-argument
+    if action not in {"post_add", "post_remove", "pre_clear"}:
+        return
+
+    if sender is Period.students.through:
+        if reverse:
+            periods = Period.objects.filter(pk__in=pk_set) if pk_set else instance.periods.all()
+            course_ids = list(periods.values_list("course_id", flat=True))
+        else:
+            course_ids = [instance.course_id]
+    elif reverse:
+        course_ids = list(pk_set) if pk_set else list(instance.courses.values_list("id", flat=True))
+    else:
+        course_ids = [instance.id]
+
+    transaction.on_commit(lambda: invalidate_course_gradebook(*course_ids))
+
+
+def _changed_user_ids(sender, instance, reverse, pk_set) -> list[int]:
+    if reverse:
+        return [instance.id]
+    if pk_set:
+        return list(pk_set)
+    field = "teacher" if sender is Course.teacher.through else "students"
+    return list(getattr(instance, field).values_list("id", flat=True))
+
+
+def forget_roles_on_membership_change(sender, instance, action, reverse, pk_set, **kwargs):  # pylint: disable=unused-argument
+    if action not in {"post_add", "post_remove", "pre_clear"}:
+        return
+
+    user_ids = _changed_user_ids(sender, instance, reverse, pk_set)
+    forget_course_roles(*user_ids)
+    # In case the old roles are cached again before the change is committed
+    transaction.on_commit(lambda: forget_course_roles(*user_ids))
+
+
+def invalidate_dashboards_on_enrollment(sender, instance, action, reverse, pk_set, **kwargs):  # pylint: disable=unused-argument
+    if action not in {"post_add", "post_remove", "pre_clear"}:
+        return
+
+    student_ids = _changed_user_ids(sender, instance, reverse, pk_set)
+    transaction.on_commit(lambda: invalidate_student_dashboards(*student_ids))
+
+
+post_save.connect(invalidate_gradebook, sender=Assignment)
+post_delete.connect(invalidate_gradebook, sender=Assignment)
+post_save.connect(invalidate_gradebook, sender=Period)
+post_delete.connect(invalidate_gradebook, sender=Period)
+post_save.connect(invalidate_dashboards, sender=Assignment)
+post_delete.connect(invalidate_dashboards, sender=Assignment)
+post_save.connect(invalidate_dashboards, sender=Course)
+post_save.connect(invalidate_dashboard_on_submission, sender=Submission)
+post_delete.connect(invalidate_dashboard_on_submission, sender=Submission)
+m2m_changed.connect(invalidate_gradebook_on_enrollment, sender=Course.students.through)
+m2m_changed.connect(invalidate_gradebook_on_enrollment, sender=Period.students.through)
+m2m_changed.connect(forget_roles_on_membership_change, sender=Course.teacher.through)
+m2m_changed.connect(forget_roles_on_membership_change, sender=Course.students.through)
+m2m_changed.connect(invalidate_dashboards_on_enrollment, sender=Course.students.through)
@@ -1,11 +1,20 @@
 from __future__ import annotations
 
+import csv
+import datetime
+import io
+
 import pytest
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
+from django.utils import timezone
 
 from tin.tests import is_login_redirect, is_redirect, login
 
+from .gradebook import get_course_gradebook
 from .models import Course
+from .roles import get_course_roles
 
 
 @login("teacher")
@@ -120,3 +129,100 @@ def test_teacher_access_hidden_archived_course(
 
     response = client.get(reverse("assignments:submit", args=[assignment.id]))
     assert response.status_code == 200
+
+
+def test_course_gradebook(
+    course, assignment, student, submission, django_capture_on_commit_callbacks
+) -> None:
+    other_assignment = course.assignments.create(
+        name="Write a Fragment Shader",
+        points_possible=100,
+        due=assignment.due + datetime.timedelta(days=1),
+    )
+    period = course.period_set.create(name="Period 1")
+    period.students.add(student)
+
+    submission.points_received = 150
+    submission.has_been_graded = True
+    submission.save()
+
+    gradebook = get_course_gradebook(course)
+    assert [a.name for a in gradebook.assignments] == [assignment.name, other_assignment.name]
+    assert [(s.username, s.periods) for s in gradebook.students] == [(student.username, "Period 1")]
+    assert gradebook.scores == [[150, "M"]]
+
+    # Cached until a score changes
+    with CaptureQueriesContext(connection) as queries:
+        assert get_course_gradebook(course) == gradebook
+    assert not queries
+
+    with django_capture_on_commit_callbacks(execute=True):
+        other_assignment.submissions.create(student=student)
+    assert get_course_gradebook(course).scores == [[150, "NG"]]
+
+
+@login("teacher")
+def test_course_gradebook_csv(client, course, student, submission) -> None:
+    response = client.get(reverse("courses:gradebook_csv", args=[course.id]))
+    rows = list(csv.reader(io.StringIO(b"".join(response.streaming_content).decode())))
+    assert rows == [
+        ["Name", "Username", "Period", submission.assignment.name],
+        [student.full_name, student.username, "", "NG"],
+    ]
+
+    response = client.get(reverse("courses:gradebook", args=[course.id]))
+    assert response.status_code == 200
+
+
+def test_course_roles(django_user_model, course, teacher, student) -> None:
+    # loaded once per user object
+    with CaptureQueriesContext(connection) as queries:
+        assert get_course_roles(student).is_enrolled_in(course.id)
+        assert course.is_student_in_course(student)
+        assert not course.is_teacher_in_course(student)
+        assert list(Course.objects.filter_visible(student)) == [course]
+    assert len(queries) == 3
+
+    assert course.is_teacher_in_course(teacher)
+    assert list(Course.objects.filter_editable(teacher)) == [course]
+    assert not Course.objects.filter_editable(student).exists()
+
+    # cached roles are forgotten when they change
+    course.students.remove(student)
+    student = django_user_model.objects.get(id=student.id)
+    assert not course.is_student_in_course(student)
+    assert not Course.objects.filter_visible(student).exists()
+
+
+@login("student")
+def test_student_dashboard(
+    client, django_capture_on_commit_callbacks, course, assignment, student
+) -> None:
+    assignment.due = timezone.now() + datetime.timedelta(days=2)
+    assignment.save()
+
+    def get_dashboard():
+        response = client.get(reverse("courses:index"))
+        assert response.status_code == 200
+        return (
+            list(response.context["unsubmitted_assignments"]),
+            list(response.context["due_soon_assignments"]),
+        )
+
+    assert get_dashboard() == ([assignment], [assignment])
+
+    # the dashboard is cached
+    with CaptureQueriesContext(connection) as queries:
+        get_dashboard()
+    assert not any("assignments_assignment" in query["sql"] for query in queries)
+
+    # and invalidated when the student submits
+    with django_capture_on_commit_callbacks(execute=True):
+        assignment.submissions.create(student=student)
+    assert get_dashboard() == ([], [assignment])
+
+    # or when an assignment is hidden
+    with django_capture_on_commit_callbacks(execute=True):
+        assignment.hidden = True
+        assignment.save()
+    assert get_dashboard() == ([], [])
@@ -1,12 +1,15 @@
 from __future__ import annotations
 
-from datetime import date, timedelta
+from datetime import date
 
+from django import http
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
 
 from ..assignments.models import Assignment
 from ..auth.decorators import login_required, teacher_or_superuser_required
+from ..streaming import stream_csv
+from .dashboard import get_student_dashboard
 from .forms import (
     CourseForm,
     ImportFromSelectedCourseForm,
@@ -14,6 +17,7 @@ from .forms import (
     SelectCourseToImportFromForm,
     StudentForm,
 )
+from .gradebook import get_course_gradebook
 from .models import Course, Period, StudentImport
 
 
@@ -32,25 +36,13 @@ def index_view(request):
     context = {"courses": courses, "archived_courses": archived_courses}
 
     if request.user.is_student:
-        assignments = (
-            Assignment.objects.filter_visible(request.user)
-            .filter(course__students=request.user, is_quiz=False)
-            .order_by("due")
-        )
-
-        unsubmitted_assignments = (
-            assignments.exclude(submissions__student=request.user)
-            .filter(course__archived=False)
-            .filter_permissions(request.user, "w")
-        )
+        dashboard = get_student_dashboard(request.user)
+        unsubmitted_assignments = dashboard.unsubmitted_assignments()
         context["unsubmitted_assignments"] = unsubmitted_assignments
         context["courses_with_unsubmitted_assignments"] = {
             assignment.course for assignment in unsubmitted_assignments
         }
-
-        now = timezone.now()
-        due_soon_assignments = assignments.filter(due__gte=now, due__lte=now + timedelta(weeks=1))
-        context["due_soon_assignments"] = due_soon_assignments
+        context["due_soon_assignments"] = dashboard.due_soon_assignments(timezone.now())
 
     return render(request, "courses/home.html", context)
 
@@ -65,7 +57,7 @@ def show_view(request, course_id):
     """
     course = get_object_or_404(Course.objects.filter_visible(request.user), id=course_id)
 
-    is_teacher = request.user in course.teacher.all()
+    is_teacher = course.is_teacher_in_course(request.user)
     if request.user.is_superuser or is_teacher:
         folders = course.folders.order_by("name")
     else:
@@ -304,6 +296,45 @@ def students_view(request, course_id):
         )
 
 
+@teacher_or_superuser_required
+def gradebook_view(request, course_id):
+    """View every student's score on every assignment in a course
+
+    Args:
+        request: The HTTP request
+        course_id: The primary key of an instance of :class:`.Course`
+    """
+    course = get_object_or_404(Course.objects.filter_editable(request.user), id=course_id)
+    gradebook = get_course_gradebook(course)
+
+    return render(
+        request,
+        "courses/gradebook.html",
+        {
+            "nav_item": "Gradebook",
+            "course": course,
+            "assignments": gradebook.assignments,
+            "rows": list(zip(gradebook.students, gradebook.scores, strict=True)),
+        },
+    )
+
+
+@teacher_or_superuser_required
+def gradebook_csv_view(request, course_id):
+    """Download a ``.csv`` of every student's score on every assignment in a course
+
+    Args:
+        request: The HTTP request
+        course_id: The primary key of an instance of :class:`.Course`
+    """
+    course = get_object_or_404(Course.objects.filter_editable(request.user), id=course_id)
+    gradebook = get_course_gradebook(course)
+
+    response = http.StreamingHttpResponse(stream_csv(gradebook.rows()), content_type="text/csv")
+    response["Content-Disposition"] = f"attachment; filename=course_{course.id}_gradebook.csv"
+    return response
+
+
 @teacher_or_superuser_required
 def import_students_view(request, course_id):
     """Add students to a course
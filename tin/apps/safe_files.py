@@ -0,0 +1,129 @@
+"""Symlink-safe file operations inside directories that graders can write to.
+
+Graders and submissions can write to the directories their files are stored in,
+so they can replace any file or directory in them with a symbolic link. Naively
+writing to a path in one of those directories could then overwrite a file
+anywhere Tin can write to.
+
+The functions here walk the path one component at a time, opening each directory
+relative to the previous one with ``O_NOFOLLOW``. Files are written to a temporary
+file that is then renamed over the target, so symbolic links and hard links at
+the target are replaced instead of followed.
+
+.. code-block:: pycon
+
+    >>> import tempfile
+    >>> root = tempfile.mkdtemp()
+    >>> safe_write_file(root, "assignment-1/grader.py", "print('Score: 100%')")
+    >>> os.symlink("/etc", os.path.join(root, "assignment-1", "evil"))
+    >>> safe_write_file(root, "assignment-1/evil/passwd", "oops")
+    Traceback (most recent call last):
+    ...
+    NotADirectoryError: [Errno 20] Not a directory: 'evil'
+"""
+
+from __future__ import annotations
+
+import contextlib
+import os
+import secrets
+from collections.abc import Iterator
+
+_DIR_FLAGS = os.O_RDONLY | os.O_DIRECTORY | os.O_NOFOLLOW | os.O_CLOEXEC
+_TEMP_FILE_FLAGS = os.O_WRONLY | os.O_CREAT | os.O_EXCL | os.O_NOFOLLOW | os.O_CLOEXEC
+
+
+def _split_path(root: str, path: str) -> list[str]:
+    """Split ``path`` into its components relative to ``root``.
+
+    ``path`` may be relative to ``root``, or absolute.
+
+    Raises:
+        ValueError: If ``path`` is not inside ``root``.
+    """
+    rel_path = os.path.relpath(os.path.join(root, path), root)
+    if rel_path == os.curdir:
+        return []
+
+    parts = rel_path.split(os.sep)
+    if os.pardir in parts:
+        raise ValueError(f"{path!r} is not inside {root!r}")
+    return parts
+
+
+@contextlib.contextmanager
+def _open_dir(root: str, parts: list[str], *, create: bool, mode: int) -> Iterator[int]:
+    # The root itself is trusted, so it may be a symbolic link
+    fd = os.open(root, os.O_RDONLY | os.O_DIRECTORY | os.O_CLOEXEC)
+    try:
+        for part in parts:
+            if create:
+                with contextlib.suppress(FileExistsError):
+                    os.mkdir(part, mode, dir_fd=fd)
+
+            new_fd = os.open(part, _DIR_FLAGS, dir_fd=fd)
+            os.close(fd)
+            fd = new_fd
+
+        yield fd
+    finally:
+        os.close(fd)
+
+
+def safe_write_file(root: str, path: str, data: str | bytes, *, mode: int = 0o644) -> None:
+    """Atomically replace the contents of a file without following symbolic links.
+
+    Any missing parent directories are created.
+
+    Args:
+        root: A trusted directory that ``path`` is inside.
+        path: The file to write, either relative to ``root`` or absolute.
+        data: The contents of the file. Text is encoded as UTF-8.
+        mode: The mode of the file.
+
+    Raises:
+        ValueError: If ``path`` is not inside ``root``.
+        OSError: If a parent of ``path`` is a symbolic link or not a directory.
+    """
+    parts = _split_path(root, path)
+    if not parts:
+        raise ValueError(f"{path!r} is not a file inside {root!r}")
+    *dirs, name = parts
+
+    if isinstance(data, str):
+        data = data.encode("utf-8")
+
+    with _open_dir(root, dirs, create=True, mode=0o755) as dir_fd:
+        temp_name = f".{name}.{secrets.token_hex(8)}.tmp"
+        fd = os.open(temp_name, _TEMP_FILE_FLAGS, mode, dir_fd=dir_fd)
+        try:
+            with os.fdopen(fd, "wb") as f_obj:
+                os.fchmod(f_obj.fileno(), mode)
+                f_obj.write(data)
+            os.rename(temp_name, name, src_dir_fd=dir_fd, dst_dir_fd=dir_fd)
+        except BaseException:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(temp_name, dir_fd=dir_fd)
+            raise
+
+
+def safe_remove_file(root: str, path: str) -> None:
+    """Remove a file (if it exists) without following symbolic links in its parents.
+
+    Args:
+        root: A trusted directory that ``path`` is inside.
+        path: The file to remove, either relative to ``root`` or absolute.
+
+    Raises:
+        ValueError: If ``path`` is not inside ``root``.
+    """
+    parts = _split_path(root, path)
+    if not parts:
+        raise ValueError(f"{path!r} is not a file inside {root!r}")
+    *dirs, name = parts
+
+    try:
+        with _open_dir(root, dirs, create=False, mode=0o755) as dir_fd:
+            os.unlink(name, dir_fd=dir_fd)
+    except (FileNotFoundError, NotADirectoryError):
+        pass
@@ -0,0 +1,26 @@
+"""Helpers for streaming large downloads with :class:`~django.http.StreamingHttpResponse`."""
+
+from __future__ import annotations
+
+import csv
+from collections.abc import Iterable, Iterator
+
+
+class Echo:
+    """A file-like object that returns what is written to it instead of storing it."""
+
+    def write(self, value):
+        return value
+
+
+def stream_csv(rows: Iterable[Iterable[object]]) -> Iterator[str]:
+    r"""Format rows as CSV, one line at a time.
+
+    .. code-block:: pycon
+
+        >>> list(stream_csv([["Name", "Score"], ["Jane Doe", 100]]))
+        ['Name,Score\r\n', 'Jane Doe,100\r\n']
+    """
+    writer = csv.writer(Echo())
+    for row in rows:
+        yield writer.writerow(row)
@@ -2,7 +2,7 @@ from __future__ import annotations
 
 from django.contrib import admin
 
-from .models import Comment, Submission
+from .models import Comment, GradebookEntry, Submission
 
 # Register your models here.
 
@@ -25,6 +25,7 @@ class SubmissionAdmin(admin.ModelAdmin):
     save_as = True
     search_fields = ("assignment__name", "student__username")
     autocomplete_fields = ("assignment", "student")
+    readonly_fields = ("blob",)
 
     @admin.display(description="Assignment")
     def assignment_name(self, obj):
@@ -57,3 +58,19 @@ class CommentAdmin(admin.ModelAdmin):
     @admin.display(description="Author")
     def author(self, obj):
         return obj.author.username
+
+
+@admin.register(GradebookEntry)
+class GradebookEntryAdmin(admin.ModelAdmin):
+    list_display = (
+        "assignment",
+        "student",
+        "points",
+        "has_been_graded",
+        "complete",
+        "last_updated",
+    )
+    list_filter = ("assignment__course",)
+    search_fields = ("assignment__name", "student__username")
+    readonly_fields = ("latest_submission", "published_submission")
+    autocomplete_fields = ("assignment", "student")
@@ -5,3 +5,6 @@ from django.apps import AppConfig
 
 class SubmissionsConfig(AppConfig):
     name = "tin.apps.submissions"
+
+    def ready(self):
+        from . import signals  # pylint: disable=unused-import,import-outside-toplevel # noqa: F401
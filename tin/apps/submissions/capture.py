@@ -0,0 +1,116 @@
+"""Bounded capture of grader output.
+
+Graders can print an arbitrary amount of output, but only the end of it is ever
+stored in the database. :class:`OutputCapture` keeps memory usage flat by only
+holding on to a fixed-size tail of the stream, while optionally spilling the
+full stream to a compressed file on disk.
+"""
+
+from __future__ import annotations
+
+import codecs
+import gzip
+import os
+from collections import deque
+
+
+class OutputCapture:
+    """Capture a stream of bytes, keeping the last ``max_chars`` characters.
+
+    Bytes are decoded incrementally, so multibyte UTF-8 characters that are split
+    across reads are decoded correctly. Null bytes are dropped, since they can't be
+    stored in the database.
+
+    .. code-block:: pycon
+
+        >>> capture = OutputCapture(max_chars=10)
+        >>> capture.feed("héllo".encode()[:2])
+        >>> capture.feed("héllo".encode()[2:] + b" world")
+        >>> capture.tail
+        'éllo world'
+        >>> capture.truncated_text(8)
+        '...rld'
+
+    Args:
+        max_chars: The number of characters at the end of the stream to keep.
+        spill_path: If given, the full, undecoded stream is written to this path,
+            compressed with gzip.
+    """
+
+    def __init__(self, max_chars: int, spill_path: str | None = None):
+        self.max_chars = max_chars
+        self.total_chars = 0
+
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._chunks: deque[str] = deque()
+        self._length = 0
+
+        self.spill_path = spill_path
+        self._spill_file = None
+        if spill_path is not None:
+            os.makedirs(os.path.dirname(spill_path), mode=0o755, exist_ok=True)
+            self._spill_file = gzip.open(spill_path, "wb")
+
+    def feed(self, data: bytes) -> None:
+        """Add some bytes read from the stream."""
+        if self._spill_file is not None:
+            self._spill_file.write(data)
+        self._append(self._decoder.decode(data))
+
+    def write(self, text: str) -> None:
+        """Append text that did not come from the stream (e.g. ``[Grader killed]``)."""
+        self._append(self._decoder.decode(b"", final=True) + text)
+        if self._spill_file is not None:
+            self._spill_file.write(text.encode())
+
+    def close(self) -> None:
+        """Flush any partially decoded characters and close the spill file."""
+        self._append(self._decoder.decode(b"", final=True))
+        if self._spill_file is not None:
+            self._spill_file.close()
+            self._spill_file = None
+
+    def __enter__(self) -> OutputCapture:
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    @property
+    def tail(self) -> str:
+        """The last ``max_chars`` (or fewer) characters of the stream."""
+        text = "".join(self._chunks)
+        return text[-self.max_chars :] if len(text) > self.max_chars else text
+
+    @property
+    def truncated(self) -> bool:
+        """Whether characters have been dropped from the start of the stream."""
+        return self.total_chars > self.max_chars
+
+    def truncated_text(self, max_len: int) -> str:
+        """The captured text, truncated to fit in ``max_len`` characters.
+
+        If the stream is longer than ``max_len``, the start of the output is replaced
+        with ``...``.
+        """
+        if self.total_chars <= max_len:
+            return self.tail
+        return "..." + self.tail[-max_len + 5 :]
+
+    def endswith(self, suffix: str) -> bool:
+        return self.tail.endswith(suffix)
+
+    def __bool__(self) -> bool:
+        return self.total_chars > 0
+
+    def _append(self, text: str) -> None:
+        text = text.replace("\0", "")
+        if not text:
+            return
+
+        self.total_chars += len(text)
+        self._chunks.append(text)
+        self._length += len(text)
+
+        while self._length - len(self._chunks[0]) >= self.max_chars:
+            self._length -= len(self._chunks.popleft())
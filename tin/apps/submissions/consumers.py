@@ -1,70 +1,393 @@
 from __future__ import annotations
 
+import asyncio
 from typing import Any
 
-from asgiref.sync import async_to_sync
-from channels.generic.websocket import JsonWebsocketConsumer
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncJsonWebsocketConsumer
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models import Q
 
-from .models import Submission
-from .utils import serialize_submission_info
+from ..assignments.models import Assignment
+from ..courses.models import Period
+from ..courses.roles import aget_course_roles, get_course_roles
+from .models import Submission, assignment_channel_group_name
+from .utils import filter_submission_info, get_appended_output, serialize_submission_info
 
+#: The fields of a submission's info that only have output appended while it runs
+OUTPUT_FIELDS = ("grader_output", "grader_errors")
+
+
+@database_sync_to_async
+def _get_submission_info(submission_id: int, user) -> dict | None:
+    submission = Submission.objects.select_related("assignment").filter(id=submission_id).first()
+    if submission is None:
+        return None
+    return serialize_submission_info(submission, user)
+
+
+class SubmissionJsonConsumer(AsyncJsonWebsocketConsumer):
+    """Sends updates about a submission to a browser watching it.
+
+    Updates sent to the submission's group (see :meth:`.Submission.send_update`)
+    carry the submission's info, so they're passed on without touching the database.
+    """
 
-class SubmissionJsonConsumer(JsonWebsocketConsumer):
     def __init__(self, *args: Any, **kwargs: Any):
         super().__init__(*args, **kwargs)
         self.submission = None
         self.user = None
         self.connected = False
 
-    def connect(self) -> None:
+    async def connect(self) -> None:
         self.user = self.scope["user"]
         if not self.user.is_authenticated:
-            self.close()
+            await self.close()
             return
 
         submission_id = self.scope["url_route"]["kwargs"]["submission_id"]
 
         try:
-            self.submission = Submission.objects.get(id=submission_id)
+            self.submission = await Submission.objects.select_related("assignment").aget(
+                id=submission_id
+            )
         except Submission.DoesNotExist:
-            self.close()
+            await self.close()
             return
 
+        roles = await aget_course_roles(self.user)
         if (
-            self.submission.assignment.course not in self.user.courses.all()
-            and self.user not in self.submission.assignment.course.teacher.all()
+            not roles.is_enrolled_in(self.submission.assignment.course_id)
+            and not roles.teaches(self.submission.assignment.course_id)
             and not self.user.is_superuser
         ):
-            self.close()
+            await self.close()
             return
 
         self.connected = True
-        self.accept()
+        await self.accept()
 
-        async_to_sync(self.channel_layer.group_add)(
-            self.submission.channel_group_name, self.channel_name
-        )
+        await self.channel_layer.group_add(self.submission.channel_group_name, self.channel_name)
 
-        self.send_submission_info()
+        await self.send_submission_info()
 
-    def disconnect(self, code: int) -> None:
+    async def disconnect(self, code: int) -> None:
+        if self.connected:
+            await self.channel_layer.group_discard(
+                self.submission.channel_group_name, self.channel_name
+            )
         self.submission = None
         self.user = None
         self.connected = False
 
-    def receive_json(self, content: Any, **kwargs: Any) -> None:
+    async def receive_json(self, content: Any, **kwargs: Any) -> None:
         if self.connected:
             if not isinstance(content, dict):
                 return
 
             msg_type = content.get("type")
             if msg_type == "request-info":
-                self.send_submission_info()
+                await self.send_submission_info()
 
-    def submission_updated(self, _event) -> None:
-        self.send_submission_info()
+    async def submission_updated(self, event) -> None:
+        if not self.connected:
+            return
 
-    def send_submission_info(self):
+        info = event.get("info")
+        if info is None:
+            # Sent by something that didn't include the submission's info
+            await self.send_submission_info()
+        else:
+            await self.send_json(filter_submission_info(info, self.user))
+
+    async def send_submission_info(self) -> None:
         if self.connected:
-            self.submission.refresh_from_db()
-            self.send_json(serialize_submission_info(self.submission, self.user))
+            info = await _get_submission_info(self.submission.id, self.user)
+            if info is not None:
+                await self.send_json(info)
+
+
+@database_sync_to_async
+def _get_watchable_submissions(user, submission_ids) -> dict[int, tuple[int, str, dict]]:
+    """Get the submissions a user may watch in a :class:`SubmissionFeedConsumer`.
+
+    Teachers can watch their courses' submissions, and students their own.
+
+    Returns:
+        A dictionary mapping each submission's id to its assignment's id, its
+        channel layer group, and its info.
+    """
+    submissions = Submission.objects.filter(id__in=submission_ids).select_related("assignment")
+    if not user.is_superuser:
+        submissions = submissions.filter(
+            Q(assignment__course_id__in=get_course_roles(user).taught_course_ids) | Q(student=user)
+        )
+    return {
+        submission.id: (
+            submission.assignment_id,
+            submission.channel_group_name,
+            serialize_submission_info(submission, user),
+        )
+        for submission in submissions
+    }
+
+
+def _is_id(value: Any) -> bool:
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class SubmissionFeedConsumer(AsyncJsonWebsocketConsumer):
+    """Sends batched updates about many submissions over a single connection.
+
+    Pages with many running submissions (like an assignment's roster) use this
+    instead of one :class:`SubmissionJsonConsumer` per submission. Browsers send
+    ``subscribe`` messages like::
+
+        {"type": "subscribe", "submissions": [1, 2, 3]}
+        {"type": "subscribe", "assignment": 4, "period": 5}
+
+    Subscribing to submissions sends their current info right away. Teachers can
+    also subscribe to all of an assignment's submissions (optionally only those of
+    the students in one period), which only joins the assignment's channel layer
+    group instead of one group per submission.
+
+    Updates are collected for ``SUBMISSION_FEED_BATCH_INTERVAL`` seconds and sent
+    together, with only the fields that changed since each submission was last sent::
+
+        {"type": "updates", "submissions": {"1": {"grader_output": "..."}, ...}}
+
+    While a submission runs, its grader output and errors usually only have text
+    appended to them, so only the new text is sent, along with where it starts and
+    ends in the stream::
+
+        {"grader_output_append": {"from": 120, "to": 145, "text": "..."}}
+
+    When that isn't possible (e.g. the browser's copy ends before the part of the
+    stream that was kept), the full output is sent instead along with where it
+    ends (as ``grader_output_end``), and the browser replaces its copy.
+
+    Subscriptions to individual submissions end once they complete.
+    """
+
+    def __init__(self, *args: Any, **kwargs: Any):
+        super().__init__(*args, **kwargs)
+        self.user = None
+        self.connected = False
+        self.joined_groups: set[str] = set()
+
+        #: The submissions subscribed to individually, and their channel layer groups
+        self.submissions: dict[int, str] = {}
+        #: The assignments subscribed to, and the ids of the students whose
+        #: submissions to send (or ``None`` for everyone)
+        self.assignments: dict[int, frozenset[int] | None] = {}
+
+        #: The info (and stream ends) of the submissions with updates to send
+        self.pending: dict[int, tuple[dict, dict[str, int]]] = {}
+        #: The info last sent about each submission
+        self.sent: dict[int, dict] = {}
+        #: Where the output last sent about each submission ends in its stream,
+        #: and how much of it the browser has
+        self.output_positions: dict[tuple[int, str], tuple[int, int]] = {}
+        self.flush_task: asyncio.Task | None = None
+
+    async def connect(self) -> None:
+        self.user = self.scope["user"]
+        if not self.user.is_authenticated:
+            await self.close()
+            return
+
+        await aget_course_roles(self.user)
+        self.connected = True
+        await self.accept()
+
+    async def disconnect(self, code: int) -> None:
+        if self.flush_task is not None:
+            self.flush_task.cancel()
+            self.flush_task = None
+        for group in self.joined_groups:
+            await self.channel_layer.group_discard(group, self.channel_name)
+        self.joined_groups.clear()
+        self.connected = False
+
+    async def receive_json(self, content: Any, **kwargs: Any) -> None:
+        if not self.connected or not isinstance(content, dict):
+            return
+
+        if content.get("type") == "subscribe":
+            await self.subscribe(content)
+
+    async def send_error(self, message: str) -> None:
+        await self.send_json({"type": "error", "message": message})
+
+    async def _join(self, group: str) -> None:
+        if group not in self.joined_groups:
+            self.joined_groups.add(group)
+            await self.channel_layer.group_add(group, self.channel_name)
+
+    async def _leave(self, group: str) -> None:
+        if group in self.joined_groups:
+            self.joined_groups.discard(group)
+            await self.channel_layer.group_discard(group, self.channel_name)
+
+    async def subscribe(self, content: dict) -> None:
+        submission_ids = content.get("submissions", [])
+        assignment_id = content.get("assignment")
+        period_id = content.get("period")
+        if (
+            not isinstance(submission_ids, list)
+            or not all(_is_id(submission_id) for submission_id in submission_ids)
+            or (assignment_id is not None and not _is_id(assignment_id))
+            or (period_id is not None and not _is_id(period_id))
+        ):
+            await self.send_error("Invalid subscription")
+            return
+
+        if (
+            len(self.submissions.keys() | set(submission_ids))
+            > settings.SUBMISSION_FEED_MAX_SUBMISSIONS
+        ):
+            await self.send_error("Too many submissions")
+            return
+
+        if assignment_id is not None:
+            if (
+                not await Assignment.objects.filter_editable(self.user)
+                .filter(id=assignment_id)
+                .aexists()
+            ):
+                await self.send_error("Assignment not found")
+                return
+
+            student_ids = None
+            if period_id is not None:
+                if not await Period.objects.filter(
+                    id=period_id, course__assignments=assignment_id
+                ).aexists():
+                    await self.send_error("Period not found")
+                    return
+                student_ids = frozenset(
+                    [
+                        student_id
+                        async for student_id in get_user_model()
+                        .objects.filter(periods=period_id)
+                        .values_list("id", flat=True)
+                    ]
+                )
+
+            self.assignments[assignment_id] = student_ids
+            await self._join(assignment_channel_group_name(assignment_id))
+
+        if submission_ids:
+            watchable = await _get_watchable_submissions(self.user, submission_ids)
+            for submission_id, (submission_assignment_id, group, info) in watchable.items():
+                self.submissions[submission_id] = group
+                if submission_assignment_id not in self.assignments:
+                    await self._join(group)
+                await self.queue_update(submission_id, info)
+            # Send their current info now
+            await self.flush()
+
+    def is_watching(self, event: dict) -> bool:
+        if event["submission_id"] in self.submissions:
+            return True
+        if event["assignment_id"] not in self.assignments:
+            return False
+        student_ids = self.assignments[event["assignment_id"]]
+        return student_ids is None or event["student_id"] in student_ids
+
+    async def submission_updated(self, event) -> None:
+        if not self.connected or "submission_id" not in event:
+            return
+        if not self.is_watching(event):
+            return
+
+        info = event.get("info")
+        if info is None:
+            # Sent by something that didn't include the submission's info
+            watchable = await _get_watchable_submissions(self.user, [event["submission_id"]])
+            if event["submission_id"] not in watchable:
+                return
+            info = watchable[event["submission_id"]][2]
+        else:
+            info = filter_submission_info(info, self.user)
+        await self.queue_update(event["submission_id"], info, event.get("stream_ends", {}))
+
+    async def queue_update(
+        self, submission_id: int, info: dict, stream_ends: dict[str, int] | None = None
+    ) -> None:
+        self.pending[submission_id] = (info, stream_ends or {})
+        if info["complete"] and submission_id in self.submissions:
+            await self._leave(self.submissions.pop(submission_id))
+
+        if self.flush_task is None:
+            self.flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(settings.SUBMISSION_FEED_BATCH_INTERVAL)
+        self.flush_task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        """Send the pending updates."""
+        updates = {}
+        for submission_id, (info, stream_ends) in self.pending.items():
+            sent = self.sent.get(submission_id)
+            if sent is None:
+                changes = dict(info)
+            else:
+                changes = {
+                    key: value
+                    for key, value in info.items()
+                    if key not in sent or sent[key] != value
+                }
+            for field_name in OUTPUT_FIELDS:
+                if field_name in changes:
+                    self._replace_with_appended_output(
+                        submission_id, changes, field_name, stream_ends.get(field_name)
+                    )
+
+            if changes:
+                updates[str(submission_id)] = changes
+            if info["complete"]:
+                self.sent.pop(submission_id, None)
+                for field_name in OUTPUT_FIELDS:
+                    self.output_positions.pop((submission_id, field_name), None)
+            else:
+                self.sent[submission_id] = info
+        self.pending.clear()
+
+        if updates:
+            await self.send_json({"type": "updates", "submissions": updates})
+
+    def _replace_with_appended_output(
+        self, submission_id: int, changes: dict, field_name: str, end: int | None
+    ) -> None:
+        """Send only the output added since the last update, if possible.
+
+        Otherwise, the full output is sent along with where it ends, so the browser
+        can resync.
+        """
+        text = changes[field_name]
+        position = self.output_positions.get((submission_id, field_name))
+        appended = None
+        if position is not None:
+            previous_end, browser_length = position
+            appended = get_appended_output(text, end, previous_end)
+            # Resync once in a while so the browser doesn't keep all the output
+            max_length = 2 * Submission._meta.get_field(field_name).max_length
+            if appended is not None and browser_length + len(appended) > max_length:
+                appended = None
+
+        if appended is not None:
+            del changes[field_name]
+            changes[f"{field_name}_append"] = {"from": previous_end, "to": end, "text": appended}
+            browser_length += len(appended)
+        else:
+            changes[f"{field_name}_end"] = end
+            browser_length = len(text)
+
+        if end is None:
+            self.output_positions.pop((submission_id, field_name), None)
+        else:
+            self.output_positions[submission_id, field_name] = (end, browser_length)
@@ -1,13 +1,13 @@
 from __future__ import annotations
 
 from django import forms
-from django.db.models import Q
+from django.db.models import Exists, OuterRef, Q
 
 from ..assignments.models import Assignment, Folder
 from ..courses.models import Course, Period
 from ..users.forms import UserMultipleChoiceField
 from ..users.models import User
-from .models import Comment, Submission
+from .models import Comment, GradebookEntry, Submission
 
 
 class CustomModelMultipleChoiceField(forms.ModelMultipleChoiceField):
@@ -147,23 +147,25 @@ class FilterForm(forms.Form):
             )
 
         order_bys = [self.cleaned_data[f"order_by_{i}"] for i in range(1, 6)]
-        order_bys = filter(None, order_bys)  # Remove empty selections
-        if order_bys:
-            queryset = queryset.order_by(*order_bys)
+        order_bys = [order_by for order_by in order_bys if order_by]  # Remove empty selections
+        # Ordering by the primary key last keeps the order stable for pagination
+        queryset = queryset.order_by(*order_bys, "pk")
+
+        # These use the gradebook, which keeps track of each student's latest and
+        # latest published submission to each assignment
+        is_latest = Exists(GradebookEntry.objects.filter(latest_submission=OuterRef("pk")))
+        is_latest_publish = Exists(
+            GradebookEntry.objects.filter(published_submission=OuterRef("pk"))
+        )
 
-        # This is done last to minimize queryset evaluation
-        # However, slicing must be done last (see limit below)
         if self.cleaned_data["is_latest_publish"]:
-            latest_publish_ids = [s.pk for s in queryset if (s.is_latest_publish or s.is_latest)]
-            queryset = queryset.filter(pk__in=latest_publish_ids)
+            queryset = queryset.filter(is_latest_publish | is_latest)
 
         if self.cleaned_data["is_latest"]:
-            latest_ids = [s.pk for s in queryset if s.is_latest]
-            queryset = queryset.filter(pk__in=latest_ids)
+            queryset = queryset.filter(is_latest)
 
         if self.cleaned_data["is_published"]:
-            published_ids = [s.pk for s in queryset if s.is_latest_publish]
-            queryset = queryset.filter(pk__in=published_ids)
+            queryset = queryset.filter(is_latest_publish)
 
         if self.cleaned_data["limit"]:
             queryset = queryset[: self.cleaned_data["limit"]]
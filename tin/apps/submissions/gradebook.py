@@ -0,0 +1,250 @@
+"""Maintain and query the gradebook (see :class:`.GradebookEntry`).
+
+A student's entry for an assignment is recomputed from their submissions whenever
+something that affects it changes (see :mod:`.signals`), in the same transaction
+as the change.
+
+Changes also invalidate the cached course-wide gradebook (see
+:mod:`tin.apps.courses.gradebook`) once they are committed.
+
+If the gradebook ever gets out of sync, ``python manage.py rebuild_gradebook``
+recomputes it from scratch.
+"""
+
+from __future__ import annotations
+
+import itertools
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, FilteredRelation, OuterRef, Q, Subquery, Sum
+from django.db.models.functions import Coalesce
+
+from ..assignments.models import Assignment
+from ..courses.gradebook import invalidate_course_gradebook
+from ..courses.models import Course
+from .models import Comment, GradebookEntry, PublishedSubmission, Submission
+
+#: Submission fields that affect gradebook entries
+GRADEBOOK_FIELDS = frozenset({"date_submitted", "points_received", "has_been_graded", "complete"})
+
+#: How many entries to recompute at once when rebuilding the gradebook
+REBUILD_CHUNK_SIZE = 1000
+
+
+def _entry_fields(latest_submission_id, published_submission_id, graded_submission, point_override):
+    points_received = graded_submission.points_received
+    return {
+        "latest_submission_id": latest_submission_id,
+        "published_submission_id": published_submission_id,
+        "points_received": points_received,
+        "points": (
+            points_received + (point_override or Decimal(0))
+            if points_received is not None
+            else None
+        ),
+        "has_been_graded": graded_submission.has_been_graded,
+        "complete": graded_submission.complete,
+    }
+
+
+def _invalidate_course_gradebook(assignment_id: int) -> None:
+    def invalidate():
+        course_id = (
+            Assignment.objects.filter(id=assignment_id).values_list("course_id", flat=True).first()
+        )
+        invalidate_course_gradebook(course_id)
+
+    transaction.on_commit(invalidate)
+
+
+def refresh_gradebook_entry(
+    assignment_id: int, student_id: int, *, create: bool = True
+) -> GradebookEntry | None:
+    """Recompute a student's gradebook entry for an assignment.
+
+    The entry is deleted if the student has no submissions to the assignment.
+
+    Args:
+        assignment_id: The id of the assignment
+        student_id: The id of the student
+        create: Whether to create the entry if it doesn't exist. This should be
+            ``False`` when handling deletions, since the assignment or student
+            may be being deleted as well.
+
+    Returns:
+        The entry, or ``None`` if there is none (or it wasn't created).
+    """
+    _invalidate_course_gradebook(assignment_id)
+
+    with transaction.atomic():
+        submissions = Submission.objects.filter(assignment_id=assignment_id, student_id=student_id)
+        latest_submission_id = (
+            submissions.order_by("-date_submitted").values_list("id", flat=True).first()
+        )
+        if latest_submission_id is None:
+            GradebookEntry.objects.filter(
+                assignment_id=assignment_id, student_id=student_id
+            ).delete()
+            return None
+
+        published_submission_id = (
+            PublishedSubmission.objects.filter(assignment_id=assignment_id, student_id=student_id)
+            .order_by("-submission__date_submitted")
+            .values_list("submission_id", flat=True)
+            .first()
+        )
+        graded_submission = submissions.get(id=published_submission_id or latest_submission_id)
+        point_override = Comment.objects.filter(submission=graded_submission).aggregate(
+            total=Sum("point_override")
+        )["total"]
+
+        fields = _entry_fields(
+            latest_submission_id, published_submission_id, graded_submission, point_override
+        )
+        if not create:
+            GradebookEntry.objects.filter(
+                assignment_id=assignment_id, student_id=student_id
+            ).update(**fields)
+            return None
+
+        entry, _ = GradebookEntry.objects.update_or_create(
+            assignment_id=assignment_id, student_id=student_id, defaults=fields
+        )
+        return entry
+
+
+def refresh_gradebook_entries_for_submissions(submission_ids, *, create: bool = True) -> None:
+    """Recompute the gradebook entries affected by changes to some submissions.
+
+    See :func:`refresh_gradebook_entry` for what ``create`` means.
+    """
+    pairs = (
+        Submission.objects.filter(id__in=submission_ids)
+        .order_by()
+        .values_list("assignment_id", "student_id")
+        .distinct()
+    )
+    for assignment_id, student_id in pairs:
+        refresh_gradebook_entry(assignment_id, student_id, create=create)
+
+
+def rebuild_gradebook() -> int:
+    """Recompute every gradebook entry from scratch.
+
+    Returns:
+        The number of entries in the rebuilt gradebook.
+    """
+    submissions = Submission.objects.filter(
+        assignment=OuterRef("assignment_id"), student=OuterRef("student_id")
+    )
+    publishes = PublishedSubmission.objects.filter(
+        assignment=OuterRef("assignment_id"), student=OuterRef("student_id")
+    )
+    pairs = (
+        Submission.objects.order_by()
+        .values("assignment_id", "student_id")
+        .distinct()
+        .annotate(
+            latest_submission_id=Subquery(submissions.order_by("-date_submitted").values("id")[:1]),
+            published_submission_id=Subquery(
+                publishes.order_by("-submission__date_submitted").values("submission_id")[:1]
+            ),
+        )
+    )
+
+    count = 0
+    with transaction.atomic():
+        GradebookEntry.objects.all().delete()
+
+        rows = pairs.iterator(chunk_size=REBUILD_CHUNK_SIZE)
+        while chunk := list(itertools.islice(rows, REBUILD_CHUNK_SIZE)):
+            graded_submissions = (
+                Submission.objects.filter(
+                    id__in=[
+                        row["published_submission_id"] or row["latest_submission_id"]
+                        for row in chunk
+                    ]
+                )
+                .annotate(total_point_override=Sum("comments__point_override"))
+                .in_bulk()
+            )
+
+            entries = []
+            for row in chunk:
+                graded_submission = graded_submissions[
+                    row["published_submission_id"] or row["latest_submission_id"]
+                ]
+                entries.append(
+                    GradebookEntry(
+                        assignment_id=row["assignment_id"],
+                        student_id=row["student_id"],
+                        **_entry_fields(
+                            row["latest_submission_id"],
+                            row["published_submission_id"],
+                            graded_submission,
+                            graded_submission.total_point_override,
+                        ),
+                    )
+                )
+            GradebookEntry.objects.bulk_create(entries)
+            count += len(entries)
+
+        transaction.on_commit(
+            lambda: invalidate_course_gradebook(*Course.objects.values_list("id", flat=True))
+        )
+
+    return count
+
+
+def annotate_gradebook(assignment, students):
+    """Annotate students with their gradebook entry for an assignment.
+
+    This joins each student to their :class:`.GradebookEntry` (if they have one),
+    and annotates them with
+
+    * ``latest_submission_id``: the id of their latest submission
+    * ``published_submission_id``: the id of their latest published submission
+    * ``graded_submission_id``: the id of their latest published submission, or else
+      their latest submission
+    * ``graded_points_received``, ``graded_points``, ``graded_has_been_graded`` and
+      ``graded_complete``: the corresponding fields of their gradebook entry
+
+    These are all ``None`` for students who haven't submitted anything.
+
+    Args:
+        assignment: The :class:`.Assignment`
+        students: A queryset of students
+    """
+    return students.annotate(
+        gradebook_entry=FilteredRelation(
+            "gradebook_entries", condition=Q(gradebook_entries__assignment=assignment)
+        )
+    ).annotate(
+        latest_submission_id=F("gradebook_entry__latest_submission_id"),
+        published_submission_id=F("gradebook_entry__published_submission_id"),
+        graded_submission_id=Coalesce(
+            "gradebook_entry__published_submission_id", "gradebook_entry__latest_submission_id"
+        ),
+        graded_points_received=F("gradebook_entry__points_received"),
+        graded_points=F("gradebook_entry__points"),
+        graded_has_been_graded=F("gradebook_entry__has_been_graded"),
+        graded_complete=F("gradebook_entry__complete"),
+    )
+
+
+def graded_submissions(assignment, students):
+    """Get each student's graded submission to an assignment.
+
+    Args:
+        assignment: The :class:`.Assignment`
+        students: A queryset of students
+
+    Returns:
+        A queryset of :class:`.Submission` objects.
+    """
+    return Submission.objects.filter(
+        id__in=annotate_gradebook(assignment, students)
+        .filter(graded_submission_id__isnull=False)
+        .values("graded_submission_id")
+    )
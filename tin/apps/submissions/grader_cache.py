@@ -0,0 +1,85 @@
+"""Reuse grading results for identical submissions.
+
+Rerunning a whole assignment regrades every submission, even if neither the
+grader nor the submission changed. If :attr:`.Assignment.cache_grader_results`
+is set, the result of each successful grader run is cached under a key derived from
+
+* :meth:`.Assignment.grader_fingerprint` (the grader, the assignment's other
+  files, and the grader settings),
+* the SHA-256 hash of the submission (see :class:`.SubmissionBlob`),
+* the username of the student who submitted it (which is passed to the grader),
+  and
+* :meth:`.Venv.packages_fingerprint`.
+
+Identical submissions from different students are therefore graded separately.
+
+Graders that are nondeterministic should leave caching disabled.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import logging
+
+from .models import CachedGraderResult, Submission
+
+logger = logging.getLogger(__name__)
+
+CACHED_FIELDS = ("grader_output", "grader_errors", "points_received", "has_been_graded")
+
+
+def grader_cache_key(submission: Submission) -> str | None:
+    """Get the cache key for a submission, or ``None`` if its result shouldn't be cached."""
+    assignment = submission.assignment
+    if not assignment.cache_grader_results or submission.blob is None:
+        return None
+
+    try:
+        grader_fingerprint = assignment.grader_fingerprint()
+    except OSError:
+        logger.exception("Could not fingerprint the grader for %s", assignment)
+        return None
+
+    if assignment.venv_fully_created:
+        venv_fingerprint = assignment.venv.packages_fingerprint()
+    else:
+        venv_fingerprint = "system"
+
+    return hashlib.sha256(
+        "\0".join(
+            (
+                grader_fingerprint,
+                submission.blob.sha256,
+                submission.student.username,
+                venv_fingerprint,
+            )
+        ).encode()
+    ).hexdigest()
+
+
+def apply_cached_result(submission: Submission, key: str) -> bool:
+    """Copy a cached result (if there is one) onto the submission, marking it complete.
+
+    The submission is not saved.
+
+    Returns:
+        Whether a cached result was found.
+    """
+    result = CachedGraderResult.objects.filter(assignment=submission.assignment, key=key).first()
+    if result is None:
+        return False
+
+    for field in CACHED_FIELDS:
+        setattr(submission, field, getattr(result, field))
+    submission.complete = True
+    submission.grader_pid = None
+    return True
+
+
+def cache_result(submission: Submission, key: str) -> None:
+    """Cache the result of grading a submission."""
+    CachedGraderResult.objects.update_or_create(
+        assignment=submission.assignment,
+        key=key,
+        defaults={field: getattr(submission, field) for field in CACHED_FIELDS},
+    )
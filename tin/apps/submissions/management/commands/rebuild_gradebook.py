@@ -0,0 +1,13 @@
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+
+from ...gradebook import rebuild_gradebook
+
+
+class Command(BaseCommand):
+    help = "Recompute the gradebook from every student's submissions"
+
+    def handle(self, *args, **options):
+        count = rebuild_gradebook()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt {count} gradebook entries"))
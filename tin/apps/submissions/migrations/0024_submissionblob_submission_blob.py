@@ -0,0 +1,27 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('submissions', '0023_auto_20231120_1024'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubmissionBlob',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('sha256', models.CharField(max_length=64, unique=True)),
+                ('size', models.PositiveIntegerField()),
+            ],
+        ),
+        migrations.AddField(
+            model_name='submission',
+            name='blob',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='submissions', to='submissions.submissionblob'),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:23
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assignments', '0033_assignment_cache_grader_results'),
+        ('submissions', '0024_submissionblob_submission_blob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CachedGraderResult',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64)),
+                ('grader_output', models.CharField(blank=True, max_length=10240)),
+                ('grader_errors', models.CharField(blank=True, max_length=4096)),
+                ('points_received', models.DecimalField(blank=True, decimal_places=3, max_digits=6, null=True)),
+                ('has_been_graded', models.BooleanField(default=False)),
+                ('date', models.DateTimeField(auto_now=True)),
+                ('assignment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='cached_grader_results', to='assignments.assignment')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='cachedgraderresult',
+            constraint=models.UniqueConstraint(fields=('assignment', 'key'), name='unique_assignment_key'),
+        ),
+    ]
@@ -0,0 +1,75 @@
+# Generated by Django 4.2.30 on 2026-10-18 06:44
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def build_gradebook(apps, schema_editor):
+    Submission = apps.get_model("submissions", "Submission")
+    PublishedSubmission = apps.get_model("submissions", "PublishedSubmission")
+    Comment = apps.get_model("submissions", "Comment")
+    GradebookEntry = apps.get_model("submissions", "GradebookEntry")
+
+    pairs = Submission.objects.order_by().values_list("assignment_id", "student_id").distinct()
+    for assignment_id, student_id in pairs.iterator():
+        submissions = Submission.objects.filter(assignment_id=assignment_id, student_id=student_id)
+        latest = submissions.order_by("-date_submitted").first()
+        publish = (
+            PublishedSubmission.objects.filter(assignment_id=assignment_id, student_id=student_id)
+            .order_by("-submission__date_submitted")
+            .first()
+        )
+        graded = submissions.get(id=publish.submission_id) if publish else latest
+        point_override = Comment.objects.filter(submission=graded).aggregate(
+            total=models.Sum("point_override")
+        )["total"] or 0
+        GradebookEntry.objects.create(
+            assignment_id=assignment_id,
+            student_id=student_id,
+            latest_submission=latest,
+            published_submission_id=publish.submission_id if publish else None,
+            points_received=graded.points_received,
+            points=(
+                graded.points_received + point_override
+                if graded.points_received is not None
+                else None
+            ),
+            has_been_graded=graded.has_been_graded,
+            complete=graded.complete,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('assignments', '0033_assignment_cache_grader_results'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('submissions', '0025_cachedgraderresult'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='GradebookEntry',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('points_received', models.DecimalField(blank=True, decimal_places=3, max_digits=6, null=True)),
+                ('points', models.DecimalField(blank=True, decimal_places=3, max_digits=7, null=True)),
+                ('has_been_graded', models.BooleanField(default=False)),
+                ('complete', models.BooleanField(default=False)),
+                ('last_updated', models.DateTimeField(auto_now=True)),
+                ('assignment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gradebook_entries', to='assignments.assignment')),
+                ('latest_submission', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='submissions.submission')),
+                ('published_submission', models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='submissions.submission')),
+                ('student', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='gradebook_entries', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'gradebook entries',
+            },
+        ),
+        migrations.AddConstraint(
+            model_name='gradebookentry',
+            constraint=models.UniqueConstraint(fields=('assignment', 'student'), name='unique_gradebook_assignment_student'),
+        ),
+        migrations.RunPython(build_gradebook, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:12
+
+from django.db import migrations, models
+from django.db.models import F, Window
+from django.db.models.functions import RowNumber
+
+
+def number_submissions(apps, schema_editor):
+    Submission = apps.get_model("submissions", "Submission")
+
+    submissions = Submission.objects.annotate(
+        row_number=Window(
+            RowNumber(),
+            partition_by=[F("assignment_id"), F("student_id")],
+            order_by=F("id").asc(),
+        )
+    ).only("id")
+
+    batch = []
+    for submission in submissions.iterator(chunk_size=2000):
+        submission.number = submission.row_number
+        batch.append(submission)
+        if len(batch) >= 2000:
+            Submission.objects.bulk_update(batch, ["number"])
+            batch = []
+    Submission.objects.bulk_update(batch, ["number"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('submissions', '0026_gradebookentry'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='number',
+            field=models.PositiveIntegerField(editable=False, null=True),
+        ),
+        migrations.RunPython(number_submissions, migrations.RunPython.noop),
+    ]
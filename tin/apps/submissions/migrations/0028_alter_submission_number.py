@@ -0,0 +1,22 @@
+# Generated by Django 4.2.30 on 2026-10-18 08:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('submissions', '0027_submission_number'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='submission',
+            name='number',
+            field=models.PositiveIntegerField(editable=False),
+        ),
+        migrations.AddConstraint(
+            model_name='submission',
+            constraint=models.UniqueConstraint(fields=('assignment', 'student', 'number'), name='unique_submission_number'),
+        ),
+    ]
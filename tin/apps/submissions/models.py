@@ -1,26 +1,36 @@
 from __future__ import annotations
 
+import contextlib
+import fcntl
+import hashlib
 import logging
 import os
-import subprocess
 from datetime import timedelta
 
+from asgiref.sync import async_to_sync
 from celery.canvas import Signature
+from channels.layers import get_channel_layer
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.validators import MinValueValidator
-from django.db import models
-from django.db.models import Q
+from django.db import models, transaction
+from django.db.models import Max, OuterRef, Q, Subquery
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.text import slugify
 
-from ...sandboxing import get_assignment_sandbox_args
-from .utils import decimal_repr
+from ..courses.roles import get_course_roles
+from ..safe_files import safe_remove_file, safe_write_file
+from .utils import format_grade, serialize_submission_info
 
 logger = logging.getLogger(__name__)
 
 
+def assignment_channel_group_name(assignment_id: int) -> str:
+    """The channel layer group updates to an assignment's submissions are sent to."""
+    return f"assignment-{assignment_id}-submissions"
+
+
 class SubmissionQuerySet(models.query.QuerySet):
     def filter_visible(self, user):
         """Filter who can see the submission
@@ -32,21 +42,126 @@ class SubmissionQuerySet(models.query.QuerySet):
             return self.all()
         else:
             return self.filter(
-                Q(assignment__course__teacher=user)
+                Q(assignment__course_id__in=get_course_roles(user).taught_course_ids)
                 | Q(student=user)
                 & Q(assignment__is_quiz=False)
                 & (
                     Q(assignment__course__archived=False)
                     | Q(assignment__course__permission__in="rw")
                 )
-            ).distinct()
+            )
 
     def filter_editable(self, user):
         """Filter submissions based on who can edit them."""
         if user.is_superuser:
             return self.all()
         else:
-            return self.filter(assignment__course__teacher=user).distinct()
+            return self.filter(assignment__course_id__in=get_course_roles(user).taught_course_ids)
+
+    def with_publish_info(self):
+        """Fetch what is needed to show whether the submissions are published.
+
+        This saves a few queries per submission when using
+        :attr:`~.Submission.is_published`, :attr:`~.Submission.is_latest_publish`
+        and :attr:`~.Submission.published_submission`.
+        """
+        latest_publish = PublishedSubmission.objects.filter(
+            assignment=OuterRef("assignment"), student=OuterRef("student")
+        ).order_by("-submission__date_submitted")
+        return self.select_related("final_submission").annotate(
+            latest_published_submission_id=Subquery(latest_publish.values("submission_id")[:1])
+        )
+
+
+def submission_blob_path(sha256: str) -> str:
+    """Get the path (relative to ``settings.MEDIA_ROOT``) of a blob in the blob store"""
+    return os.path.join("submission-blobs", sha256[:2], sha256[2:4], sha256)
+
+
+class SubmissionBlobQuerySet(models.query.QuerySet):
+    def store(self, text: str) -> SubmissionBlob:
+        """Store some text, reusing the existing blob if the same text was stored before.
+
+        This must be called in a transaction, and the blob must be referenced by a
+        submission before the transaction ends. Until then, the blob is locked so
+        that it can't be released.
+        """
+        data = text.encode("utf-8")
+        sha256 = hashlib.sha256(data).hexdigest()
+
+        while True:
+            blob, _ = self.get_or_create(sha256=sha256, defaults={"size": len(data)})
+            try:
+                blob = self.select_for_update().get(id=blob.id)
+            except SubmissionBlob.DoesNotExist:
+                # It was released in between, so create it again
+                continue
+            break
+
+        # The file is written atomically, but it may have been left empty or truncated
+        # by a crash before it was flushed to disk (or deleted by hand), so repair it.
+        try:
+            intact = os.path.getsize(blob.path) == blob.size
+        except FileNotFoundError:
+            intact = False
+        if not intact:
+            safe_write_file(settings.MEDIA_ROOT, blob.name, data)
+
+        return blob
+
+    def release(self, blob_id: int) -> None:
+        """Delete a blob (and its file) if no submissions reference it anymore.
+
+        The file is only deleted once the deletion of the blob is committed, and only
+        if the same text hasn't been stored again since.
+        """
+        with transaction.atomic():
+            blob = self.select_for_update().filter(id=blob_id).first()
+            if blob is None or blob.submissions.exists():
+                return
+
+            blob.delete()
+            transaction.on_commit(lambda: self._remove_unused_file(blob.sha256, blob.path))
+
+    def _remove_unused_file(self, sha256: str, path: str) -> None:
+        if not self.filter(sha256=sha256).exists():
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+
+
+class SubmissionBlob(models.Model):
+    """The contents of one or more identical submissions.
+
+    Blobs are stored once on disk, at a path derived from their SHA-256 hash.
+    A blob is deleted once the last submission referencing it is deleted.
+    """
+
+    sha256 = models.CharField(max_length=64, unique=True)
+    size = models.PositiveIntegerField()
+
+    objects = SubmissionBlobQuerySet.as_manager()
+
+    def __str__(self):
+        return self.sha256
+
+    @property
+    def name(self) -> str:
+        return submission_blob_path(self.sha256)
+
+    @property
+    def path(self) -> str:
+        return os.path.join(settings.MEDIA_ROOT, self.name)
+
+    @property
+    def ref_count(self) -> int:
+        return self.submissions.count()
+
+    def read_bytes(self) -> bytes:
+        with open(self.path, "rb") as f:
+            return f.read()
+
+    def read_text(self) -> str:
+        return self.read_bytes().decode("utf-8")
 
 
 def upload_submission_file_path(submission, _) -> str:  # pylint: disable=unused-argument
@@ -80,6 +195,10 @@ class Submission(models.Model):
     date_submitted = models.DateTimeField(auto_now_add=True)
     last_run = models.DateTimeField(null=True, blank=True)
 
+    # The submission's position among the student's submissions to the assignment,
+    # starting from 1. This is assigned when the submission is created.
+    number = models.PositiveIntegerField(editable=False)
+
     has_been_graded = models.BooleanField(default=False)
 
     complete = models.BooleanField(default=False)
@@ -92,7 +211,15 @@ class Submission(models.Model):
 
     points_received = models.DecimalField(max_digits=6, decimal_places=3, null=True, blank=True)
 
+    # Where the submission is written while it is being graded
     file = models.FileField(upload_to=upload_submission_file_path, null=True)
+    blob = models.ForeignKey(
+        SubmissionBlob,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name="submissions",
+    )
 
     grader_output = models.CharField(max_length=10 * 1024, blank=True)
     grader_errors = models.CharField(max_length=4 * 1024, blank=True)
@@ -101,6 +228,12 @@ class Submission(models.Model):
 
     class Meta:
         get_latest_by = "date_submitted"
+        constraints = [
+            models.UniqueConstraint(
+                name="unique_submission_number",
+                fields=["assignment", "student", "number"],
+            ),
+        ]
 
     def __str__(self):
         return "{}{} [{}]: {} ({})".format(
@@ -111,6 +244,24 @@ class Submission(models.Model):
             (self.grade_percent if self.has_been_graded else "not graded"),
         )
 
+    def save(self, *args, **kwargs):
+        if self._state.adding and self.number is None:
+            with transaction.atomic():
+                # Lock the student so that concurrent submissions get different numbers
+                list(
+                    get_user_model()
+                    .objects.select_for_update()
+                    .filter(id=self.student_id)
+                    .values_list("id")
+                )
+                last_number = Submission.objects.filter(
+                    assignment_id=self.assignment_id, student_id=self.student_id
+                ).aggregate(last_number=Max("number"))["last_number"]
+                self.number = (last_number or 0) + 1
+                super().save(*args, **kwargs)
+        else:
+            super().save(*args, **kwargs)
+
     def get_absolute_url(self):
         return reverse("submissions:show", args=[self.id])
 
@@ -156,10 +307,7 @@ class Submission(models.Model):
     @property
     def formatted_grade(self):
         if self.has_been_graded:
-            return (
-                f"{decimal_repr(self.points)} / {decimal_repr(self.points_possible)} "
-                f"({self.grade_percent})"
-            )
+            return format_grade(self.points, self.points_possible)
         return "Not graded"
 
     @property
@@ -185,7 +333,8 @@ class Submission(models.Model):
             "// " if language == "J" else "# ",
             course.name,
             self.assignment.name,
-            ", ".join(p.name for p in self.student.periods.filter(course=course)),
+            # Not filtered in the database, so that prefetched periods can be used
+            ", ".join(p.name for p in self.student.periods.all() if p.course_id == course.id),
             self.student.full_name,
             self.student.username,
             timezone.localtime(self.date_submitted).strftime("%D (%B %e, %Y) %-I:%M %P"),
@@ -199,9 +348,13 @@ class Submission(models.Model):
             return None
 
         try:
-            with open(self.backup_file_path) as f:
-                file_text = f.read()
-        except OSError:
+            if self.blob is not None:
+                file_text = self.blob.read_text()
+            else:
+                # Submissions from before the blob store was added
+                with open(self.backup_file_path) as f:
+                    file_text = f.read()
+        except (OSError, UnicodeDecodeError):
             file_text = "[Error accessing submission file]"
 
         return file_text
@@ -232,6 +385,11 @@ class Submission(models.Model):
             os.path.basename(self.file.name),
         )
 
+    @property
+    def full_output_dir(self) -> str:
+        """Where the full grader output is saved if ``settings.SAVE_FULL_GRADER_OUTPUT`` is set."""
+        return os.path.join(settings.MEDIA_ROOT, "grader-output", f"submission-{self.id}")
+
     @property
     def backup_file_path(self) -> str | None:
         if self.file is None:
@@ -240,57 +398,78 @@ class Submission(models.Model):
         return os.path.join(settings.MEDIA_ROOT, "submission-backups", self.file.name)
 
     def save_file(self, submission_text: str) -> None:
-        """Save the student's code submission to a file
-
-        .. warning::
-
-            Writing to files in directories not controlled by us without some
-            form of sandboxing is a security risk. Most notably, users can use symbolic
-            links to trick you into writing to another file, outside the directory.
-            This solution is very hacky, but we don't have another good way of
-            doing this.
+        """Save the student's code submission to the blob store
 
+        Identical submissions share the same blob. The file at :attr:`file_path`
+        is only created while the submission is being graded (see
+        :meth:`write_working_copy`).
         """
         fname = upload_submission_file_path(self, "")
 
-        self.file.name = fname
-        self.save()
+        with transaction.atomic():
+            self.blob = SubmissionBlob.objects.store(submission_text)
+            self.file.name = fname
+            self.save()
 
-        fpath = self.file_path
+    @contextlib.contextmanager
+    def _lock_working_copy(self):
+        """Lock the working copy and the count of runs using it.
 
-        os.makedirs(os.path.dirname(fpath), exist_ok=True)
+        Runs of the same submission can happen at once (e.g. when it is rerun while
+        it's being graded), possibly on different workers, so they coordinate with
+        a lock on the blob's file (which graders can't write to).
+        """
+        with open(self.blob.path, "rb") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield
 
-        args = get_assignment_sandbox_args(
-            ["sh", "-c", 'cat >"$1"', "sh", fpath],
-            network_access=False,
-            whitelist=[os.path.dirname(fpath)],
-        )
+    @property
+    def _working_copy_runs_name(self) -> str:
+        return os.path.join("working-copy-runs", f"submission-{self.id}")
 
+    def _get_working_copy_runs(self) -> int:
         try:
-            subprocess.run(
-                args,
-                input=submission_text,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                encoding="utf-8",
-                text=True,
-                check=True,
-            )
-        except FileNotFoundError as e:
-            logger.error("Cannot run processes: %s", e)
-            raise FileNotFoundError from e
+            with open(os.path.join(settings.MEDIA_ROOT, self._working_copy_runs_name)) as f:
+                return int(f.read())
+        except FileNotFoundError:
+            return 0
+
+    def _set_working_copy_runs(self, runs: int) -> None:
+        if runs > 0:
+            safe_write_file(settings.MEDIA_ROOT, self._working_copy_runs_name, str(runs))
+        else:
+            safe_remove_file(settings.MEDIA_ROOT, self._working_copy_runs_name)
 
-    def create_backup_copy(self, submission_text: str) -> None:
-        """Create a backup copy of the student's code submission"""
-        backup_fpath = self.backup_file_path
+    def write_working_copy(self) -> None:
+        """Write the submission to :attr:`file_path` so the grader can run it.
 
-        if backup_fpath is None:
-            raise ValueError
+        Every call must be followed by a call to :meth:`remove_working_copy`.
 
-        os.makedirs(os.path.dirname(backup_fpath), mode=0o755, exist_ok=True)
+        The submission's directory is writable by graders, so the file is written
+        with :func:`.safe_write_file` to avoid following symbolic links out of it.
+        """
+        if self.blob is None:
+            return
 
-        with open(backup_fpath, "w", encoding="utf-8") as f_obj:
-            f_obj.write(submission_text)
+        with self._lock_working_copy():
+            self._set_working_copy_runs(self._get_working_copy_runs() + 1)
+            safe_write_file(settings.MEDIA_ROOT, self.file.name, self.blob.read_bytes())
+
+    def remove_working_copy(self) -> None:
+        """Remove the file written by :meth:`write_working_copy`.
+
+        It is left in place while any other run of the submission is still using
+        it. Submissions from before the blob store was added are only stored at
+        :attr:`file_path`, so they are left alone.
+        """
+        if self.blob is None:
+            return
+
+        with self._lock_working_copy():
+            runs = self._get_working_copy_runs() - 1
+            self._set_working_copy_runs(runs)
+            if runs <= 0:
+                safe_remove_file(settings.MEDIA_ROOT, self.file.name)
 
     def rerun(self) -> Signature:
         from .tasks import run_submission  # pylint: disable=import-outside-toplevel
@@ -316,6 +495,68 @@ class Submission(models.Model):
     def channel_group_name(self) -> str:
         return f"submission-{self.id}"
 
+    @property
+    def assignment_channel_group_name(self) -> str:
+        """The channel layer group updates to all of an assignment's submissions are sent to.
+
+        See :class:`.SubmissionFeedConsumer`.
+        """
+        return assignment_channel_group_name(self.assignment_id)
+
+    @property
+    def update_group_names(self) -> tuple[str, str]:
+        """The channel layer groups :meth:`get_update_event` is sent to."""
+        return self.channel_group_name, self.assignment_channel_group_name
+
+    def get_update_event(self, stream_ends: dict[str, int] | None = None) -> dict:
+        """The message sent to :attr:`update_group_names` when the submission changes.
+
+        It carries the submission's info (see :func:`.serialize_submission_info`),
+        so consumers can pass it on without fetching the submission themselves.
+
+        Args:
+            stream_ends: Where the grader output and errors end in their streams,
+                if known (see :func:`.output_stream_ends`)
+        """
+        return {
+            "type": "submission.updated",
+            "submission_id": self.id,
+            "assignment_id": self.assignment_id,
+            "student_id": self.student_id,
+            "info": serialize_submission_info(self),
+            "stream_ends": stream_ends or {},
+        }
+
+    def send_update(self, stream_ends: dict[str, int] | None = None) -> None:
+        """Tell everyone watching the submission that it changed."""
+        channel_layer = get_channel_layer()
+        event = self.get_update_event(stream_ends)
+        for group in self.update_group_names:
+            async_to_sync(channel_layer.group_send)(group, event)
+
+    @property
+    def control_group_name(self) -> str:
+        """The channel layer group the grader supervising this submission listens on."""
+        return f"submission-{self.id}-control"
+
+    def request_kill(self) -> None:
+        """Ask the grader supervising this submission to kill it.
+
+        The request is both saved to the database and pushed to the supervisor over
+        the channel layer, so the grader is killed as soon as the message arrives.
+        If the channel layer is unavailable, the supervisor still finds the request
+        in the database, just later.
+        """
+        self.kill_requested = True
+        self.save(update_fields=["kill_requested"])
+
+        try:
+            async_to_sync(get_channel_layer().group_send)(
+                self.control_group_name, {"type": "grader.kill"}
+            )
+        except Exception:
+            logger.exception("Could not send a kill request to %s", self.control_group_name)
+
     @property
     def is_latest(self):
         submissions = Submission.objects.filter(assignment=self.assignment, student=self.student)
@@ -323,12 +564,14 @@ class Submission(models.Model):
 
     @property
     def is_published(self):
-        return PublishedSubmission.objects.filter(
-            assignment=self.assignment, student=self.student, submission=self
-        ).exists()
+        return self.published_submission is not None
 
     @property
     def is_latest_publish(self):
+        if hasattr(self, "latest_published_submission_id"):
+            # Annotated by SubmissionQuerySet.with_publish_info()
+            return self.latest_published_submission_id == self.id
+
         latest_publish = PublishedSubmission.objects.filter(
             assignment=self.assignment, student=self.student
         )
@@ -336,14 +579,14 @@ class Submission(models.Model):
 
     @property
     def published_submission(self):
-        submissions = PublishedSubmission.objects.filter(
-            student=self.student, assignment=self.assignment, submission=self
-        )
-        return submissions.first() if submissions else None
+        try:
+            return self.final_submission
+        except PublishedSubmission.DoesNotExist:
+            return None
 
     def publish(self):
         if not self.is_published:
-            PublishedSubmission.objects.create(
+            self.final_submission = PublishedSubmission.objects.create(
                 assignment=self.assignment, student=self.student, submission=self
             )
 
@@ -353,6 +596,7 @@ class Submission(models.Model):
             PublishedSubmission.objects.filter(
                 assignment=self.assignment, student=self.student, submission=self
             ).delete()
+            self.final_submission = None
 
 
 class PublishedSubmission(models.Model):
@@ -381,6 +625,90 @@ class PublishedSubmission(models.Model):
         return cls.objects.filter(student=student, assignment=assignment).order_by("-date")
 
 
+class GradebookEntry(models.Model):
+    """A denormalized summary of a student's submissions to an assignment.
+
+    This is kept up to date whenever a submission is created, graded, published or
+    unpublished, or commented on (see :mod:`.gradebook`), so that pages listing many
+    students don't have to work it out from their submissions.
+
+    The "graded" submission is the latest published submission, or the latest
+    submission if none have been published.
+    """
+
+    assignment = models.ForeignKey(
+        "assignments.Assignment", on_delete=models.CASCADE, related_name="gradebook_entries"
+    )
+    student = models.ForeignKey(
+        settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="gradebook_entries"
+    )
+
+    latest_submission = models.ForeignKey(
+        Submission, on_delete=models.SET_NULL, null=True, related_name="+"
+    )
+    published_submission = models.ForeignKey(
+        Submission, on_delete=models.SET_NULL, null=True, related_name="+"
+    )
+
+    # The graded submission's score, without and with comment point overrides
+    points_received = models.DecimalField(max_digits=6, decimal_places=3, null=True, blank=True)
+    points = models.DecimalField(max_digits=7, decimal_places=3, null=True, blank=True)
+    has_been_graded = models.BooleanField(default=False)
+    complete = models.BooleanField(default=False)
+
+    last_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "gradebook entries"
+        constraints = [
+            models.UniqueConstraint(
+                name="unique_gradebook_assignment_student",
+                fields=["assignment", "student"],
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return f"{type(self).__name__}({self.assignment!s}, {self.student!s})"
+
+    @property
+    def graded_submission_id(self) -> int | None:
+        return self.published_submission_id or self.latest_submission_id
+
+    @property
+    def graded_submission(self) -> Submission | None:
+        return self.published_submission or self.latest_submission
+
+
+class CachedGraderResult(models.Model):
+    """The result of running a grader, reused for identical submissions.
+
+    See :mod:`.grader_cache` for details.
+    """
+
+    assignment = models.ForeignKey(
+        "assignments.Assignment", on_delete=models.CASCADE, related_name="cached_grader_results"
+    )
+    key = models.CharField(max_length=64)
+
+    grader_output = models.CharField(max_length=10 * 1024, blank=True)
+    grader_errors = models.CharField(max_length=4 * 1024, blank=True)
+    points_received = models.DecimalField(max_digits=6, decimal_places=3, null=True, blank=True)
+    has_been_graded = models.BooleanField(default=False)
+
+    date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                name="unique_assignment_key",
+                fields=["assignment", "key"],
+            ),
+        ]
+
+    def __str__(self) -> str:
+        return f"{type(self).__name__}({self.assignment!s}, {self.key})"
+
+
 class Comment(models.Model):
     """A comment on a submission by a user"""
 
@@ -0,0 +1,320 @@
+"""Run graders on an asyncio event loop.
+
+Normally, :func:`.run_submission` blocks a Celery worker process for as long as
+the grader runs. If ``settings.ASYNC_GRADER_RUNNER`` is set, it instead hands the
+submission to the worker process's :class:`GraderRunner`, which runs graders as
+asyncio subprocesses on an event loop in a background thread. A single worker
+process can then supervise up to ``settings.ASYNC_GRADER_RUNNER_MAX_GRADERS``
+graders at once.
+
+Once that many graders are running, :meth:`GraderRunner.submit` (and so the Celery
+task) blocks until one finishes, so that extra submissions stay in the Celery queue,
+where other workers can take them, instead of piling up in one process. However,
+the task still returns (and its message is acknowledged) once its grader starts,
+so graders that are running when a worker process dies are lost rather than
+retried; they're left incomplete.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import concurrent.futures
+import logging
+import os
+import subprocess
+import threading
+
+from celery.signals import worker_process_shutdown, worker_shutdown
+from channels.db import database_sync_to_async
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.utils import timezone
+
+from .grader_cache import apply_cached_result, cache_result, grader_cache_key
+from .models import Submission
+from .supervisor import supervise_grader
+from .tasks import (
+    cleanup_submission,
+    finish_output,
+    grader_command,
+    grader_timeout,
+    kill_grader,
+    make_output_capture,
+    output_stream_ends,
+    prepare_submission,
+    save_grading_result,
+    set_internal_error,
+    set_score_from_output,
+    set_setup_error,
+)
+
+logger = logging.getLogger(__name__)
+
+#: How often to check the database for kill requests if the channel layer is unavailable
+KILL_CHECK_INTERVAL = 15
+
+
+def _setup_submission(submission_id: int):
+    """Prepare a submission to be graded.
+
+    Returns:
+        A tuple of the submission, the grader command (or ``None`` if the grader
+        shouldn't be run), and the grader cache key.
+    """
+    submission = Submission.objects.select_related(
+        "assignment", "assignment__venv", "student", "blob"
+    ).get(id=submission_id)
+
+    cache_key = grader_cache_key(submission)
+    if cache_key is not None and apply_cached_result(submission, cache_key):
+        save_grading_result(submission)
+        return submission, None, cache_key
+
+    try:
+        python_exe = prepare_submission(submission)
+    except OSError:
+        set_setup_error(submission)
+        save_grading_result(submission)
+        cleanup_submission(submission)
+        return submission, None, cache_key
+
+    return submission, grader_command(submission, python_exe), cache_key
+
+
+async def _wait_for_kill_request(submission: Submission) -> None:
+    """Return once a kill has been requested for the submission."""
+    channel_layer = get_channel_layer()
+    kill_requested = database_sync_to_async(
+        Submission.objects.filter(id=submission.id, kill_requested=True).exists
+    )
+
+    try:
+        channel_name = await channel_layer.new_channel()
+        await channel_layer.group_add(submission.control_group_name, channel_name)
+    except Exception:
+        logger.exception("Could not subscribe to %s", submission.control_group_name)
+        while not await kill_requested():
+            await asyncio.sleep(KILL_CHECK_INTERVAL)
+        return
+
+    try:
+        # The kill may have been requested before we started listening for it
+        if await kill_requested():
+            return
+        while (await channel_layer.receive(channel_name)).get("type") != "grader.kill":
+            pass
+    finally:
+        try:
+            await channel_layer.group_discard(submission.control_group_name, channel_name)
+        except Exception:
+            logger.exception("Could not unsubscribe from %s", submission.control_group_name)
+
+
+async def _flush_periodically(dirty: asyncio.Event, flush) -> None:
+    """Call ``flush`` whenever ``dirty`` is set.
+
+    ``flush`` is called at most ``settings.GRADER_OUTPUT_MAX_FLUSHES_PER_SECOND``
+    times per second.
+    """
+    max_per_second = settings.GRADER_OUTPUT_MAX_FLUSHES_PER_SECOND
+    if max_per_second <= 0:
+        return
+
+    while True:
+        await dirty.wait()
+        dirty.clear()
+        try:
+            await flush()
+        except Exception:
+            logger.exception("Could not save grader output")
+        await asyncio.sleep(1 / max_per_second)
+
+
+async def _send_update(
+    channel_layer, submission: Submission, stream_ends: dict[str, int] | None = None
+) -> None:
+    event = await database_sync_to_async(submission.get_update_event)(stream_ends)
+    for group in submission.update_group_names:
+        await channel_layer.group_send(group, event)
+
+
+async def run_submission_async(submission_id: int) -> None:
+    """The asyncio equivalent of :func:`.run_submission`."""
+    channel_layer = get_channel_layer()
+
+    submission, command, cache_key = await database_sync_to_async(_setup_submission)(submission_id)
+    if command is None:
+        await _send_update(channel_layer, submission)
+        return
+
+    save = database_sync_to_async(submission.save)
+
+    output = errors = None
+    proc = None
+    try:
+        killed = False
+        retcode = None
+
+        output = make_output_capture(submission, "grader_output", "stdout")
+        errors = make_output_capture(submission, "grader_errors", "stderr")
+
+        args, env, cwd = command
+
+        dirty = asyncio.Event()
+
+        def on_output(stream, data):
+            (output if stream == "stdout" else errors).feed(data)
+            dirty.set()
+
+        async def flush_output():
+            submission.grader_output = output.truncated_text(output.max_chars)
+            submission.grader_errors = errors.truncated_text(errors.max_chars)
+            await save(update_fields=["grader_output", "grader_errors"])
+
+            await _send_update(
+                channel_layer, submission, output_stream_ends(submission, output, errors)
+            )
+
+        proc = await asyncio.create_subprocess_exec(  # pylint: disable=subprocess-popen-preexec-fn
+            *args,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            stdin=subprocess.DEVNULL,
+            cwd=cwd,
+            preexec_fn=os.setpgrp,
+            env=env,
+        )
+
+        submission.grader_pid = proc.pid
+        submission.grader_start_time = timezone.localtime().timestamp()
+        await save(update_fields=["grader_pid", "grader_start_time"])
+
+        flusher = asyncio.create_task(_flush_periodically(dirty, flush_output))
+        try:
+            result = await supervise_grader(
+                proc,
+                timeout=grader_timeout(submission),
+                on_output=on_output,
+                kill_request=_wait_for_kill_request(submission),
+                kill=lambda: kill_grader(proc.pid),
+            )
+        finally:
+            flusher.cancel()
+
+        killed = result != "exited"
+        retcode = proc.returncode
+
+        finish_output(
+            output, errors, killed=killed, timed_out=result == "timed_out", retcode=retcode
+        )
+
+        # This is saved (and the final notification sent) below
+        submission.grader_output = output.truncated_text(output.max_chars)
+        submission.grader_errors = errors.truncated_text(errors.max_chars)
+    except Exception:  # pylint: disable=broad-except  # noqa: BLE001
+        if proc is not None and proc.returncode is None:
+            kill_grader(proc.pid)
+        set_internal_error(submission)
+    else:
+        if output and not killed and retcode == 0:
+            set_score_from_output(submission, output)
+        if cache_key is not None and not killed and retcode == 0:
+            await database_sync_to_async(cache_result)(submission, cache_key)
+    finally:
+        for capture in (output, errors):
+            if capture is not None:
+                capture.close()
+
+        submission.complete = True
+        submission.grader_pid = None
+        await database_sync_to_async(save_grading_result)(submission)
+
+        await _send_update(
+            channel_layer, submission, output_stream_ends(submission, output, errors)
+        )
+
+        cleanup_submission(submission)
+
+
+class GraderRunner:
+    """Runs graders concurrently on an event loop in a background thread.
+
+    Args:
+        max_graders: The maximum number of graders to run at once.
+    """
+
+    def __init__(self, max_graders: int):
+        self.max_graders = max_graders
+
+        self._slots = threading.Semaphore(max_graders)
+        self._pending: set[concurrent.futures.Future] = set()
+        self._lock = threading.Lock()
+
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(
+            target=self._loop.run_forever, name="grader-runner", daemon=True
+        )
+        self._thread.start()
+
+    def submit(self, submission_id: int) -> concurrent.futures.Future:
+        """Start grading a submission without waiting for it to finish.
+
+        This blocks until fewer than ``max_graders`` graders are running.
+        """
+        self._slots.acquire()  # pylint: disable=consider-using-with
+        try:
+            future = asyncio.run_coroutine_threadsafe(
+                run_submission_async(submission_id), self._loop
+            )
+        except BaseException:
+            self._slots.release()
+            raise
+        with self._lock:
+            self._pending.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def shutdown(self, *, wait: bool = True) -> None:
+        """Stop the event loop, by default after all submitted graders have finished."""
+        if wait:
+            with self._lock:
+                pending = list(self._pending)
+            concurrent.futures.wait(pending)
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def _on_done(self, future: concurrent.futures.Future) -> None:
+        with self._lock:
+            self._pending.discard(future)
+        self._slots.release()
+
+        if not future.cancelled() and future.exception() is not None:
+            logger.error("Grader runner task failed", exc_info=future.exception())
+
+
+_runner: GraderRunner | None = None
+_runner_pid: int | None = None
+_runner_lock = threading.Lock()
+
+
+def get_grader_runner() -> GraderRunner:
+    """Get the :class:`GraderRunner` for this process, starting it if necessary."""
+    global _runner, _runner_pid  # noqa: PLW0603  # pylint: disable=global-statement
+
+    with _runner_lock:
+        # Celery forks worker processes, and the event loop thread doesn't survive that
+        if _runner is None or _runner_pid != os.getpid():
+            _runner = GraderRunner(settings.ASYNC_GRADER_RUNNER_MAX_GRADERS)
+            _runner_pid = os.getpid()
+        return _runner
+
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def shutdown_grader_runner(**kwargs) -> None:  # pylint: disable=unused-argument
+    """Let running graders finish before a worker process exits."""
+    with _runner_lock:
+        runner = _runner if _runner_pid == os.getpid() else None
+    if runner is not None:
+        runner.shutdown()
@@ -0,0 +1,67 @@
+from __future__ import annotations
+
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+
+from ..assignments.models import Assignment
+from .gradebook import (
+    GRADEBOOK_FIELDS,
+    refresh_gradebook_entries_for_submissions,
+    refresh_gradebook_entry,
+)
+from .models import Comment, PublishedSubmission, Submission, SubmissionBlob
+from .versions import forget_submission_versions
+
+
+def release_blob(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    if instance.blob_id is not None:
+        blob_id = instance.blob_id
+        transaction.on_commit(lambda: SubmissionBlob.objects.release(blob_id))
+
+
+def update_gradebook(sender, instance, update_fields=None, **kwargs):  # pylint: disable=unused-argument
+    if update_fields is not None and GRADEBOOK_FIELDS.isdisjoint(update_fields):
+        return
+    refresh_gradebook_entry(instance.assignment_id, instance.student_id)
+
+
+def update_gradebook_on_delete(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    # The assignment or student may be being deleted as well
+    refresh_gradebook_entry(instance.assignment_id, instance.student_id, create=False)
+
+
+def update_gradebook_for_comment(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    refresh_gradebook_entries_for_submissions([instance.submission_id])
+
+
+def update_gradebook_for_comment_on_delete(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    refresh_gradebook_entries_for_submissions([instance.submission_id], create=False)
+
+
+def forget_version(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    forget_submission_versions(instance.id)
+
+
+def forget_version_for_comment(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    forget_submission_versions(instance.submission_id)
+
+
+def forget_versions_for_assignment(sender, instance, **kwargs):  # pylint: disable=unused-argument
+    # e.g. its points possible changed
+    forget_submission_versions(*instance.submissions.values_list("id", flat=True))
+
+
+post_delete.connect(release_blob, sender=Submission)
+
+post_save.connect(update_gradebook, sender=Submission)
+post_save.connect(update_gradebook, sender=PublishedSubmission)
+post_delete.connect(update_gradebook_on_delete, sender=Submission)
+post_delete.connect(update_gradebook_on_delete, sender=PublishedSubmission)
+post_save.connect(update_gradebook_for_comment, sender=Comment)
+post_delete.connect(update_gradebook_for_comment_on_delete, sender=Comment)
+
+post_save.connect(forget_version, sender=Submission)
+post_delete.connect(forget_version, sender=Submission)
+post_save.connect(forget_version_for_comment, sender=Comment)
+post_delete.connect(forget_version_for_comment, sender=Comment)
+post_save.connect(forget_versions_for_assignment, sender=Assignment)
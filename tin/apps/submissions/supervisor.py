@@ -0,0 +1,359 @@
+"""Event-driven supervision of running graders.
+
+Instead of waking up on a fixed interval and asking the database whether anything
+happened, the grader is supervised with a selector that reacts to:
+
+* output on the grader's stdout/stderr,
+* the grader process exiting (via a pidfd where the platform supports it),
+* the grader's deadline passing, and
+* kill requests, which are delivered over the channel layer (see
+  :meth:`.Submission.request_kill`) and turned into a readable file descriptor
+  by :class:`KillRequestListener`.
+
+:func:`supervise_grader` does the same for graders started with asyncio, which
+lets a single process supervise many graders at once (see :mod:`.runner`).
+"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+import os
+import selectors
+import subprocess
+import threading
+import time
+from collections.abc import Awaitable, Callable
+from typing import Literal
+
+from channels.layers import get_channel_layer
+
+logger = logging.getLogger(__name__)
+
+SupervisorResult = Literal["exited", "killed", "timed_out"]
+
+#: How long to wait for the channel layer subscription before falling back
+LISTENER_STARTUP_TIMEOUT = 5
+
+
+class KillRequestListener:
+    """Turns kill requests sent over the channel layer into a readable file descriptor.
+
+    The listener subscribes to ``group_name`` in a background thread. Whenever a
+    ``grader.kill`` message arrives, a byte is written to :attr:`read_fd`, which
+    can be registered with a selector alongside the grader's pipes.
+
+    If the channel layer cannot be reached, :attr:`available` is ``False`` and
+    callers should fall back to checking the database.
+
+    .. code-block:: python
+
+        with KillRequestListener(submission.control_group_name) as listener:
+            ...
+    """
+
+    def __init__(self, group_name: str):
+        self.group_name = group_name
+        self.read_fd, self._write_fd = os.pipe()
+        os.set_blocking(self.read_fd, False)
+
+        self.available = False
+
+        self._ready = threading.Event()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._task: asyncio.Task | None = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def __enter__(self) -> KillRequestListener:
+        self._thread.start()
+        if not self._ready.wait(LISTENER_STARTUP_TIMEOUT):
+            logger.warning("Timed out subscribing to %s", self.group_name)
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        self.close()
+
+    def trigger(self) -> None:
+        """Wake up anything selecting on :attr:`read_fd`."""
+        try:
+            os.write(self._write_fd, b"k")
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        if self._loop is not None and self._task is not None:
+            self._loop.call_soon_threadsafe(self._task.cancel)
+        self._thread.join(LISTENER_STARTUP_TIMEOUT)
+
+        for fd in (self.read_fd, self._write_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _run(self) -> None:
+        try:
+            asyncio.run(self._main())
+        except Exception:
+            logger.exception("Kill request listener for %s crashed", self.group_name)
+        finally:
+            self._ready.set()
+
+    async def _main(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+
+        channel_layer = get_channel_layer()
+        try:
+            channel_name = await channel_layer.new_channel()
+            await channel_layer.group_add(self.group_name, channel_name)
+        except Exception:
+            logger.exception("Could not subscribe to %s", self.group_name)
+            return
+
+        self.available = True
+        self._ready.set()
+
+        try:
+            while True:
+                message = await channel_layer.receive(channel_name)
+                if message.get("type") == "grader.kill":
+                    self.trigger()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.available = False
+            try:
+                await channel_layer.group_discard(self.group_name, channel_name)
+            except Exception:
+                logger.exception("Could not unsubscribe from %s", self.group_name)
+
+
+class ThrottledFlusher:
+    """Coalesces frequent updates into at most ``max_per_second`` flushes per second.
+
+    Call :meth:`mark_dirty` whenever there is something new to flush. Nothing is
+    flushed if nothing changed since the last flush.
+
+    .. code-block:: pycon
+
+        >>> flushes = []
+        >>> flusher = ThrottledFlusher(lambda: flushes.append(1), max_per_second=1)
+        >>> flusher.mark_dirty()
+        >>> flusher.maybe_flush(now=100)
+        >>> flusher.mark_dirty()
+        >>> flusher.maybe_flush(now=100.5)
+        >>> flusher.deadline()
+        101.0
+        >>> flusher.flush()
+        >>> flusher.flush()
+        >>> len(flushes)
+        2
+
+    Args:
+        flush: Called to flush the pending updates.
+        max_per_second: The maximum number of flushes per second. If this is 0,
+            updates are only flushed when :meth:`flush` is called explicitly.
+    """
+
+    def __init__(self, flush: Callable[[], None], *, max_per_second: float):
+        self._flush = flush
+        self.interval = 1 / max_per_second if max_per_second > 0 else None
+        self.dirty = False
+        self.last_flush = float("-inf")
+
+    def mark_dirty(self) -> None:
+        self.dirty = True
+
+    def deadline(self) -> float | None:
+        """The earliest time the pending updates may be flushed, if there are any."""
+        if not self.dirty or self.interval is None:
+            return None
+        return self.last_flush + self.interval
+
+    def maybe_flush(self, now: float | None = None) -> None:
+        """Flush if there are pending updates and enough time has passed."""
+        deadline = self.deadline()
+        if now is None:
+            now = time.monotonic()
+        if deadline is not None and now >= deadline:
+            self.flush(now)
+
+    def flush(self, now: float | None = None) -> None:
+        """Flush the pending updates (if any) regardless of when the last flush was."""
+        if self.dirty:
+            self.dirty = False
+            self.last_flush = time.monotonic() if now is None else now
+            self._flush()
+
+
+class GraderSupervisor:
+    """Supervises a grader process until it exits, is killed, or times out.
+
+    Args:
+        proc: The grader process. Its stdout and stderr must be unbuffered pipes.
+        timeout: The number of seconds the grader may run for, or ``None`` for no limit.
+        on_output: Called with ``("stdout" | "stderr", data)`` whenever output is read.
+        kill_fd: A file descriptor that becomes readable when the grader should be killed.
+        kill_check: A fallback used only if ``kill_fd`` is not given. It is called every
+            ``kill_check_interval`` seconds and should return ``True`` if the grader
+            should be killed.
+        kill_check_interval: How often to call ``kill_check``.
+        flusher: If given, it is marked dirty whenever output is read, and is flushed
+            as often as it allows while the grader runs.
+    """
+
+    READ_SIZE = 8192
+
+    def __init__(
+        self,
+        proc: subprocess.Popen,
+        *,
+        timeout: float | None,
+        on_output: Callable[[str, bytes], None],
+        kill_fd: int | None = None,
+        kill_check: Callable[[], bool] | None = None,
+        kill_check_interval: float = 15,
+        flusher: ThrottledFlusher | None = None,
+    ):
+        self.proc = proc
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.on_output = on_output
+        self.kill_fd = kill_fd
+        self.kill_check = kill_check
+        self.kill_check_interval = kill_check_interval
+        self.flusher = flusher
+
+    def run(self) -> SupervisorResult:
+        """Wait for something to happen to the grader.
+
+        This does not kill the grader; if the result is ``"killed"`` or ``"timed_out"``
+        it is up to the caller to do so.
+        """
+        pidfd = self._open_pidfd()
+
+        with selectors.DefaultSelector() as selector:
+            open_pipes = 0
+            for name, pipe in (("stdout", self.proc.stdout), ("stderr", self.proc.stderr)):
+                if pipe is not None:
+                    selector.register(pipe, selectors.EVENT_READ, name)
+                    open_pipes += 1
+            if pidfd is not None:
+                selector.register(pidfd, selectors.EVENT_READ, "exit")
+            if self.kill_fd is not None:
+                selector.register(self.kill_fd, selectors.EVENT_READ, "kill")
+
+            next_kill_check = time.monotonic()
+
+            try:
+                while True:
+                    now = time.monotonic()
+                    if self.deadline is not None and now >= self.deadline:
+                        return "timed_out"
+
+                    wake_times = [self.deadline]
+
+                    if self.kill_fd is None and self.kill_check is not None:
+                        if now >= next_kill_check:
+                            if self.kill_check():
+                                return "killed"
+                            next_kill_check = now + self.kill_check_interval
+                        wake_times.append(next_kill_check)
+
+                    if self.flusher is not None:
+                        self.flusher.maybe_flush(now)
+                        wake_times.append(self.flusher.deadline())
+
+                    if pidfd is None and open_pipes == 0:
+                        # Without a pidfd, the only way to notice the exit is to poll
+                        # the process itself (which does not touch the database).
+                        if self.proc.poll() is not None:
+                            return "exited"
+                        wake_times.append(now + 1)
+
+                    wake_times = [t for t in wake_times if t is not None]
+                    timeout = max(min(wake_times) - now, 0) if wake_times else None
+
+                    for key, _ in selector.select(timeout):
+                        if key.data == "kill":
+                            return "killed"
+                        elif key.data == "exit":
+                            self.proc.poll()
+                            return "exited"
+                        else:
+                            data = key.fileobj.read(self.READ_SIZE)
+                            if data:
+                                self.on_output(key.data, data)
+                                if self.flusher is not None:
+                                    self.flusher.mark_dirty()
+                            else:
+                                selector.unregister(key.fileobj)
+                                open_pipes -= 1
+            finally:
+                if pidfd is not None:
+                    os.close(pidfd)
+
+    def _open_pidfd(self) -> int | None:
+        if not hasattr(os, "pidfd_open"):
+            return None
+        try:
+            return os.pidfd_open(self.proc.pid)
+        except OSError:
+            return None
+
+
+async def supervise_grader(
+    proc: asyncio.subprocess.Process,
+    *,
+    timeout: float | None,
+    on_output: Callable[[str, bytes], None],
+    kill_request: Awaitable[object] | None = None,
+    kill: Callable[[], None] | None = None,
+) -> SupervisorResult:
+    """The asyncio counterpart of :class:`GraderSupervisor`.
+
+    Unlike :meth:`GraderSupervisor.run`, this kills the grader itself if it times
+    out or a kill is requested, and only returns once the grader has exited and
+    all of its output has been passed to ``on_output``.
+
+    Args:
+        proc: The grader process. Its stdout and stderr must be pipes.
+        timeout: The number of seconds the grader may run for, or ``None`` for no limit.
+        on_output: Called with ``("stdout" | "stderr", data)`` whenever output is read.
+        kill_request: Completes when the grader should be killed.
+        kill: Kills the grader. Defaults to :meth:`~asyncio.subprocess.Process.kill`.
+    """
+
+    async def pump(name: str, stream: asyncio.StreamReader) -> None:
+        while data := await stream.read(GraderSupervisor.READ_SIZE):
+            on_output(name, data)
+
+    async def finish() -> None:
+        await asyncio.gather(
+            *(
+                pump(name, stream)
+                for name, stream in (("stdout", proc.stdout), ("stderr", proc.stderr))
+                if stream is not None
+            )
+        )
+        await proc.wait()
+
+    finished = asyncio.ensure_future(finish())
+    waiters = {finished}
+    killer = None
+    if kill_request is not None:
+        killer = asyncio.ensure_future(kill_request)
+        waiters.add(killer)
+
+    try:
+        done, _ = await asyncio.wait(waiters, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+        if finished in done:
+            return "exited"
+
+        (kill or proc.kill)()
+        await finished
+        return "killed" if killer in done else "timed_out"
+    finally:
+        if killer is not None:
+            killer.cancel()
+        finished.cancel()
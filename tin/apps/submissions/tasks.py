@@ -3,275 +3,393 @@ from __future__ import annotations
 import logging
 import os
 import re
-import select
 import shutil
 import signal
 import subprocess
-import time
 import traceback
 from decimal import Decimal
 
 import psutil
-from asgiref.sync import async_to_sync
 from celery import shared_task
-from channels.layers import get_channel_layer
 from django.conf import settings
 from django.utils import timezone
 
 from ... import sandboxing
-from ...sandboxing import get_assignment_sandbox_args
+from ..safe_files import safe_remove_file, safe_write_file
+from .capture import OutputCapture
+from .grader_cache import apply_cached_result, cache_result, grader_cache_key
 from .models import Submission
+from .supervisor import GraderSupervisor, KillRequestListener, ThrottledFlusher
 
 logger = logging.getLogger(__name__)
 
+#: The fields of a submission that grading it sets
+GRADING_FIELDS = (
+    "complete",
+    "grader_pid",
+    "grader_output",
+    "grader_errors",
+    "points_received",
+    "has_been_graded",
+)
+
 
 def truncate_output(text, field_name):
     max_len = Submission._meta.get_field(field_name).max_length
     return ("..." + text[-max_len + 5 :]) if len(text) > max_len else text
 
 
-@shared_task
-def run_submission(submission_id):
-    submission = Submission.objects.get(id=submission_id)
+def make_output_capture(submission, field_name, stream_name) -> OutputCapture:
+    """Create an :class:`.OutputCapture` big enough for ``field_name``.
+
+    If ``settings.SAVE_FULL_GRADER_OUTPUT`` is set, the full stream is also saved
+    to :attr:`.Submission.full_output_dir`.
+    """
+    spill_path = None
+    if settings.SAVE_FULL_GRADER_OUTPUT:
+        spill_path = os.path.join(submission.full_output_dir, f"{stream_name}.gz")
+
+    return OutputCapture(Submission._meta.get_field(field_name).max_length, spill_path=spill_path)
+
+
+def output_stream_ends(submission, output, errors) -> dict[str, int]:
+    """Where the grader output and errors saved on a submission end in their streams.
+
+    Live updates use these to only send the output added since the last update (see
+    :class:`.SubmissionFeedConsumer`). Fields that weren't set from their
+    :class:`.OutputCapture` (e.g. after an internal error) are left out.
+    """
+    ends = {}
+    for field_name, capture in (("grader_output", output), ("grader_errors", errors)):
+        if capture is not None and getattr(submission, field_name) == capture.truncated_text(
+            capture.max_chars
+        ):
+            ends[field_name] = capture.total_chars
+    return ends
 
-    try:
-        grader_path = os.path.join(settings.MEDIA_ROOT, submission.assignment.grader_file.name)
-        grader_log_path = os.path.join(
-            settings.MEDIA_ROOT, submission.assignment.grader_log_filename
-        )
-        submission_path = submission.file_path
 
-        submission_wrapper_path = submission.wrapper_file_path
+def prepare_submission(submission) -> str:
+    """Write the submission and its wrapper script to disk.
 
-        args = get_assignment_sandbox_args(
-            ["mkdir", "-p", "--", os.path.dirname(submission_wrapper_path)],
-            network_access=False,
-            whitelist=[os.path.dirname(os.path.dirname(submission_wrapper_path))],
+    Returns:
+        The path to the Python executable the grader should be run with.
+
+    Raises:
+        OSError: If the wrapper could not be created.
+    """
+    submission_wrapper_path = submission.wrapper_file_path
+
+    submission.write_working_copy()
+
+    python_exe = (
+        os.path.join(submission.assignment.venv.path, "bin", "python")
+        if submission.assignment.venv_fully_created
+        else "/usr/bin/python3.10"
+    )
+
+    if not settings.DEBUG or shutil.which("bwrap") is not None:
+        folder_name = "sandboxed"
+    else:
+        folder_name = "testing"
+
+    with open(
+        os.path.join(
+            settings.BASE_DIR,
+            "sandboxing",
+            "wrappers",
+            folder_name,
+            f"{submission.assignment.language}.txt",
+        )
+    ) as wrapper_file:
+        wrapper_text = wrapper_file.read().format(
+            has_network_access=bool(submission.assignment.has_network_access),
+            venv_path=(
+                submission.assignment.venv.path
+                if submission.assignment.venv_fully_created
+                else None
+            ),
+            submission_path=submission.file_path,
+            python=python_exe,
         )
 
-        try:
-            subprocess.run(
-                args,
-                stdin=subprocess.DEVNULL,
-                stdout=subprocess.DEVNULL,
-                stderr=subprocess.PIPE,
-                text=True,
-                check=True,
-            )
-        except FileNotFoundError as e:
-            logger.error("Cannot run processes: %s", e)
-            raise FileNotFoundError from e
-
-        python_exe = (
-            os.path.join(submission.assignment.venv.path, "bin", "python")
-            if submission.assignment.venv_fully_created
-            else "/usr/bin/python3.10"
+    safe_write_file(settings.MEDIA_ROOT, submission_wrapper_path, wrapper_text, mode=0o700)
+
+    return python_exe
+
+
+def cleanup_submission(submission) -> None:
+    """Remove the files written by :func:`prepare_submission`."""
+    safe_remove_file(settings.MEDIA_ROOT, submission.wrapper_file_path)
+    submission.remove_working_copy()
+
+
+def save_grading_result(submission) -> None:
+    """Save the fields set by grading a submission.
+
+    The submission was loaded when grading started, so other fields (like
+    ``kill_requested``) may have been changed since. Those are left alone, and
+    ``kill_requested`` is reloaded so the final update reports it.
+    """
+    submission.save(update_fields=GRADING_FIELDS)
+    submission.refresh_from_db(fields=["kill_requested"])
+
+
+def set_setup_error(submission) -> None:
+    """Mark a submission whose wrapper could not be created as failed.
+
+    This must be called from an ``except`` block.
+    """
+    submission.grader_output = (
+        "An internal error occurred. Please try again.\n"
+        "If the problem persists, contact your teacher."
+    )
+    submission.grader_errors = truncate_output(
+        traceback.format_exc().replace("\0", ""), "grader_errors"
+    )
+    submission.complete = True
+
+
+def grader_command(submission, python_exe: str) -> tuple[list[str], dict[str, str], str]:
+    """Build the (sandboxed) command used to run the grader on a submission.
+
+    Returns:
+        A tuple of the arguments, the environment and the working directory.
+    """
+    grader_path = os.path.join(settings.MEDIA_ROOT, submission.assignment.grader_file.name)
+    grader_log_path = os.path.join(settings.MEDIA_ROOT, submission.assignment.grader_log_filename)
+    submission_path = submission.file_path
+    submission_wrapper_path = submission.wrapper_file_path
+
+    args = [
+        python_exe,
+        "-u",
+        grader_path,
+        submission_wrapper_path,
+        submission_path,
+        submission.student.username,
+        grader_log_path,
+    ]
+
+    if not settings.DEBUG or shutil.which("firejail") is not None:
+        whitelist = [os.path.dirname(grader_path)]
+        read_only = [grader_path, submission_path, os.path.dirname(submission_wrapper_path)]
+        if submission.assignment.venv_fully_created:
+            whitelist.append(submission.assignment.venv.path)
+            read_only.append(submission.assignment.venv.path)
+
+        args = sandboxing.get_assignment_sandbox_args(
+            args,
+            network_access=submission.assignment.grader_has_network_access,
+            direct_network_access=False,
+            whitelist=whitelist,
+            read_only=read_only,
         )
 
-        if not settings.DEBUG or shutil.which("bwrap") is not None:
-            folder_name = "sandboxed"
+    env = dict(os.environ)
+    if submission.assignment.venv_fully_created:
+        env.update(submission.assignment.venv.get_activation_env())
+
+    return args, env, os.path.dirname(grader_path)
+
+
+def grader_timeout(submission) -> float | None:
+    if submission.assignment.enable_grader_timeout:
+        return submission.assignment.grader_timeout
+    return None
+
+
+def kill_grader(pid: int) -> None:
+    """Kill a grader, its process group, and any children that escaped it."""
+    try:
+        children = psutil.Process(pid).children(recursive=True)
+    except psutil.NoSuchProcess:
+        children = []
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # Shouldn't happen, but just in case
+        try:
+            os.kill(pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+    for child in children:
+        try:
+            child.kill()
+        except psutil.NoSuchProcess:
+            pass
+
+
+def finish_output(
+    output: OutputCapture,
+    errors: OutputCapture,
+    *,
+    killed: bool,
+    timed_out: bool,
+    retcode: int | None,
+) -> None:
+    """Append the status messages (e.g. ``[Grader killed]``) and close the captures."""
+    if killed:
+        msg = "[Grader timed out]" if timed_out else "[Grader killed]"
+
+        if output and not output.endswith("\n"):
+            output.write("\n")
+        output.write(msg)
+
+        if errors and not errors.endswith("\n"):
+            errors.write("\n")
+        errors.write(msg)
+    elif retcode != 0:
+        if output and not output.endswith("\n"):
+            output.write("\n")
+        output.write("[Grader error]")
+
+        if errors and not errors.endswith("\n"):
+            errors.write("\n")
+        errors.write(f"[Grader exited with status {retcode}]")
+
+    output.close()
+    errors.close()
+
+
+def set_score_from_output(submission, output: OutputCapture) -> None:
+    """Grade the submission if the last line of the output is ``Score: <score>``."""
+    last_line = output.tail.splitlines()[-1]
+    match = re.search(r"^Score: ([\d.]+%?)$", last_line)
+    if match is not None:
+        score = match.group(1)
+        if score.endswith("%"):
+            score = submission.assignment.points_possible * Decimal(score[:-1]) / 100
         else:
-            folder_name = "testing"
-
-        with open(
-            os.path.join(
-                settings.BASE_DIR,
-                "sandboxing",
-                "wrappers",
-                folder_name,
-                f"{submission.assignment.language}.txt",
-            )
-        ) as wrapper_file:
-            wrapper_text = wrapper_file.read().format(
-                has_network_access=bool(submission.assignment.has_network_access),
-                venv_path=(
-                    submission.assignment.venv.path
-                    if submission.assignment.venv_fully_created
-                    else None
-                ),
-                submission_path=submission_path,
-                python=python_exe,
-            )
+            score = Decimal(score)
+        if abs(score) < 1000:
+            submission.points_received = score
+            submission.has_been_graded = True
+
+
+def set_internal_error(submission) -> None:
+    """Record the exception currently being handled as an internal error."""
+    submission.grader_output = "[Internal error]"
+    submission.grader_errors = truncate_output(
+        traceback.format_exc().replace("\0", ""), "grader_errors"
+    )
+
 
-        with open(submission_wrapper_path, "w", encoding="utf-8") as f_obj:
-            f_obj.write(wrapper_text)
+@shared_task
+def run_submission(submission_id):
+    if settings.ASYNC_GRADER_RUNNER:
+        # pylint: disable-next=import-outside-toplevel
+        from .runner import get_grader_runner
+
+        get_grader_runner().submit(submission_id)
+        return
+
+    submission = Submission.objects.get(id=submission_id)
 
-        os.chmod(submission_wrapper_path, 0o700)
+    cache_key = grader_cache_key(submission)
+    if cache_key is not None and apply_cached_result(submission, cache_key):
+        save_grading_result(submission)
+
+        submission.send_update()
+        return
+
+    try:
+        python_exe = prepare_submission(submission)
     except OSError:
-        submission.grader_output = (
-            "An internal error occurred. Please try again.\n"
-            "If the problem persists, contact your teacher."
-        )
-        submission.grader_errors = truncate_output(
-            traceback.format_exc().replace("\0", ""), "grader_errors"
-        )
-        submission.complete = True
-        submission.save()
+        set_setup_error(submission)
+        save_grading_result(submission)
+        cleanup_submission(submission)
 
-        async_to_sync(get_channel_layer().group_send)(
-            submission.channel_group_name, {"type": "submission.updated"}
-        )
+        submission.send_update()
         return
 
+    output = errors = None
     try:
         retcode = None
         killed = False
 
-        output = ""
-        errors = ""
-
-        args = [
-            python_exe,
-            "-u",
-            grader_path,
-            submission_wrapper_path,
-            submission_path,
-            submission.student.username,
-            grader_log_path,
-        ]
-
-        if not settings.DEBUG or shutil.which("firejail") is not None:
-            whitelist = [os.path.dirname(grader_path)]
-            read_only = [grader_path, submission_path, os.path.dirname(submission_wrapper_path)]
-            if submission.assignment.venv_fully_created:
-                whitelist.append(submission.assignment.venv.path)
-                read_only.append(submission.assignment.venv.path)
-
-            args = sandboxing.get_assignment_sandbox_args(
-                args,
-                network_access=submission.assignment.grader_has_network_access,
-                direct_network_access=False,
-                whitelist=whitelist,
-                read_only=read_only,
-            )
+        output = make_output_capture(submission, "grader_output", "stdout")
+        errors = make_output_capture(submission, "grader_errors", "stderr")
 
-        env = dict(os.environ)
-        if submission.assignment.venv_fully_created:
-            env.update(submission.assignment.venv.get_activation_env())
+        args, env, cwd = grader_command(submission, python_exe)
 
-        with subprocess.Popen(  # pylint: disable=subprocess-popen-preexec-fn
-            args,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            stdin=subprocess.DEVNULL,
-            bufsize=0,
-            cwd=os.path.dirname(grader_path),
-            preexec_fn=os.setpgrp,  # noqa: PLW1509
-            env=env,
-        ) as proc:
-            start_time = time.time()
+        def on_output(stream, data):
+            (output if stream == "stdout" else errors).feed(data)
+
+        def flush_output():
+            submission.grader_output = output.truncated_text(output.max_chars)
+            submission.grader_errors = errors.truncated_text(errors.max_chars)
+            submission.save(update_fields=["grader_output", "grader_errors"])
+
+            submission.send_update(output_stream_ends(submission, output, errors))
 
+        def kill_check():
+            return Submission.objects.filter(id=submission.id, kill_requested=True).exists()
+
+        with (
+            KillRequestListener(submission.control_group_name) as kill_listener,
+            subprocess.Popen(  # pylint: disable=subprocess-popen-preexec-fn
+                args,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.PIPE,
+                stdin=subprocess.DEVNULL,
+                bufsize=0,
+                cwd=cwd,
+                preexec_fn=os.setpgrp,  # noqa: PLW1509
+                env=env,
+            ) as proc,
+        ):
             submission.grader_pid = proc.pid
             submission.grader_start_time = timezone.localtime().timestamp()
-            submission.save()
-
-            timed_out = False
-
-            while proc.poll() is None:
-                submission.refresh_from_db()
-                submission.assignment.refresh_from_db()
-                if submission.assignment.enable_grader_timeout:
-                    time_elapsed = time.time() - start_time
-                    timeout = submission.assignment.grader_timeout - time_elapsed
-                    if timeout <= 0:
-                        timed_out = True
-                        break
-
-                    timeout = min(timeout, 15)
-                else:
-                    timeout = 15
-
-                if submission.kill_requested:
-                    break
-
-                files_ready = select.select([proc.stdout, proc.stderr], [], [], timeout)[0]
-                if proc.stdout in files_ready:
-                    output += proc.stdout.read(8192).decode()
-
-                if proc.stderr in files_ready:
-                    errors += proc.stderr.read(8192).decode()
-
-                submission.grader_output = truncate_output(
-                    output.replace("\0", ""), "grader_output"
-                )
-                submission.grader_errors = truncate_output(
-                    errors.replace("\0", ""), "grader_errors"
-                )
-                submission.save(update_fields=["grader_output", "grader_errors"])
-
-                async_to_sync(get_channel_layer().group_send)(
-                    submission.channel_group_name, {"type": "submission.updated"}
-                )
+            submission.save(update_fields=["grader_pid", "grader_start_time"])
+
+            # The kill may have been requested before we started listening for it
+            if kill_listener.available and kill_check():
+                kill_listener.trigger()
+
+            supervisor = GraderSupervisor(
+                proc,
+                timeout=grader_timeout(submission),
+                on_output=on_output,
+                kill_fd=kill_listener.read_fd if kill_listener.available else None,
+                kill_check=kill_check,
+                flusher=ThrottledFlusher(
+                    flush_output, max_per_second=settings.GRADER_OUTPUT_MAX_FLUSHES_PER_SECOND
+                ),
+            )
+            timed_out = supervisor.run() == "timed_out"
 
             if proc.poll() is None:
                 killed = True
+                kill_grader(proc.pid)
+
+            for data in iter(lambda: proc.stdout.read(GraderSupervisor.READ_SIZE), b""):
+                output.feed(data)
+            for data in iter(lambda: proc.stderr.read(GraderSupervisor.READ_SIZE), b""):
+                errors.feed(data)
 
-                children = psutil.Process(proc.pid).children(recursive=True)
-                try:
-                    os.killpg(proc.pid, signal.SIGKILL)
-                except ProcessLookupError:
-                    # Shouldn't happen, but just in case
-                    proc.kill()
-                for child in children:
-                    try:
-                        child.kill()
-                    except psutil.NoSuchProcess:
-                        pass
-
-            output += proc.stdout.read().decode()
-            errors += proc.stderr.read().decode()
-
-            if killed:
-                msg = "[Grader timed out]" if timed_out else "[Grader killed]"
-
-                if output and not output.endswith("\n"):
-                    output += "\n"
-                output += msg
-
-                if errors and not errors.endswith("\n"):
-                    errors += "\n"
-                errors += msg
-            else:
-                retcode = proc.poll()
-                if retcode != 0:
-                    if output and not output.endswith("\n"):
-                        output += "\n"
-                    output += "[Grader error]"
-
-                    if errors and not errors.endswith("\n"):
-                        errors += "\n"
-                    errors += f"[Grader exited with status {retcode}]"
-
-            submission.grader_output = truncate_output(output.replace("\0", ""), "grader_output")
-            submission.grader_errors = truncate_output(errors.replace("\0", ""), "grader_errors")
-            submission.save()
+            retcode = proc.wait()
+
+        finish_output(output, errors, killed=killed, timed_out=timed_out, retcode=retcode)
+
+        # This is saved (and the final notification sent) below
+        submission.grader_output = output.truncated_text(output.max_chars)
+        submission.grader_errors = errors.truncated_text(errors.max_chars)
     except Exception:  # pylint: disable=broad-except  # noqa: BLE001
-        submission.grader_output = "[Internal error]"
-        submission.grader_errors = truncate_output(
-            traceback.format_exc().replace("\0", ""), "grader_errors"
-        )
-        submission.save()
+        set_internal_error(submission)
     else:
         if output and not killed and retcode == 0:
-            last_line = output.splitlines()[-1]
-            match = re.search(r"^Score: ([\d.]+%?)$", last_line)
-            if match is not None:
-                score = match.group(1)
-                if score.endswith("%"):
-                    score = submission.assignment.points_possible * Decimal(score[:-1]) / 100
-                else:
-                    score = Decimal(score)
-                if abs(score) < 1000:
-                    submission.points_received = score
-                    submission.has_been_graded = True
+            set_score_from_output(submission, output)
+        if cache_key is not None and not killed and retcode == 0:
+            cache_result(submission, cache_key)
     finally:
+        for capture in (output, errors):
+            if capture is not None:
+                capture.close()
+
         submission.complete = True
         submission.grader_pid = None
-        submission.save()
+        save_grading_result(submission)
 
-        async_to_sync(get_channel_layer().group_send)(
-            submission.channel_group_name, {"type": "submission.updated"}
-        )
+        submission.send_update(output_stream_ends(submission, output, errors))
 
-        if os.path.exists(submission_wrapper_path):
-            os.remove(submission_wrapper_path)
+        cleanup_submission(submission)
@@ -1,12 +1,42 @@
 from __future__ import annotations
 
+import asyncio
+import gzip
+import importlib
+import io
+import os
+import subprocess
+import sys
+import threading
+import time
+from itertools import pairwise
 from typing import TYPE_CHECKING
 
 import pytest
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.apps import apps as django_apps
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import F
+from django.test.utils import CaptureQueriesContext
 from django.urls import reverse
 
 from tin.tests import is_redirect, login
 
+from ..safe_files import safe_write_file
+from . import runner
+from .capture import OutputCapture
+from .consumers import SubmissionFeedConsumer, SubmissionJsonConsumer
+from .forms import FilterForm
+from .grader_cache import apply_cached_result, cache_result, grader_cache_key
+from .models import GradebookEntry, Submission, SubmissionBlob
+from .runner import GraderRunner
+from .supervisor import GraderSupervisor, ThrottledFlusher, supervise_grader
+from .tasks import make_output_capture, output_stream_ends, save_grading_result
+
 if TYPE_CHECKING:
     from django.test import Client
 
@@ -53,3 +83,696 @@ def test_teacher_requests_kill(client: Client, submission: Submission):
     submission.refresh_from_db()
     assert is_redirect(response)
     assert submission.kill_requested
+
+
+@login("student")
+def test_kill_request_without_channel_layer(client: Client, settings, submission: Submission):
+    settings.CHANNEL_LAYERS = {
+        "default": {
+            "BACKEND": "channels_redis.core.RedisChannelLayer",
+            "CONFIG": {"hosts": [("localhost", 1)]},
+        }
+    }
+    response = client.post(reverse("submissions:kill", args=[submission.id]))
+    submission.refresh_from_db()
+    # The supervisor will find the request in the database instead
+    assert is_redirect(response)
+    assert submission.kill_requested
+
+
+def test_save_grading_result(submission: Submission):
+    # Loaded when grading started
+    graded = Submission.objects.get(id=submission.id)
+
+    submission.request_kill()
+    graded.grader_output = "[Grader killed]"
+    graded.complete = True
+    save_grading_result(graded)
+    # The kill request isn't overwritten, and is included in the final update
+    assert graded.kill_requested
+
+    submission.refresh_from_db()
+    assert submission.kill_requested
+    assert submission.complete
+    assert submission.grader_output == "[Grader killed]"
+
+
+@login("student")
+def test_show_json_etag(client: Client, submission: Submission, django_capture_on_commit_callbacks):
+    url = reverse("submissions:show_json", args=[submission.id])
+    response = client.get(url)
+    assert response.status_code == 200
+    etag = response["ETag"]
+
+    # Unchanged submissions aren't fetched again
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert not any("submissions_submission" in query["sql"] for query in queries)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        submission.grader_output = "Hello"
+        submission.save()
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.json()["grader_output"] == "Hello"
+    assert response["ETag"] != etag
+
+
+@login("admin")
+def test_timed_out_submissions_get_new_versions(
+    client: Client, submission: Submission, django_capture_on_commit_callbacks
+):
+    submission.assignment.enable_grader_timeout = True
+    submission.assignment.grader_timeout = 10
+    submission.assignment.save()
+    submission.grader_start_time = time.time() - 60
+    submission.save()
+
+    url = reverse("submissions:show_json", args=[submission.id])
+    etag = client.get(url)["ETag"]
+
+    with django_capture_on_commit_callbacks(execute=True):
+        client.post(reverse("submissions:set_past_timeout_complete"))
+
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert response.json()["complete"]
+
+
+@login("student")
+def test_show_json_long_poll(client: Client, settings, submission: Submission):
+    settings.SUBMISSION_JSON_MAX_WAIT = 0.2
+    settings.SUBMISSION_JSON_WAIT_INTERVAL = 0.05
+    url = reverse("submissions:show_json", args=[submission.id])
+    etag = client.get(url)["ETag"]
+
+    start = time.monotonic()
+    response = client.get(url, {"wait": 10}, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert 0.2 <= time.monotonic() - start < 5
+
+    # Other users can't reuse the ETag
+    client.force_login(submission.assignment.course.teacher.first())
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+
+@pytest.mark.django_db(transaction=True)
+@pytest.mark.parametrize("viewer", ("student", "teacher"))
+def test_submission_consumer_forwards_updates(request, submission: Submission, viewer):
+    user = request.getfixturevalue(viewer)
+
+    async def watch():
+        communicator = WebsocketCommunicator(
+            SubmissionJsonConsumer.as_asgi(), f"/submissions/{submission.id}.json"
+        )
+        communicator.scope["user"] = user
+        communicator.scope["url_route"] = {"kwargs": {"submission_id": submission.id}}
+        connected, _ = await communicator.connect()
+        assert connected
+        await communicator.receive_json_from()
+
+        # The update's info is passed on as-is, without fetching the submission
+        submission.grader_output = "Hello"
+        submission.grader_errors = "Oops"
+        await get_channel_layer().group_send(
+            submission.channel_group_name, submission.get_update_event()
+        )
+        info = await communicator.receive_json_from()
+        await communicator.disconnect()
+        return info
+
+    info = async_to_sync(watch)()
+    assert info["grader_output"] == "Hello"
+    assert ("grader_errors" in info) is (viewer == "teacher")
+
+
+@pytest.mark.django_db(transaction=True)
+def test_submission_consumer_rejects_other_students(submission: Submission, django_user_model):
+    outsider = django_user_model.objects.create(username="outsider", is_student=True)
+
+    async def watch():
+        communicator = WebsocketCommunicator(
+            SubmissionJsonConsumer.as_asgi(), f"/submissions/{submission.id}.json"
+        )
+        communicator.scope["user"] = outsider
+        communicator.scope["url_route"] = {"kwargs": {"submission_id": submission.id}}
+        connected, _ = await communicator.connect()
+        return connected
+
+    assert not async_to_sync(watch)()
+
+
+async def send_update(submission: Submission) -> None:
+    for group in submission.update_group_names:
+        await get_channel_layer().group_send(group, submission.get_update_event())
+
+
+def feed_communicator(user) -> WebsocketCommunicator:
+    communicator = WebsocketCommunicator(SubmissionFeedConsumer.as_asgi(), "/submissions/feed.json")
+    communicator.scope["user"] = user
+    return communicator
+
+
+@pytest.mark.django_db(transaction=True)
+def test_submission_feed_sends_changes(settings, submission: Submission, student, course):
+    settings.SUBMISSION_FEED_BATCH_INTERVAL = 0
+    other = course.assignments.first().submissions.create(
+        student=course.students.create(username="other", is_student=True)
+    )
+
+    async def watch():
+        communicator = feed_communicator(student)
+        connected, _ = await communicator.connect()
+        assert connected
+
+        # Students can only subscribe to their own submissions
+        await communicator.send_json_to(
+            {"type": "subscribe", "submissions": [submission.id, other.id]}
+        )
+        snapshot = await communicator.receive_json_from()
+
+        submission.grader_output = "Hello"
+        await send_update(submission)
+        await send_update(other)
+        update = await communicator.receive_json_from()
+        assert await communicator.receive_nothing()
+        await communicator.disconnect()
+        return snapshot, update
+
+    snapshot, update = async_to_sync(watch)()
+    assert snapshot["type"] == "updates"
+    assert set(snapshot["submissions"]) == {str(submission.id)}
+    assert "grader_errors" not in snapshot["submissions"][str(submission.id)]
+    # Only what changed is sent
+    assert update["submissions"] == {
+        str(submission.id): {"grader_output": "Hello", "grader_output_end": None}
+    }
+
+
+@pytest.mark.django_db(transaction=True)
+def test_submission_feed_appends_output(settings, submission: Submission, student):
+    settings.SUBMISSION_FEED_BATCH_INTERVAL = 0
+    max_chars = Submission._meta.get_field("grader_output").max_length
+    output = OutputCapture(max_chars)
+
+    async def update(data: bytes) -> dict:
+        output.feed(data)
+        submission.grader_output = output.truncated_text(max_chars)
+        await send_update_with_ends(submission, {"grader_output": output.total_chars})
+        message = await communicator.receive_json_from()
+        return message["submissions"][str(submission.id)]
+
+    async def send_update_with_ends(sub, stream_ends):
+        for group in sub.update_group_names:
+            await get_channel_layer().group_send(group, sub.get_update_event(stream_ends))
+
+    async def watch():
+        connected, _ = await communicator.connect()
+        assert connected
+        await communicator.send_json_to({"type": "subscribe", "submissions": [submission.id]})
+        await communicator.receive_json_from()
+
+        updates = [await update(b"Hello"), await update(b" world")]
+        # Once the start of the output is truncated past what the browser has,
+        # the full output is sent again
+        updates.append(await update(b"x" * max_chars))
+        updates.append(await update(b"!"))
+        await communicator.disconnect()
+        return updates
+
+    communicator = feed_communicator(student)
+    first, second, resync, last = async_to_sync(watch)()
+    # The snapshot didn't say where the output ends, so it's sent in full once
+    assert first == {"grader_output": "Hello", "grader_output_end": 5}
+    assert second == {"grader_output_append": {"from": 5, "to": 11, "text": " world"}}
+    assert resync["grader_output"].startswith("...")
+    assert resync["grader_output_end"] == max_chars + 11
+    assert last == {
+        "grader_output_append": {"from": max_chars + 11, "to": max_chars + 12, "text": "!"}
+    }
+
+
+@pytest.mark.django_db(transaction=True)
+def test_submission_feed_assignment_subscription(
+    settings, submission: Submission, teacher, student, course
+):
+    settings.SUBMISSION_FEED_BATCH_INTERVAL = 0
+    period = course.period_set.create(name="Period 1")
+    period.students.add(student)
+    other = submission.assignment.submissions.create(
+        student=course.students.create(username="other", is_student=True)
+    )
+
+    async def watch(user, subscription):
+        communicator = feed_communicator(user)
+        await communicator.connect()
+        await communicator.send_json_to(
+            {"type": "subscribe", "submissions": [submission.id], **subscription}
+        )
+        first = await communicator.receive_json_from()
+        await send_update(submission)
+        await send_update(other)
+        updates = dict(first.get("submissions", {}))
+        while not await communicator.receive_nothing():
+            message = await communicator.receive_json_from()
+            updates.update(message["submissions"])
+        await communicator.disconnect()
+        return first, updates
+
+    _, updates = async_to_sync(watch)(teacher, {"assignment": submission.assignment_id})
+    assert set(updates) == {str(submission.id), str(other.id)}
+    assert "grader_errors" in updates[str(submission.id)]
+
+    _, updates = async_to_sync(watch)(
+        teacher, {"assignment": submission.assignment_id, "period": period.id}
+    )
+    assert set(updates) == {str(submission.id)}
+
+    # Only teachers can subscribe to an assignment
+    first, updates = async_to_sync(watch)(student, {"assignment": submission.assignment_id})
+    assert first["type"] == "error"
+    assert not updates
+
+
+def test_identical_submissions_share_a_blob(
+    assignment, student, submission: Submission, django_capture_on_commit_callbacks
+):
+    other = assignment.submissions.create(student=student)
+    other.save_file("print('Hello World!')")
+
+    assert other.blob == submission.blob
+    assert submission.blob.ref_count == 2
+    assert other.file_text == "print('Hello World!')"
+    assert not os.path.exists(other.file_path)
+
+    blob = submission.blob
+    with django_capture_on_commit_callbacks(execute=True):
+        submission.delete()
+    assert os.path.exists(blob.path)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        other.delete()
+    assert not os.path.exists(blob.path)
+    assert not SubmissionBlob.objects.filter(id=blob.id).exists()
+
+
+def test_blob_file_is_repaired(assignment, student, submission: Submission):
+    blob = submission.blob
+    with open(blob.path, "wb") as f:
+        f.write(b"print(")
+
+    other = assignment.submissions.create(student=student)
+    other.save_file("print('Hello World!')")
+    assert other.blob == blob
+    assert other.file_text == "print('Hello World!')"
+
+
+def test_blob_release_rolled_back(submission: Submission, django_capture_on_commit_callbacks):
+    blob = submission.blob
+    submission.blob = None
+    submission.save()
+
+    with django_capture_on_commit_callbacks(execute=True), transaction.atomic():
+        SubmissionBlob.objects.release(blob.id)
+        transaction.set_rollback(True)
+    assert SubmissionBlob.objects.filter(id=blob.id).exists()
+    assert os.path.exists(blob.path)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        SubmissionBlob.objects.release(blob.id)
+    assert not os.path.exists(blob.path)
+
+
+def test_grader_cache(assignment, student, submission: Submission):
+    assignment.save_grader_file("print('Score: 100%')")
+    assert grader_cache_key(submission) is None
+
+    assignment.cache_grader_results = True
+    assignment.save()
+    key = grader_cache_key(submission)
+    assert key is not None
+    assert not apply_cached_result(submission, key)
+
+    submission.grader_output = "Score: 100%"
+    submission.points_received = assignment.points_possible
+    submission.has_been_graded = True
+    cache_result(submission, key)
+
+    other = assignment.submissions.create(student=student)
+    other.save_file("print('Hello World!')")
+    assert grader_cache_key(other) == key
+    assert apply_cached_result(other, key)
+    assert other.complete
+    assert other.has_been_graded
+    assert other.points_received == 300
+
+    # The student's username is passed to the grader, so it's part of the key
+    classmate = assignment.submissions.create(
+        student=assignment.course.students.create(username="classmate", is_student=True)
+    )
+    classmate.save_file("print('Hello World!')")
+    assert grader_cache_key(classmate) != key
+
+    # Changing the grader or the assignment's files invalidates the cache
+    assignment.save_file("data", "data.txt")
+    assert grader_cache_key(submission) != key
+    assignment.save_grader_file("print('Score: 50%')")
+    assert not assignment.cached_grader_results.exists()
+
+
+def test_gradebook_is_kept_up_to_date(assignment, student, teacher, submission: Submission):
+    entry = GradebookEntry.objects.get(assignment=assignment, student=student)
+    assert entry.latest_submission == submission
+    assert entry.published_submission is None
+    assert entry.points is None
+
+    submission.points_received = 200
+    submission.has_been_graded = True
+    submission.complete = True
+    submission.save()
+    submission.comments.create(
+        author=teacher, start_char=0, end_char=1, text="Nice", point_override=10
+    )
+    entry.refresh_from_db()
+    assert entry.points_received == 200
+    assert entry.points == 210
+    assert entry.has_been_graded
+    assert entry.complete
+
+    newer = assignment.submissions.create(student=student)
+    entry.refresh_from_db()
+    assert entry.graded_submission == newer
+    assert entry.points is None
+
+    submission.publish()
+    entry.refresh_from_db()
+    assert entry.latest_submission == newer
+    assert entry.graded_submission == submission
+    assert entry.points == 210
+
+    submission.unpublish()
+    newer.delete()
+    entry.refresh_from_db()
+    assert entry.published_submission is None
+    assert entry.latest_submission == submission
+
+    submission.delete()
+    assert not GradebookEntry.objects.filter(id=entry.id).exists()
+
+
+def test_rebuild_gradebook(assignment, student, submission: Submission):
+    submission.points_received = 150
+    submission.save()
+    expected = GradebookEntry.objects.get(assignment=assignment, student=student)
+    GradebookEntry.objects.all().delete()
+
+    call_command("rebuild_gradebook", stdout=io.StringIO())
+
+    entry = GradebookEntry.objects.get(assignment=assignment, student=student)
+    assert entry.latest_submission == expected.latest_submission
+    assert entry.points == expected.points == 150
+
+
+def test_deleting_an_assignment_deletes_its_gradebook(assignment, submission: Submission):
+    submission.publish()
+    assignment.delete()
+    assert not GradebookEntry.objects.exists()
+
+
+@pytest.mark.parametrize(
+    ("filters", "expected"),
+    (
+        ({"is_latest": True}, {"latest"}),
+        ({"is_published": True}, {"published"}),
+        ({"is_latest_publish": True}, {"latest", "published"}),
+        ({}, {"old", "published", "latest"}),
+    ),
+)
+def test_filter_form_latest_and_published(assignment, student, filters, expected):
+    submissions = {
+        name: assignment.submissions.create(student=student)
+        for name in ("old", "published", "latest")
+    }
+    submissions["published"].publish()
+
+    form = FilterForm({"limit": 100, **filters})
+    assert form.is_valid(), form.errors
+    with CaptureQueriesContext(connection) as queries:
+        results = set(form.get_results())
+    assert len(queries) == 1
+    assert results == {submissions[name] for name in expected}
+
+
+@login("admin")
+def test_filter_view_code_is_paginated(client, settings, assignment, student):
+    settings.FILTER_VIEW_CODE_PAGE_SIZE = 2
+    for i in range(5):
+        assignment.submissions.create(student=student).save_file(f"print({i})")
+
+    data = {"limit": 100, "view_code": "View code for each submission"}
+    response = client.post(reverse("submissions:filter"), data)
+    assert [text for _, text in response.context["submissions"]] == ["print(0)", "print(1)"]
+
+    response = client.post(f"{reverse('submissions:filter')}?page=3", data)
+    assert [text for _, text in response.context["submissions"]] == ["print(4)"]
+    assert response.context["page"].paginator.count == 5
+
+
+def test_submission_numbers(assignment, student, submission: Submission):
+    second = assignment.submissions.create(student=student)
+    other_assignment = assignment.course.assignments.create(
+        name="Other", points_possible=10, due=assignment.due
+    ).submissions.create(student=student)
+    assert (submission.number, second.number, other_assignment.number) == (1, 2, 1)
+
+    # The backfill numbers existing submissions in the order they were created
+    Submission.objects.update(number=F("id") + 1000)
+    number_submissions = importlib.import_module(
+        "tin.apps.submissions.migrations.0027_submission_number"
+    ).number_submissions
+    number_submissions(django_apps, None)
+    assert list(assignment.submissions.order_by("id").values_list("number", flat=True)) == [1, 2]
+
+
+def test_working_copy(submission: Submission):
+    submission.write_working_copy()
+    with open(submission.file_path, encoding="utf-8") as f:
+        assert f.read() == "print('Hello World!')"
+
+    submission.remove_working_copy()
+    assert not os.path.exists(submission.file_path)
+    assert os.path.exists(submission.blob.path)
+
+
+def test_working_copy_shared_by_runs(submission: Submission):
+    submission.write_working_copy()
+    submission.write_working_copy()
+    # The count of runs isn't lost along with the cache
+    cache.clear()
+
+    # Still used by the other run
+    submission.remove_working_copy()
+    assert os.path.exists(submission.file_path)
+
+    submission.remove_working_copy()
+    assert not os.path.exists(submission.file_path)
+
+
+def _grader_process(code: str) -> subprocess.Popen:
+    return subprocess.Popen(
+        [sys.executable, "-u", "-c", code],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
+        bufsize=0,
+    )
+
+
+def test_supervisor_collects_output_until_exit():
+    chunks = []
+    with _grader_process("print('Score: 100%')") as proc:
+        result = GraderSupervisor(
+            proc, timeout=10, on_output=lambda stream, data: chunks.append((stream, data))
+        ).run()
+        remaining = proc.stdout.read()
+
+    assert result == "exited"
+    output = b"".join(data for stream, data in chunks if stream == "stdout") + remaining
+    assert output == b"Score: 100%\n"
+
+
+def test_supervisor_times_out():
+    with _grader_process("import time; time.sleep(30)") as proc:
+        start = time.monotonic()
+        result = GraderSupervisor(proc, timeout=0.5, on_output=lambda *_: None).run()
+        proc.kill()
+
+    assert result == "timed_out"
+    assert time.monotonic() - start < 10
+
+
+def test_supervisor_reacts_to_kill_fd():
+    read_fd, write_fd = os.pipe()
+    try:
+        with _grader_process("import time; time.sleep(30)") as proc:
+            os.write(write_fd, b"k")
+            result = GraderSupervisor(
+                proc, timeout=None, on_output=lambda *_: None, kill_fd=read_fd
+            ).run()
+            proc.kill()
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+    assert result == "killed"
+
+
+def test_supervisor_throttles_flushes():
+    flushes = []
+    flusher = ThrottledFlusher(lambda: flushes.append(time.monotonic()), max_per_second=4)
+    code = "import time\nfor _ in range(200):\n    print('x')\n    time.sleep(0.005)"
+    start = time.monotonic()
+    with _grader_process(code) as proc:
+        result = GraderSupervisor(
+            proc, timeout=None, on_output=lambda *_: None, flusher=flusher
+        ).run()
+    flusher.flush()
+
+    assert result == "exited"
+    # The grader prints 200 lines, but they should be coalesced into a few flushes
+    assert 1 <= len(flushes) <= (time.monotonic() - start) * 4 + 2
+    assert all(b - a >= 0.25 for a, b in pairwise(flushes[:-1]))
+
+
+async def _supervise_async(code: str, **kwargs) -> tuple[str, bytes]:
+    chunks = []
+    proc = await asyncio.create_subprocess_exec(
+        sys.executable,
+        "-u",
+        "-c",
+        code,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        stdin=subprocess.DEVNULL,
+    )
+    result = await supervise_grader(
+        proc, on_output=lambda stream, data: chunks.append(data), **kwargs
+    )
+    assert proc.returncode is not None
+    return result, b"".join(chunks)
+
+
+def test_supervise_grader_collects_output_until_exit():
+    result, output = asyncio.run(
+        _supervise_async(
+            "import sys; print('Score: 100%'); print('x', file=sys.stderr)", timeout=30
+        )
+    )
+
+    assert result == "exited"
+    assert b"Score: 100%" in output
+    assert b"x" in output
+
+
+def test_supervise_grader_times_out():
+    start = time.monotonic()
+    result, output = asyncio.run(
+        # Long enough for the grader to start even when the tests are run in parallel
+        _supervise_async("import time; print('hi'); time.sleep(60)", timeout=3)
+    )
+
+    assert result == "timed_out"
+    assert output == b"hi\n"
+    assert time.monotonic() - start < 20
+
+
+def test_supervise_grader_reacts_to_kill_request():
+    async def main():
+        kill_request = asyncio.Event()
+        asyncio.get_running_loop().call_later(0.2, kill_request.set)
+        return await _supervise_async(
+            "import time; time.sleep(30)", timeout=None, kill_request=kill_request.wait()
+        )
+
+    result, _ = asyncio.run(main())
+    assert result == "killed"
+
+
+def test_safe_write_file_replaces_symlinks(tmp_path):
+    outside = tmp_path / "outside.txt"
+    outside.write_text("secret")
+    root = tmp_path / "media"
+    (root / "assignment-1").mkdir(parents=True)
+    (root / "assignment-1" / "submission.py").symlink_to(outside)
+
+    safe_write_file(str(root), "assignment-1/submission.py", "print('hi')")
+
+    assert outside.read_text() == "secret"
+    assert not (root / "assignment-1" / "submission.py").is_symlink()
+    assert (root / "assignment-1" / "submission.py").read_text() == "print('hi')"
+    assert os.listdir(root / "assignment-1") == ["submission.py"]
+
+    with pytest.raises(ValueError, match="not inside"):
+        safe_write_file(str(root), "../outside.txt", "oops")
+    assert outside.read_text() == "secret"
+
+
+def test_output_capture_is_bounded():
+    capture = OutputCapture(max_chars=100)
+    for _ in range(10_000):
+        capture.feed(b"x" * 1000)
+    capture.close()
+
+    assert capture.total_chars == 10_000_000
+    assert capture.truncated
+    assert len(capture.tail) == 100
+    assert len(capture.truncated_text(100)) <= 100
+
+
+def test_output_capture_decodes_split_characters_and_spills(tmp_path):
+    data = "snowman: ☃\0\n".encode() * 3
+    spill_path = tmp_path / "output" / "stdout.gz"
+    with OutputCapture(max_chars=1024, spill_path=str(spill_path)) as capture:
+        for i in range(len(data)):
+            capture.feed(data[i : i + 1])
+
+    assert capture.tail == "snowman: ☃\n" * 3
+    assert gzip.decompress(spill_path.read_bytes()) == data
+
+
+def test_output_stream_ends(submission: Submission):
+    output = make_output_capture(submission, "grader_output", "stdout")
+    errors = make_output_capture(submission, "grader_errors", "stderr")
+    output.feed(b"x" * 20_000)
+    errors.feed(b"Traceback")
+    submission.grader_output = output.truncated_text(output.max_chars)
+    submission.grader_errors = "[Internal error]"
+
+    # The errors weren't set from their capture
+    assert output_stream_ends(submission, output, errors) == {"grader_output": 20_000}
+
+
+def test_grader_runner_waits_for_a_slot(monkeypatch):
+    started = []
+    release = threading.Event()
+
+    async def run_submission_async(submission_id):
+        started.append(submission_id)
+        await asyncio.get_running_loop().run_in_executor(None, release.wait)
+
+    monkeypatch.setattr(runner, "run_submission_async", run_submission_async)
+    grader_runner = GraderRunner(max_graders=1)
+    grader_runner.submit(1)
+
+    # The second submission isn't taken until the first one finishes
+    thread = threading.Thread(target=grader_runner.submit, args=(2,))
+    thread.start()
+    thread.join(0.2)
+    assert thread.is_alive()
+
+    release.set()
+    thread.join(5)
+    assert not thread.is_alive()
+    grader_runner.shutdown()
+    assert started == [1, 2]
@@ -1,15 +1,41 @@
 from __future__ import annotations
 
+import concurrent.futures
+from collections.abc import Sequence
 from decimal import Decimal
 
+from django.conf import settings
+
 
 def decimal_repr(d: Decimal) -> Decimal:
     return d.quantize(Decimal(1)) if d == d.to_integral() else d.normalize()
 
 
-def serialize_submission_info(submission, user) -> dict[str, float | str | bool | None]:
+def format_grade(points: Decimal, points_possible: Decimal) -> str:
+    """Format a grade like ``"150 / 300 (50.00%)"``.
+
+    .. code-block:: pycon
+
+        >>> format_grade(Decimal("150.000"), Decimal("300"))
+        '150 / 300 (50.00%)'
+    """
+    return (
+        f"{decimal_repr(points)} / {decimal_repr(points_possible)} "
+        f"({points / points_possible:.2%})"
+    )
+
+
+def serialize_submission_info(submission, user=None) -> dict[str, float | str | bool | None]:
+    """Serialize what the submission pages show about a submission while it runs.
+
+    Args:
+        submission: The :class:`.Submission`
+        user: The user it's being shown to, if any. Fields they aren't allowed to
+            see are left out (see :func:`filter_submission_info`).
+    """
     data = {
         "grader_output": submission.grader_output,
+        "grader_errors": submission.grader_errors,
         "has_been_graded": submission.has_been_graded,
         "complete": submission.complete,
         "kill_requested": submission.kill_requested,
@@ -28,7 +54,69 @@ def serialize_submission_info(submission, user) -> dict[str, float | str | bool
         "formatted_grade": submission.formatted_grade,
     }
 
-    if user.is_teacher or user.is_superuser:
-        data["grader_errors"] = submission.grader_errors
+    if user is not None:
+        data = filter_submission_info(data, user)
 
     return data
+
+
+def filter_submission_info(data: dict, user) -> dict:
+    """Remove the parts of :func:`serialize_submission_info` a user can't see.
+
+    Only teachers and admins can see grader errors.
+    """
+    if user.is_teacher or user.is_superuser:
+        return data
+    return {key: value for key, value in data.items() if key != "grader_errors"}
+
+
+def get_appended_output(text: str, end: int | None, previous_end: int | None) -> str | None:
+    """Get the grader output added since the output stream ended at ``previous_end``.
+
+    Args:
+        text: The output shown on the submission, which may be truncated to the
+            end of the stream (with its start replaced with ``...``)
+        end: The position in the stream (in characters) where ``text`` ends
+        previous_end: The position where the output seen before ended
+
+    Returns:
+        The text added since then, or ``None`` if it isn't known (e.g. because
+        the part of the stream after ``previous_end`` was truncated away).
+
+    .. code-block:: pycon
+
+        >>> get_appended_output("Hello world", 11, 5)
+        ' world'
+        >>> get_appended_output("...o world", 40, 35)
+        'world'
+        >>> get_appended_output("...o world", 40, 20) is None
+        True
+    """
+    if end is None or previous_end is None or previous_end > end:
+        return None
+    if end == len(text):
+        window = text
+    elif text.startswith("..."):
+        window = text[3:]
+    else:
+        return None
+
+    start = end - len(window)
+    if previous_end < start:
+        return None
+    return window[previous_end - start :]
+
+
+def read_file_texts(submissions: Sequence) -> list[str | None]:
+    """Read the :attr:`~.Submission.file_text` of several submissions in parallel.
+
+    Files are read by up to ``settings.SUBMISSION_FILE_READ_THREADS`` threads. The
+    submissions' blobs should already be fetched (e.g. with ``select_related``),
+    since the threads shouldn't query the database.
+    """
+    if not submissions:
+        return []
+
+    max_threads = min(settings.SUBMISSION_FILE_READ_THREADS, len(submissions))
+    with concurrent.futures.ThreadPoolExecutor(max_threads) as executor:
+        return list(executor.map(lambda submission: submission.file_text, submissions))
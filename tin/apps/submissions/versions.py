@@ -0,0 +1,44 @@
+"""Versions of what :func:`.serialize_submission_info` returns for each submission.
+
+Pages that can't use WebSockets poll :func:`.show_json_view` for each running
+submission. To make polls for submissions that haven't changed cheap, each
+submission has a version in the cache, which is replaced whenever the submission
+(or anything else its info depends on) changes (see :mod:`.signals`). Versions
+are random, so one that's forgotten (e.g. because the cache was cleared) won't be
+confused with an old one.
+"""
+
+from __future__ import annotations
+
+from django.core.cache import cache
+from django.db import transaction
+from django.utils.crypto import get_random_string
+
+#: How long (in seconds) a version is kept for. If it expires, the submission's
+#: info is sent again on the next poll.
+VERSION_TIMEOUT = 24 * 60 * 60
+
+
+def _cache_key(submission_id: int) -> str:
+    return f"submission-version-{submission_id}"
+
+
+def get_submission_version(submission_id: int) -> str:
+    """Get the current version of a submission's info.
+
+    This should be read before the submission is, so that changes made in between
+    aren't missed.
+    """
+    key = _cache_key(submission_id)
+    version = cache.get(key)
+    if version is None:
+        version = get_random_string(12)
+        if not cache.add(key, version, VERSION_TIMEOUT):
+            version = cache.get(key, version)
+    return version
+
+
+def forget_submission_versions(*submission_ids: int) -> None:
+    """Give some submissions new versions once the current transaction commits."""
+    keys = [_cache_key(submission_id) for submission_id in submission_ids]
+    transaction.on_commit(lambda: cache.delete_many(keys))
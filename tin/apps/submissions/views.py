@@ -1,16 +1,25 @@
 from __future__ import annotations
 
+import time
+
 import psutil
 from django import http
+from django.conf import settings
+from django.core.paginator import Paginator
+from django.db import transaction
 from django.db.models import F, Q
 from django.shortcuts import get_object_or_404, redirect, render
 from django.utils import timezone
-from django.utils.http import url_has_allowed_host_and_scheme
+from django.utils.cache import patch_cache_control
+from django.utils.crypto import salted_hmac
+from django.utils.http import parse_etags, quote_etag, url_has_allowed_host_and_scheme
 
 from ..auth.decorators import login_required, superuser_required, teacher_or_superuser_required
 from .forms import CommentForm, FilterForm
+from .gradebook import refresh_gradebook_entries_for_submissions
 from .models import Comment, Submission
-from .utils import serialize_submission_info
+from .utils import read_file_texts, serialize_submission_info
+from .versions import forget_submission_versions, get_submission_version
 
 # Create your views here.
 
@@ -31,20 +40,17 @@ def show_view(request, submission_id):
         student=submission.student, assignment=submission.assignment
     )
 
-    before_submissions = submissions.filter(id__lt=submission.id)
-    submission_number = before_submissions.count() + 1
-
     context = {
         "course": submission.assignment.course,
         "folder": submission.assignment.folder,
         "assignment": submission.assignment,
         "submission": submission,
-        "submission_number": submission_number,
+        "submission_number": submission.number,
         "submission_text": submission.file_text,
         "submission_comments": submission.comments.all(),
         "submissions": submissions.order_by("-date_submitted"),
         "is_student": submission.assignment.course.is_student_in_course(request.user),
-        "is_teacher": request.user in submission.assignment.course.teacher.all(),
+        "is_teacher": submission.assignment.course.is_teacher_in_course(request.user),
     }
 
     if request.user.is_teacher or request.user.is_superuser:
@@ -53,20 +59,60 @@ def show_view(request, submission_id):
     return render(request, "submissions/show.html", context)
 
 
+def _info_etag(user, submission_id: int, version: str) -> str:
+    # Signed, so only someone who was sent the submission's info can use it to
+    # find out whether it changed
+    return quote_etag(
+        salted_hmac("submissions.show_json", f"{user.id}-{submission_id}-{version}").hexdigest()
+    )
+
+
 @login_required
 def show_json_view(request, submission_id):
     """Get a JSON response about the information of a submission
 
+    Responses have an ``ETag`` based on the submission's version (see
+    :mod:`.versions`), so polls with ``If-None-Match`` for a submission that
+    hasn't changed get a ``304 Not Modified`` without touching the database.
+
+    If the ``wait`` query parameter is given, such polls are held for up to that
+    many seconds (at most ``SUBMISSION_JSON_MAX_WAIT``) until the submission
+    changes.
+
     Args:
         request: The request
         submission_id: An instance of the :class:`.Submission` model
     """
+    client_etags = parse_etags(request.headers.get("If-None-Match", ""))
+
+    version = get_submission_version(submission_id)
+    etag = _info_etag(request.user, submission_id, version)
+    if etag in client_etags:
+        try:
+            wait = min(float(request.GET.get("wait", 0)), settings.SUBMISSION_JSON_MAX_WAIT)
+        except ValueError:
+            wait = 0
+        deadline = time.monotonic() + wait
+        while etag in client_etags and time.monotonic() < deadline:
+            time.sleep(settings.SUBMISSION_JSON_WAIT_INTERVAL)
+            version = get_submission_version(submission_id)
+            etag = _info_etag(request.user, submission_id, version)
+
+        if etag in client_etags:
+            response = http.HttpResponseNotModified()
+            response["ETag"] = etag
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+
     try:
         submission = Submission.objects.filter_visible(request.user).get(id=submission_id)
     except Submission.DoesNotExist:
         return http.JsonResponse({"error": "Submission not found"})
 
-    return http.JsonResponse(serialize_submission_info(submission, request.user))
+    response = http.JsonResponse(serialize_submission_info(submission, request.user))
+    response["ETag"] = etag
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 @login_required
@@ -105,8 +151,7 @@ def kill_view(request, submission_id):
     submission = get_object_or_404(submissions_editable, id=submission_id)
 
     if request.method == "POST":
-        submission.kill_requested = True
-        submission.save()
+        submission.request_kill()
         next_url = request.GET.get("next")
         if next_url and url_has_allowed_host_and_scheme(next_url, allowed_hosts=None):
             return redirect(next_url)
@@ -188,11 +233,6 @@ def edit_comment_view(request, submission_id, comment_id):
             form.save()
             return redirect("submissions:show", submission.id)
 
-    before_submissions = Submission.objects.filter(
-        student=submission.student, assignment=submission.assignment, id__lt=submission.id
-    )
-    submission_number = before_submissions.count() + 1
-
     form = CommentForm(instance=comment)
     context = {
         "form": form,
@@ -202,7 +242,7 @@ def edit_comment_view(request, submission_id, comment_id):
         "assignment": assignment,
         "submission": submission,
         "comment": comment,
-        "submission_number": submission_number,
+        "submission_number": submission.number,
     }
 
     return render(request, "submissions/edit_comment.html", context=context)
@@ -223,7 +263,7 @@ def delete_comment_view(request, submission_id, comment_id):
     comment = get_object_or_404(submission.comments.all(), id=comment_id)
     course = submission.assignment.course
 
-    if not course.teacher.filter(id=request.user.id).exists() and not request.user.is_superuser:
+    if not course.is_teacher_in_course(request.user) and not request.user.is_superuser:
         raise http.Http404
 
     comment.delete()
@@ -286,16 +326,25 @@ def filter_view(request):
                     },
                 )
             elif "view_code" in request.POST:
-                submission_texts = []
-                for submission in queryset:
-                    submission_texts.append(submission.file_text)
+                # Only the current page of submissions is fetched and read from disk
+                paginator = Paginator(
+                    queryset.select_related(
+                        "assignment__course", "assignment__folder", "student", "blob"
+                    ).prefetch_related("comments"),
+                    settings.FILTER_VIEW_CODE_PAGE_SIZE,
+                )
+                page = paginator.get_page(request.GET.get("page"))
+                submissions = list(page)
 
                 return render(
                     request,
                     "submissions/filter.html",
                     {
                         "form": filter_form,
-                        "submissions": list(zip(queryset, submission_texts, strict=False)),
+                        "submissions": list(
+                            zip(submissions, read_file_texts(submissions), strict=True)
+                        ),
+                        "page": page,
                         "action": "show_code",
                         "nav_item": "Filter submissions",
                     },
@@ -338,6 +387,11 @@ def set_aborted_complete_view(request):
     return redirect("auth:index")
 
 
+def _send_updates(submission_ids: list[int]) -> None:
+    for submission in Submission.objects.filter(id__in=submission_ids):
+        submission.send_update()
+
+
 @superuser_required
 def set_past_timeout_complete_view(request):
     """Update submissions based off the time limit
@@ -348,12 +402,20 @@ def set_past_timeout_complete_view(request):
         request: The request
     """
     if request.method == "POST":
-        Submission.objects.filter(
+        submissions = Submission.objects.filter(
             complete=False,
             grader_start_time__isnull=False,
             assignment__enable_grader_timeout=True,
             grader_start_time__lte=timezone.localtime().timestamp()
             - F("assignment__grader_timeout"),
-        ).update(complete=True)
+        )
+        with transaction.atomic():
+            submission_ids = list(submissions.values_list("id", flat=True))
+            Submission.objects.filter(id__in=submission_ids).update(complete=True)
+            # update() doesn't send signals, so the gradebook and the submissions'
+            # versions have to be updated here
+            refresh_gradebook_entries_for_submissions(submission_ids)
+            forget_submission_versions(*submission_ids)
+            transaction.on_commit(lambda: _send_updates(submission_ids))
 
     return redirect("auth:index")
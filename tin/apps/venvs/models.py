@@ -1,5 +1,7 @@
 from __future__ import annotations
 
+import glob
+import hashlib
 import logging
 import os
 import subprocess
@@ -81,6 +83,20 @@ class Venv(models.Model):
             "PATH": os.path.join(venv_path, "bin") + os.pathsep + os.environ["PATH"],
         }
 
+    def packages_fingerprint(self) -> str:
+        """A hash of the packages installed in the virtual environment.
+
+        Unlike :meth:`list_packages`, this doesn't run anything; it only looks at the
+        names of the package metadata directories (which include the versions).
+        """
+        site_packages = os.path.join(self.path, "lib", "python*", "site-packages")
+        names = sorted(
+            os.path.relpath(path, self.path)
+            for pattern in ("*.dist-info", "*.egg-info")
+            for path in glob.glob(os.path.join(site_packages, pattern))
+        )
+        return hashlib.sha256("\n".join(names).encode()).hexdigest()
+
     def list_packages(self) -> list[list[str]] | None:
         """List all packages in a virtual environment.
 
@@ -22,7 +22,10 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "tin.settings")
 django_asgi_app = get_asgi_application()
 
 
-from .apps.submissions.consumers import SubmissionJsonConsumer  # noqa: E402
+from .apps.submissions.consumers import (  # noqa: E402
+    SubmissionFeedConsumer,
+    SubmissionJsonConsumer,
+)
 
 
 class WebsocketCloseConsumer(WebsocketConsumer):
@@ -43,6 +46,7 @@ application = ProtocolTypeRouter(
         "websocket": AuthMiddlewareStack(
             URLRouter(
                 [
+                    path("submissions/feed.json", SubmissionFeedConsumer.as_asgi()),
                     path("submissions/<int:submission_id>.json", SubmissionJsonConsumer.as_asgi()),
                     path("<path:path>", WebsocketCloseConsumer.as_asgi()),
                 ]
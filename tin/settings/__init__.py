@@ -111,6 +111,20 @@ CHANNEL_LAYERS = {
     },
 }
 
+# Cache
+# https://docs.djangoproject.com/en/4.2/topics/cache/
+
+# Caches are invalidated by whichever process changes the cached data (e.g. the
+# Celery worker grading a submission), so they need to be shared between
+# processes, even in development. Override this in secret.py to use a different
+# backend.
+CACHES = {
+    "default": {
+        "BACKEND": "django.core.cache.backends.redis.RedisCache",
+        "LOCATION": "redis://localhost:6379/3",
+    },
+}
+
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 TEST_RUNNER = "tin.tests.runner.PytestRunner"
@@ -312,12 +326,80 @@ SUBMISSION_PYTHON = "/usr/bin/python3.10"
 
 SUBMISSION_NAMESERVERS = ["198.38.16.40", "198.38.16.41"]
 
+# Save the full (gzipped) grader output to disk in addition to
+# the truncated output stored in the database
+SAVE_FULL_GRADER_OUTPUT = False
+
+# How many times per second a running grader's output may be saved to the
+# database and pushed to clients. Set to 0 to only save it when the grader exits.
+GRADER_OUTPUT_MAX_FLUSHES_PER_SECOND = 2
+
+# Run graders as asyncio subprocesses, so that each Celery worker process can
+# supervise many graders at once instead of blocking while one runs
+ASYNC_GRADER_RUNNER = False
+
+# The maximum number of graders each worker process runs at once
+# when ASYNC_GRADER_RUNNER is enabled. Once this many are running, the worker
+# stops taking submissions from the queue. Running graders are lost if their
+# worker process dies, since their tasks have already been acknowledged.
+ASYNC_GRADER_RUNNER_MAX_GRADERS = 32
+
+# How many submission files are read at once when downloading
+# or viewing the code of many submissions
+SUBMISSION_FILE_READ_THREADS = 8
+
+# How many submissions' code is shown per page on the submission filter page
+FILTER_VIEW_CODE_PAGE_SIZE = 50
+
+# Pages watching many submissions get their updates over one WebSocket, in
+# batches sent at most this often (in seconds). Each connection may subscribe
+# to at most this many individual submissions.
+SUBMISSION_FEED_BATCH_INTERVAL = 0.5
+SUBMISSION_FEED_MAX_SUBMISSIONS = 500
+
+# Polls for a submission's info may wait up to this many seconds for it to
+# change, checking every SUBMISSION_JSON_WAIT_INTERVAL seconds. Each waiting
+# poll holds a worker thread.
+SUBMISSION_JSON_MAX_WAIT = 20
+SUBMISSION_JSON_WAIT_INTERVAL = 0.5
+
+# How long (in seconds) a course's gradebook may be cached for. It is also
+# removed from the cache whenever a score in the course changes.
+COURSE_GRADEBOOK_CACHE_TIMEOUT = 60 * 60
+
+# How long (in seconds) a student's list of unsubmitted and due soon assignments
+# may be cached for. It is also removed from the cache whenever it changes.
+STUDENT_DASHBOARD_CACHE_TIMEOUT = 60 * 60
+
+# How long (in seconds) the courses a user teaches and is enrolled in may be
+# cached for. They are also removed from the cache whenever they change.
+# Set this to 0 to load them once per request.
+COURSE_ROLES_CACHE_TIMEOUT = 60
+
 # Users may only have this many submissions running
 CONCURRENT_USER_SUBMISSION_LIMIT = 2
 
+# Submission rate limits are tracked in this Redis database, falling back to the
+# database if it's unavailable. Set this to None to always use the database.
+SUBMISSION_RATE_LIMIT_REDIS_URL = "redis://localhost:6379/2"
+
+# Rate limits with longer intervals than this (in minutes) are always checked
+# in the database
+SUBMISSION_RATE_LIMIT_MAX_INTERVAL = 24 * 60
+
 # Threshold for log messages being issues
 QUIZ_ISSUE_THRESHOLD = 5
 
+# Quiz log messages reported by students' browsers are buffered in this Redis
+# database and saved once this many have been reported, or this many seconds
+# after the first one. Set the URL to None to save them as they're reported.
+QUIZ_LOG_REDIS_URL = "redis://localhost:6379/4"
+QUIZ_LOG_BUFFER_SIZE = 200
+QUIZ_LOG_FLUSH_INTERVAL = 2
+
+# How long (in seconds) a student's total quiz severity may be cached for
+QUIZ_STATE_CACHE_TIMEOUT = 60 * 60
+
 # ImgBB API key (set in secret.py)
 IMGBB_API_KEY = ""
 
@@ -10,54 +10,160 @@ function filter_incomplete_by_endpoint(endpoint) {
   );
 }
 
-var websockets = {};
+// Updates to all the submissions on the page are received over a single
+// WebSocket (see SubmissionFeedConsumer). It is undefined before it's created,
+// and false after it closes.
+var FEED_ENDPOINT = '/submissions/feed.json';
+var feed;
+// The endpoint of each submission subscribed to, by id
+var feed_endpoints = {};
+// The ids of the incomplete submissions on the page
+var feed_ids = [];
+// The info received about each submission so far, since updates only
+// include what changed
+var feed_info = {};
 
-function create_websocket(endpoint) {
+function submission_id_from_endpoint(endpoint) {
+  var match = new URL(endpoint, location.href).pathname.match(
+    /^\/submissions\/(\d+)\.json$/
+  );
+  return match ? parseInt(match[1]) : null;
+}
+
+function feed_subscribe(submission_ids) {
+  var message = { type: 'subscribe', submissions: submission_ids };
+  // Teachers watching an assignment's roster subscribe to the whole assignment
+  var roster = $('[data-feed-assignment]').first();
+  if (roster.length) {
+    message.assignment = roster.data('feed-assignment');
+    if (roster.data('feed-period') !== undefined) {
+      message.period = roster.data('feed-period');
+    }
+  }
+  feed.send(JSON.stringify(message));
+}
+
+// Merge an update into what's known about a submission. Returns what changed:
+// the text appended to each output field that was appended to, and true for
+// each other field that changed.
+function merge_feed_update(id, changes) {
+  var info = feed_info[id] || (feed_info[id] = {});
+  var updated = {};
+  for (var key in changes) {
+    var value = changes[key];
+    var match = key.match(/^(.*)_append$/);
+    if (match) {
+      var field = match[1];
+      // Should always match, since updates arrive in order
+      if (info[field + '_end'] === value.from) {
+        info[field] += value.text;
+        info[field + '_end'] = value.to;
+        updated[field] = value.text;
+      }
+    } else {
+      info[key] = value;
+      updated[key] = true;
+    }
+  }
+  return updated;
+}
+
+function create_feed() {
   var ws_endpoint = join_url(
     location.protocol + '//' + location.host,
-    endpoint
+    FEED_ENDPOINT
   ).replace(/^http(s?):/, 'ws$1:');
   var sock = new WebSocket(ws_endpoint);
+  sock.onopen = function (e) {
+    feed_subscribe(feed_ids);
+  };
   sock.onmessage = function (e) {
-    data = JSON.parse(e.data);
-    handle_data(endpoint, data);
-    if (filter_incomplete_by_endpoint(endpoint).get().length == 0) {
+    var data = JSON.parse(e.data);
+    if (data.type != 'updates') {
+      return;
+    }
+    for (var id in data.submissions) {
+      var updated = merge_feed_update(id, data.submissions[id]);
+      if (feed_endpoints[id] !== undefined) {
+        handle_data(feed_endpoints[id], feed_info[id], updated);
+      }
+    }
+    if ($('.incomplete').get().length == 0) {
       sock.close();
     }
   };
   sock.onclose = function (e) {
-    websockets[endpoint] = false;
+    feed = false;
   };
-  websockets[endpoint] = sock;
+  feed = sock;
+}
+
+// How long (in seconds) polls wait for the submission to change
+var POLL_WAIT = 20;
+// Whether each endpoint has a poll waiting for a response
+var polling = {};
+
+function poll(endpoint) {
+  if (polling[endpoint]) {
+    return;
+  }
+  polling[endpoint] = true;
+  // With ifModified, jQuery sends the ETag of the last response, and the server
+  // waits until the submission changes before answering
+  $.ajax({
+    url: endpoint,
+    data: { wait: POLL_WAIT },
+    ifModified: true,
+    success: function (data, status) {
+      if (status != 'notmodified') {
+        handle_data(endpoint, data);
+      }
+    },
+    complete: function () {
+      polling[endpoint] = false;
+    },
+  });
 }
 
 function update() {
   var endpoints = new Set();
+  var ids = [];
+  var new_ids = [];
   $('.incomplete').each(function (i, obj) {
-    endpoint = $(obj).data('endpoint');
-    if (!endpoints.has(endpoint)) {
-      if ($(obj).data('no-websocket') == true) {
-        $.get(endpoint, function (data) {
-          handle_data(endpoint, data);
-        });
-      } else {
-        if (websockets[endpoint] === undefined) {
-          // Just not created yet
-          create_websocket(endpoint);
-        } else if (websockets[endpoint] == false) {
-          // Connection closed
-          $.get(endpoint, function (data) {
-            handle_data(endpoint, data);
-            create_websocket(endpoint);
-          });
-        }
+    var endpoint = $(obj).data('endpoint');
+    if (endpoints.has(endpoint)) {
+      return;
+    }
+    endpoints.add(endpoint);
+
+    var id = submission_id_from_endpoint(endpoint);
+    if ($(obj).data('no-websocket') == true || id === null || feed === false) {
+      // Poll instead (until the feed is reopened, if it closed)
+      poll(endpoint);
+    }
+    if (id !== null && $(obj).data('no-websocket') != true) {
+      ids.push(id);
+      if (feed_endpoints[id] === undefined) {
+        new_ids.push(id);
       }
-      endpoints.add(endpoint);
+      feed_endpoints[id] = endpoint;
     }
   });
+
+  feed_ids = ids;
+  if (!feed_ids.length) {
+    return;
+  }
+  if (!feed) {
+    // Subscribes to everything once it opens
+    create_feed();
+  } else if (new_ids.length && feed.readyState == WebSocket.OPEN) {
+    feed_subscribe(new_ids);
+  }
 }
 
-function handle_data(endpoint, res) {
+// `updated` is what changed since the last call, if known (see merge_feed_update)
+function handle_data(endpoint, res, updated) {
   filter_incomplete_by_endpoint(endpoint).each(function (i, obj) {
     obj = $(obj);
     if (res.complete) {
@@ -99,10 +205,17 @@ function handle_data(endpoint, res) {
         other_result_div.text('');
       }
     }
-    var value = res[obj.data('endpoint-key')];
+    var key = obj.data('endpoint-key');
+    var value = res[key];
     if (obj.hasClass('code-result')) {
-      result_obj.text('');
-      $('<pre>').appendTo($('<code>').appendTo(result_obj)).text(value);
+      var pre = result_obj.find('pre');
+      if (updated && typeof updated[key] == 'string' && pre.length) {
+        // Only render the new output
+        pre.append(document.createTextNode(updated[key]));
+      } else if (!updated || updated[key] || !pre.length) {
+        result_obj.text('');
+        $('<pre>').appendTo($('<code>').appendTo(result_obj)).text(value);
+      }
     } else if (obj.hasClass('conditional-result')) {
       var show = Boolean(value);
       if (obj.data('resultNegate') == true) {
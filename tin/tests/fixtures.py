@@ -4,6 +4,7 @@ import shutil
 from pathlib import Path
 
 import pytest
+from django.core.cache import cache
 from django.utils import timezone
 
 import tin.tests.create_users as users
@@ -32,6 +33,36 @@ def tin_setup(settings, worker_id: str, testrun_uid: str):
         shutil.rmtree(settings.MEDIA_ROOT)
 
 
+@pytest.fixture(autouse=True)
+def in_memory_channel_layer(settings):
+    """Use an in-memory channel layer so tests don't need Redis."""
+    settings.CHANNEL_LAYERS = {"default": {"BACKEND": "channels.layers.InMemoryChannelLayer"}}
+
+
+@pytest.fixture(autouse=True)
+def database_rate_limits(settings):
+    """Check submission rate limits in the database so tests don't need Redis."""
+    settings.SUBMISSION_RATE_LIMIT_REDIS_URL = None
+
+
+@pytest.fixture(autouse=True)
+def unbuffered_quiz_log(settings):
+    """Save reported quiz log messages right away, so tests don't need Redis."""
+    settings.QUIZ_LOG_REDIS_URL = None
+
+
+@pytest.fixture(autouse=True)
+def in_memory_cache(settings):
+    """Use an in-memory cache so tests don't need Redis."""
+    settings.CACHES = {"default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}}
+
+
+@pytest.fixture(autouse=True)
+def clear_cache(in_memory_cache):
+    """Make sure nothing cached by a previous test leaks into the next one."""
+    cache.clear()
+
+
 @pytest.fixture(autouse=True)
 def create_users():
     users.add_users_to_database(password=PASSWORD, verbose=False)